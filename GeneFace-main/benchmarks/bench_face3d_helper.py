@@ -0,0 +1,60 @@
+"""
+Loading time and parity of Face3DHelper with the cached keypoint bases (BFM_keypoint_basis.npz) against the
+previous full load of BFM_model_front.mat. Needs the BFM at --bfm_dir.
+
+    python benchmarks/bench_face3d_helper.py --bfm_dir=deep_3drecon/BFM
+"""
+import os
+import argparse
+import time
+import numpy as np
+import torch
+from scipy.io import loadmat
+
+from data_util.face3d_helper import Face3DHelper, get_face3d_helper, KEYPOINT_BASIS_NPZ
+
+
+def previous_key_bases(bfm_dir):
+    model = loadmat(os.path.join(bfm_dir, "BFM_model_front.mat"))
+    mean_shape = torch.from_numpy(model['meanshape'].transpose()).float()
+    id_base = torch.from_numpy(model['idBase']).float()
+    exp_base = torch.from_numpy(model['exBase']).float()
+    key_points = torch.from_numpy(model['keypoints'].squeeze().astype(np.int64)).long()
+    return {
+        'key_mean_shape': mean_shape.reshape([-1, 3])[key_points, :],
+        'key_id_base': id_base.reshape([-1, 3, 80])[key_points, :, :].reshape([-1, 80]),
+        'key_exp_base': exp_base.reshape([-1, 3, 64])[key_points, :, :].reshape([-1, 64]),
+    }
+
+
+def _time(func):
+    t = time.time()
+    ret = func()
+    return time.time() - t, ret
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bfm_dir', type=str, default='deep_3drecon/BFM')
+    args = parser.parse_args()
+    npz_name = os.path.join(args.bfm_dir, KEYPOINT_BASIS_NPZ)
+    if os.path.exists(npz_name):
+        os.remove(npz_name)
+
+    t_prev, expected = _time(lambda: previous_key_bases(args.bfm_dir))
+    t_build, _ = _time(lambda: Face3DHelper(args.bfm_dir, use_gpu=False)) # builds the cache
+    t_cached, helper = _time(lambda: Face3DHelper(args.bfm_dir, use_gpu=False))
+    for k, v in expected.items():
+        assert torch.equal(getattr(helper, k), v), k
+    identity, exp = torch.randn(100, 80), torch.randn(100, 64)
+    assert 'mean_shape' not in helper.__dict__, 'the full mesh bases are loaded eagerly'
+    t_mesh, mesh = _time(lambda: helper.reconstruct_face_mesh(identity, exp))
+    lm3d = mesh.reshape([100, -1, 3])[:, helper.key_points] # the mesh recenters with the mean of all vertices
+    lm3d_ref = helper.reconstruct_lm3d(identity, exp) - helper.mean_shape.reshape([-1, 3]).mean(dim=0) + helper.key_mean_shape.mean(dim=0)
+    assert torch.allclose(lm3d, lm3d_ref, atol=1e-3)
+    assert get_face3d_helper(args.bfm_dir, use_gpu=False) is get_face3d_helper(args.bfm_dir, use_gpu=False)
+    print("| parity: ok")
+    print(f"| previous, full .mat load           : {t_prev * 1000:9.2f} ms")
+    print(f"| current, first use (builds cache)  : {t_build * 1000:9.2f} ms")
+    print(f"| current, cached keypoint bases     : {t_cached * 1000:9.2f} ms, speedup {t_prev / t_cached:.1f}x")
+    print(f"| current, lazy full mesh load       : {t_mesh * 1000:9.2f} ms")
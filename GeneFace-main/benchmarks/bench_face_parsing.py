@@ -0,0 +1,97 @@
+"""
+Throughput of the BiSeNet face parsing (data_util/face_parsing/test.py) on CPU for several batch sizes,
+and of the LUT colorization against the previous per-class loops.
+
+    python benchmarks/bench_face_parsing.py --batch_sizes=1,4,16 --num_images=64 --num_workers=4
+
+The frames are random 512x512 images decoded by the same ParsingDataset/DataLoader as test.py,
+the checkpoint is loaded when it exists (the throughput does not depend on the weights).
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+import shutil
+import time
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+FACE_PARSING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data_util/face_parsing')
+sys.path.insert(0, FACE_PARSING_DIR)
+# load test.py by its path, `import test` would be the stdlib package
+spec = importlib.util.spec_from_file_location('face_parsing_test', os.path.join(FACE_PARSING_DIR, 'test.py'))
+face_parsing_test = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(face_parsing_test)
+from model import BiSeNet
+from data_util.frame_store import colorize_parsing
+
+
+def colorize_loops(parsing):
+    # the previous vis_parsing_maps
+    color = np.zeros((parsing.shape[0], parsing.shape[1], 3)) + np.array([255, 255, 255])
+    for pi in range(1, 14):
+        index = np.where(parsing == pi)
+        color[index[0], index[1], :] = np.array([255, 0, 0])
+    for pi in range(14, 16):
+        index = np.where(parsing == pi)
+        color[index[0], index[1], :] = np.array([0, 255, 0])
+    for pi in range(16, 17):
+        index = np.where(parsing == pi)
+        color[index[0], index[1], :] = np.array([0, 0, 255])
+    for pi in range(17, np.max(parsing) + 1):
+        index = np.where(parsing == pi)
+        color[index[0], index[1], :] = np.array([255, 0, 0])
+    return color.astype(np.uint8)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=str, default='1,4,16')
+    parser.add_argument('--num_images', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads, 0 for the default')
+    parser.add_argument('--modelpath', type=str, default='data_util/face_parsing/79999_iter.pth')
+    args = parser.parse_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    net = BiSeNet(n_classes=19)
+    if os.path.exists(args.modelpath):
+        net.load_state_dict(torch.load(args.modelpath, map_location='cpu'))
+    net.eval()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState(0)
+        image_names = []
+        for i in range(args.num_images):
+            cv2.imwrite(os.path.join(tmp_dir, f'{i}.jpg'), rng.randint(0, 256, size=(512, 512, 3), dtype=np.uint8))
+            image_names.append(f'{i}.jpg')
+        dataset = face_parsing_test.ParsingDataset(tmp_dir, image_names, use_frame_store=False)
+
+        parsings = None
+        for bs in [int(x) for x in args.batch_sizes.split(',')]:
+            loader = DataLoader(dataset, batch_size=bs, num_workers=args.num_workers, shuffle=False)
+            with torch.no_grad():
+                net(torch.zeros([1, 3, 512, 512])) # warmup
+                t = time.time()
+                for imgs, idxs, ori_sizes in loader:
+                    parsings = net(imgs)[0].argmax(1).byte().numpy()
+                t_total = time.time() - t
+            print(f"| batch size {bs:>2d}: {args.num_images / t_total:.2f} images/s ({t_total:.2f}s for {args.num_images} images)")
+
+        t = time.time()
+        for _ in range(10):
+            ref = colorize_loops(parsings[0])
+        t_loops = (time.time() - t) / 10
+        t = time.time()
+        for _ in range(10):
+            out = colorize_parsing(parsings[0], (512, 512))
+        t_lut = (time.time() - t) / 10
+        assert (ref == out).all()
+        print(f"| colorization: per-class loops {t_loops * 1000:.2f}ms, lut {t_lut * 1000:.2f}ms")
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,57 @@
+"""
+Runtime of the focal search of data_util/face_tracking/face_tracker.py: the previous sequential search
+(one full fit per candidate focal) against the batched search, with and without the per-candidate early stopping.
+
+    CUDA_VISIBLE_DEVICES= python benchmarks/bench_face_tracker_focal.py --video_id=May
+
+Needs the landmarks of data/processed/videos/<video_id>/ori_imgs (the extract_landmarks step).
+Prints the time and the selected focal of each search, and the best landmark loss of each candidate.
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+
+FACE_TRACKING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data_util/face_tracking')
+sys.path.insert(0, FACE_TRACKING_DIR)
+from face_tracker import search_focal
+from facemodel import Face_3DMM
+from data_loader import load_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video_id', type=str, default='May')
+    parser.add_argument('--img_h', type=int, default=512)
+    parser.add_argument('--img_w', type=int, default=512)
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads, 0 for the default')
+    args = parser.parse_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    lms, _ = load_dir(os.path.join('data/processed/videos', args.video_id, 'ori_imgs'), 0, 100000)
+    cxy = torch.tensor((args.img_w / 2.0, args.img_h / 2.0), dtype=torch.float).to(lms.device)
+    model_3dmm = Face_3DMM(os.path.join(FACE_TRACKING_DIR, '3DMM'), 100, 79, 100, 34650)
+    focals = list(range(600, 1700, 100))
+
+    # the previous search: one fit per focal, all iterations
+    t = time.time()
+    seq_losses = [search_focal(model_3dmm, lms, cxy, focals=[focal], early_stop=False, log_fname=None)[1][0] for focal in focals]
+    t_seq = time.time() - t
+    seq_focal = focals[min(range(len(focals)), key=lambda k: seq_losses[k])]
+
+    t = time.time()
+    batch_focal, batch_losses = search_focal(model_3dmm, lms, cxy, focals=focals, early_stop=False, log_fname=None)
+    t_batch = time.time() - t
+
+    t = time.time()
+    stop_focal, stop_losses = search_focal(model_3dmm, lms, cxy, focals=focals, early_stop=True, log_fname=None)
+    t_stop = time.time() - t
+
+    print(f"| sequential: {t_seq:.1f}s, focal {seq_focal}")
+    print(f"| batched: {t_batch:.1f}s ({t_seq / t_batch:.1f}x), focal {batch_focal}")
+    print(f"| batched + early stop: {t_stop:.1f}s ({t_seq / t_stop:.1f}x), focal {stop_focal}")
+    for focal, l_seq, l_batch, l_stop in zip(focals, seq_losses, batch_losses, stop_losses):
+        print(f"| focal {focal}: loss_lan sequential {l_seq:.4f}, batched {l_batch:.4f}, early stop {l_stop:.4f}")
+    assert seq_focal == batch_focal == stop_focal, "the selected focal differs"
@@ -0,0 +1,76 @@
+"""
+Benchmark of the frame store (data_util/frame_store.py) against the per-frame jpgs.
+
+    python benchmarks/bench_frame_store.py --video=data/raw/videos/May.mp4 --num_passes=6
+
+Measures the time to explode the video, the time of `num_passes` full reads of the frames
+(landmarks, parsing, background, head, torso/gt and 3dmm each read all frames once), and the disk footprint.
+The wall time of the whole preprocessing is recorded by data_gen/nerf/process_data.py in
+data/processed/videos/<video_id>/process_manifest.json (`last_run`).
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+import cv2
+import numpy as np
+
+from data_util.frame_store import build_frame_store, list_frames, read_frame
+
+
+def dir_size(path, pattern):
+    return sum(os.path.getsize(f) for f in glob.glob(os.path.join(path, pattern)))
+
+
+def read_all(image_paths, reader):
+    checksum = 0
+    for image_path in image_paths:
+        img = reader(image_path)
+        checksum += int(img[0, 0, 0])
+    return checksum
+
+
+def bench_jpg(video, out_dir, fps, num_passes):
+    t = time.time()
+    os.system(f'ffmpeg -v quiet -i {video} -vf fps={fps} -qmin 1 -q:v 1 -start_number 0 {os.path.join(out_dir, "%d.jpg")}')
+    t_extract = time.time() - t
+    image_paths = glob.glob(os.path.join(out_dir, '*.jpg'))
+    t = time.time()
+    for _ in range(num_passes):
+        read_all(image_paths, lambda p: cv2.imread(p, cv2.IMREAD_UNCHANGED))
+    t_read = time.time() - t
+    return t_extract, t_read, dir_size(out_dir, '*.jpg'), len(image_paths)
+
+
+def bench_frame_store(video, out_dir, fps, num_passes):
+    t = time.time()
+    build_frame_store(video, out_dir, fps=fps)
+    t_extract = time.time() - t
+    image_paths = list_frames(out_dir)
+    t = time.time()
+    for _ in range(num_passes):
+        read_all(image_paths, read_frame)
+    t_read = time.time() - t
+    return t_extract, t_read, dir_size(out_dir, 'frames.*'), len(image_paths)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video', type=str, default='data/raw/videos/May.mp4')
+    parser.add_argument('--fps', type=int, default=25)
+    parser.add_argument('--num_passes', type=int, default=6, help='number of stages that read all frames')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name, fn in [('jpg', bench_jpg), ('frame_store', bench_frame_store)]:
+            out_dir = os.path.join(tmp_dir, name)
+            os.makedirs(out_dir)
+            t_extract, t_read, size, num_frames = fn(args.video, out_dir, args.fps, args.num_passes)
+            print(f"| {name:>12s}: {num_frames} frames, extract {t_extract:.2f}s, "
+                  f"{args.num_passes} reads {t_read:.2f}s ({num_frames * args.num_passes / max(t_read, 1e-9):.0f} frames/s), "
+                  f"total {t_extract + t_read:.2f}s, disk {size / 1024**3:.2f} GB")
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,85 @@
+"""
+Benchmark of the per-frame ray generation of modules.radnerfs.utils.get_rays.
+
+    python benchmarks/bench_get_rays.py --H=512 --W=512 --device=cpu
+
+Compares the cached camera-direction grid with the previous implementation,
+which rebuilt the full H*W meshgrid and normalized directions for every frame.
+"""
+import argparse
+import time
+import torch
+
+from modules.radnerfs.utils import custom_meshgrid, get_rays
+
+
+def get_rays_uncached(poses, intrinsics, H, W):
+    # the previous implementation of get_rays, N=-1 branch
+    device = poses.device
+    B = poses.shape[0]
+    fx, fy, cx, cy = intrinsics
+    i, j = custom_meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device)) # float
+    i = i.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
+    j = j.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
+    zs = torch.ones_like(i)
+    xs = (i - cx) / fx * zs
+    ys = (j - cy) / fy * zs
+    directions = torch.stack((xs, ys, zs), dim=-1)
+    directions = directions / torch.norm(directions, dim=-1, keepdim=True)
+    rays_d = directions @ poses[:, :3, :3].transpose(-1, -2) # (B, N, 3)
+    rays_o = poses[..., :3, 3] # [B, 3]
+    rays_o = rays_o[..., None, :].expand_as(rays_d) # [B, N, 3]
+    return {'rays_o': rays_o, 'rays_d': rays_d}
+
+
+def random_poses(num_frames, device):
+    poses = torch.eye(4, device=device).repeat(num_frames, 1, 1)
+    q, _ = torch.linalg.qr(torch.randn(num_frames, 3, 3, device=device))
+    poses[:, :3, :3] = q
+    poses[:, :3, 3] = torch.randn(num_frames, 3, device=device)
+    return poses
+
+
+def bench(fn, poses, n_warmup=3):
+    for i in range(n_warmup):
+        fn(poses[[i]])
+    if poses.is_cuda:
+        torch.cuda.synchronize()
+    t0 = time.time()
+    for i in range(poses.shape[0]):
+        fn(poses[[i]])
+    if poses.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - t0) / poses.shape[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--H', type=int, default=512)
+    parser.add_argument('--W', type=int, default=512)
+    parser.add_argument('--num_frames', type=int, default=100)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    H, W = args.H, args.W
+    intrinsics = [1200., 1200., W / 2, H / 2]
+    poses = random_poses(args.num_frames, args.device)
+
+    rays = get_rays(poses[[0]], intrinsics, H, W, N=-1)
+    rays_ref = get_rays_uncached(poses[[0]], intrinsics, H, W)
+    max_err = (rays['rays_d'] - rays_ref['rays_d']).abs().max().item()
+    print(f"| {H}x{W} on {args.device}, max abs diff of rays_d: {max_err:.2e}")
+    # in-place updates of the returned tensors must not leak into the cached grid
+    for k in ['i', 'j', 'rays_d']:
+        rays[k] += 1.
+    rays_again = get_rays(poses[[0]], intrinsics, H, W, N=-1)
+    for k in ['i', 'j', 'rays_d']:
+        assert torch.equal(rays_again[k] + 1., rays[k]), k
+
+    t_uncached = bench(lambda pose: get_rays_uncached(pose, intrinsics, H, W), poses)
+    t_cached = bench(lambda pose: get_rays(pose, intrinsics, H, W, N=-1), poses)
+    print(f"| uncached: {t_uncached * 1000:.2f} ms/frame")
+    print(f"| cached:   {t_cached * 1000:.2f} ms/frame, {t_uncached / t_cached:.1f}x")
+    lip_rect = [H // 2, H // 2 + 64, W // 2 - 32, W // 2 + 32]
+    t_rect = bench(lambda pose: get_rays(pose, intrinsics, H, W, N=-1, rect=lip_rect), poses)
+    print(f"| rect 64x64: {t_rect * 1000:.2f} ms/frame")
@@ -0,0 +1,104 @@
+"""
+Random-access read throughput of utils/commons/indexed_datasets.IndexedDataset: the previous reader
+(open/seek/read/close and unpickle for every item) against the memory-mapped reader, item by item,
+with get_many, and in the raw 'memoryview' mode without pickle.
+
+    python benchmarks/bench_indexed_dataset.py --num_items=2000 --num_reads=5000 --batch_size=64
+
+The items are LRS3-like dicts (mel, hubert, coeff, idexp_lm3d of a random length) written over several
+chunks by IndexedDatasetBuilder. Run it twice to compare with the cold page cache
+(e.g., `echo 3 > /proc/sys/vm/drop_caches` in between, as root).
+"""
+import argparse
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import time
+from bisect import bisect
+import numpy as np
+import tqdm
+
+from utils.commons.indexed_datasets import IndexedDataset, IndexedDatasetBuilder, load_index_data
+
+
+class PreviousIndexedDataset:
+    # the reader before the memory maps
+    def __init__(self, path):
+        self.path = path
+        with open(f"{path}.data", 'rb') as f:
+            self.byte_offsets, self.id2pos, self.meta = load_index_data(f)
+
+    def __getitem__(self, i):
+        chunk_id = bisect(self.meta['chunk_begin'][1:], self.byte_offsets[i])
+        data_file = open(f"{self.path}.data" if chunk_id == 0 else f"{self.path}.{chunk_id}.data", 'rb', buffering=-1)
+        data_file.seek(self.byte_offsets[i] - self.meta['chunk_begin'][chunk_id])
+        b = data_file.read(self.byte_offsets[i + 1] - self.byte_offsets[i])
+        data_file.close()
+        return pickle.loads(b)
+
+
+def build_dataset(ds_path, num_items, max_size):
+    rng = np.random.RandomState(0)
+    builder = IndexedDatasetBuilder(ds_path, max_size=max_size)
+    for i in tqdm.trange(num_items, desc='building'):
+        t = rng.randint(20, 200)
+        builder.add_item({
+            'item_id': f'spk_{i}',
+            'mel': rng.randn(2 * t, 80).astype(np.float32),
+            'hubert': rng.randn(2 * t, 1024).astype(np.float32),
+            'coeff': rng.randn(t, 257).astype(np.float32),
+            'idexp_lm3d': rng.randn(t, 68, 3).astype(np.float32),
+        })
+    builder.finalize()
+
+
+def timeit(desc, func, num_reads):
+    t = time.time()
+    func()
+    t_total = time.time() - t
+    print(f"| {desc:<28s}: {num_reads / t_total:10.1f} items/s ({t_total:.2f}s)")
+    return t_total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_items', type=int, default=2000)
+    parser.add_argument('--num_reads', type=int, default=5000)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--chunk_mb', type=int, default=256, help='max size of a data chunk')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ds_path = os.path.join(tmp_dir, 'train')
+        build_dataset(ds_path, args.num_items, args.chunk_mb * 1024 ** 2)
+        random.seed(0)
+        indices = [random.randint(0, args.num_items - 1) for _ in range(args.num_reads)]
+        batches = [indices[i:i + args.batch_size] for i in range(0, len(indices), args.batch_size)]
+
+        prev_ds = PreviousIndexedDataset(ds_path)
+        ds = IndexedDataset(ds_path)
+        raw_ds = IndexedDataset(ds_path, mode='memoryview')
+        print(f"| {args.num_items} items in {len(ds.data_fnames)} chunks, "
+              f"{sum(os.path.getsize(f) for f in ds.data_fnames) / 1024 ** 2:.1f} MB")
+
+        # the readers return the same items
+        for i in indices[:100]:
+            a, b, c = prev_ds[i], ds[i], pickle.loads(raw_ds[i])
+            assert a['item_id'] == b['item_id'] == c['item_id'] and (a['mel'] == b['mel']).all() and (a['hubert'] == c['hubert']).all()
+        for batch in batches[:10]:
+            for i, item in zip(batch, ds.get_many(batch)):
+                assert item['item_id'] == f'spk_{i}'
+
+        t_prev = timeit('previous, item by item', lambda: [prev_ds[i] for i in indices], args.num_reads)
+        t_mmap = timeit('mmap, item by item', lambda: [ds[i] for i in indices], args.num_reads)
+        t_many = timeit(f'mmap, get_many({args.batch_size})', lambda: [ds.get_many(b) for b in batches], args.num_reads)
+        t_raw = timeit('mmap, raw memoryview', lambda: [raw_ds[i] for i in indices], args.num_reads)
+        t_raw_many = timeit(f'mmap, raw get_many({args.batch_size})', lambda: [raw_ds.get_many(b) for b in batches], args.num_reads)
+        print(f"| speedup over the previous reader: item {t_prev / t_mmap:.2f}x, get_many {t_prev / t_many:.2f}x, "
+              f"raw {t_prev / t_raw:.2f}x, raw get_many {t_prev / t_raw_many:.2f}x")
+        del ds, raw_ds
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,54 @@
+"""
+Scaling of the 2D landmark detection of data_util/process.py with the number of workers.
+
+    python benchmarks/bench_landmarks.py --ori_imgs_dir=data/processed/videos/May/ori_imgs --num_frames=500 --workers=1,2,4,8
+
+The cpu path runs one FaceAlignment instance per worker (pinned to its own cores) and reuses the
+face box of the previous frame; `--device=cuda` benchmarks the batched detector path instead.
+`--baseline` also times the previous implementation, i.e., the face detector on every frame.
+"""
+import argparse
+import time
+import os
+import cv2
+import numpy as np
+
+from data_util.frame_store import list_frames, read_frame
+from data_util.process import build_face_alignment, detect_landmarks
+
+
+def detect_landmarks_baseline(image_paths):
+    fa = build_face_alignment('cpu')
+    lms = np.zeros([len(image_paths), 68, 2], dtype=np.float32)
+    for i, image_path in enumerate(image_paths):
+        preds = fa.get_landmarks(cv2.cvtColor(read_frame(image_path), cv2.COLOR_BGR2RGB))
+        if preds is not None and len(preds) > 0:
+            lms[i] = preds[0].reshape(-1, 2)[:, :2]
+    return lms
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ori_imgs_dir', type=str, default='data/processed/videos/May/ori_imgs')
+    parser.add_argument('--num_frames', type=int, default=500)
+    parser.add_argument('--workers', type=str, default='1,2,4,8')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--baseline', action='store_true')
+    args = parser.parse_args()
+
+    image_paths = sorted(list_frames(args.ori_imgs_dir), key=lambda p: int(os.path.basename(p)[:-4]))[:args.num_frames]
+    ref_lms = None
+    if args.baseline:
+        t = time.time()
+        ref_lms = detect_landmarks_baseline(image_paths)
+        elapsed = time.time() - t
+        print(f"| baseline: {len(image_paths) / elapsed:.2f} frames/s")
+    worker_lst = [int(x) for x in args.workers.split(',')] if args.device == 'cpu' else [1]
+    for num_workers in worker_lst:
+        t = time.time()
+        lms, valid = detect_landmarks(image_paths, device=args.device, num_workers=num_workers)
+        elapsed = time.time() - t
+        msg = f"| workers={num_workers}: {len(image_paths) / elapsed:.2f} frames/s, valid {valid.sum()}/{len(valid)}"
+        if ref_lms is not None:
+            msg += f", mean diff to baseline {np.abs(lms[valid] - ref_lms[valid]).mean():.3f} px"
+        print(msg)
@@ -0,0 +1,164 @@
+"""
+Throughput of utils/commons/multiprocess_utils on the mel/F0 extraction of data_gen/process_lrs3: the previous
+manager (one job per message, every result pickled through the results queue) against the current one with
+chunked submission and the numpy results in shared memory, ordered and unordered.
+
+    python benchmarks/bench_multiprocess.py --num_wavs=256 --num_workers=8 --chunk_size=4
+    python benchmarks/bench_multiprocess.py --wav_glob='data/raw/lrs3/*/*.wav' --num_wavs=1000
+
+Without --wav_glob, random wavs of 2~10 seconds are written to a temporary directory. Each job returns the
+padded wav, the mel and the f0, so the results are a few hundred KB each, like the LRS3 items.
+check_errors runs first: a failed job returns None by default, and with on_error='raise' no shared memory
+block is left in /dev/shm.
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+import traceback
+import numpy as np
+import soundfile as sf
+
+from data_gen.process_lrs3.process_audio_mel_f0 import extract_mel_from_fname, extract_f0_from_wav_and_mel
+from utils.commons.multiprocess_utils import MultiprocessManager, WorkerError
+
+
+def previous_chunked_worker(worker_id, args_queue=None, results_queue=None):
+    while True:
+        args = args_queue.get()
+        if args == '<KILL>':
+            return
+        job_idx, map_func, arg = args
+        try:
+            results_queue.put((job_idx, map_func(arg)))
+        except:
+            traceback.print_exc()
+            results_queue.put((job_idx, None))
+
+
+def previous_multiprocess_run(map_func, args, num_workers):
+    # the manager before the chunked submission and the shared memory, unordered
+    from multiprocessing import Queue, Process
+    args_queue, results_queue = Queue(), Queue()
+    workers = [Process(target=previous_chunked_worker, args=(i, args_queue, results_queue), daemon=True)
+               for i in range(num_workers)]
+    for w in workers:
+        w.start()
+    for i, arg in enumerate(args):
+        args_queue.put((i, map_func, arg))
+    for _ in range(len(args)):
+        yield results_queue.get()
+    for _ in workers:
+        args_queue.put('<KILL>')
+    for w in workers:
+        w.join()
+
+
+def current_multiprocess_run(map_func, args, num_workers, ordered, **manager_kwargs):
+    manager = MultiprocessManager(num_workers, **manager_kwargs)
+    for arg in args:
+        manager.add_job(map_func, arg)
+    yield from manager.get_results(ordered=ordered)
+    manager.close()
+
+
+def extract_mel_f0_job(wav_name):
+    wav, mel = extract_mel_from_fname(wav_name)
+    f0, _ = extract_f0_from_wav_and_mel(wav, mel)
+    return {'wav': wav.astype(np.float32), 'mel': mel.astype(np.float32), 'f0': f0}
+
+
+def failing_job(i, fail_every):
+    if i % fail_every == 0:
+        raise ValueError(f"job {i} fails")
+    return np.full([256 * 1024], i, dtype=np.float32) # 1MB, in shared memory
+
+
+def list_shm():
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+
+def check_errors(num_workers):
+    # the failed jobs are skipped by default
+    res = dict(current_multiprocess_run(failing_job, [(i, 7) for i in range(50)], num_workers, ordered=True))
+    assert len(res) == 50 and all((res[i] is None) == (i % 7 == 0) for i in range(50))
+    assert all(res[i][0] == i for i in range(50) if i % 7 != 0)
+    # the results in flight are released when a failed job aborts the run
+    shm_before = list_shm()
+    try:
+        for _ in current_multiprocess_run(failing_job, [(i, 97) for i in range(1, 400)], num_workers,
+                                          ordered=False, chunk_size=4, on_error='raise'):
+            pass
+        raise AssertionError('no WorkerError')
+    except WorkerError as e:
+        assert e.job_idx == 96, e.job_idx
+    time.sleep(0.5)
+    leaked = list_shm() - shm_before
+    assert len(leaked) == 0, f"shared memory blocks leaked: {sorted(leaked)}"
+    print("| errors: ok")
+
+
+def write_random_wavs(out_dir, num_wavs, sample_rate=16000):
+    rng = np.random.RandomState(0)
+    wav_names = []
+    for i in range(num_wavs):
+        t = np.arange(int(rng.uniform(2, 10) * sample_rate)) / sample_rate
+        # a gliding tone over noise, so the pitch tracker has some voiced frames
+        wav = 0.3 * np.sin(2 * np.pi * (150 + 50 * np.sin(t)) * t) + 0.01 * rng.randn(len(t))
+        wav_name = os.path.join(out_dir, f'{i:05d}.wav')
+        sf.write(wav_name, wav.astype(np.float32), sample_rate)
+        wav_names.append(wav_name)
+    return wav_names
+
+
+def timeit(desc, run, num_jobs):
+    t = time.time()
+    mel_frames = 0
+    for _, res in run():
+        mel_frames += len(res['mel'])
+    t_total = time.time() - t
+    print(f"| {desc:<36s}: {num_jobs / t_total:8.1f} wavs/s ({t_total:.2f}s, {mel_frames} mel frames)")
+    return t_total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--wav_glob', type=str, default='')
+    parser.add_argument('--num_wavs', type=int, default=256)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--chunk_size', type=int, default=4)
+    args = parser.parse_args()
+
+    tmp_dir = None
+    if args.wav_glob != '':
+        wav_names = sorted(glob.glob(args.wav_glob))[:args.num_wavs]
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        wav_names = write_random_wavs(tmp_dir, args.num_wavs)
+    try:
+        check_errors(args.num_workers)
+        # the managers return the same results
+        prev_res = dict(previous_multiprocess_run(extract_mel_f0_job, wav_names[:16], args.num_workers))
+        cur_res = dict(current_multiprocess_run(extract_mel_f0_job, wav_names[:16], args.num_workers, ordered=True,
+                                                chunk_size=args.chunk_size))
+        for i in range(len(prev_res)):
+            for k in ['wav', 'mel', 'f0']:
+                assert np.array_equal(prev_res[i][k], cur_res[i][k]), (i, k)
+
+        n = len(wav_names)
+        t_prev = timeit('previous', lambda: previous_multiprocess_run(extract_mel_f0_job, wav_names, args.num_workers), n)
+        t_pickle = timeit('current, pickled results', lambda: current_multiprocess_run(
+            extract_mel_f0_job, wav_names, args.num_workers, ordered=False, min_shm_bytes=float('inf')), n)
+        t_shm = timeit('current, shared memory', lambda: current_multiprocess_run(
+            extract_mel_f0_job, wav_names, args.num_workers, ordered=False), n)
+        t_chunk = timeit(f'current, shared memory, chunk {args.chunk_size}', lambda: current_multiprocess_run(
+            extract_mel_f0_job, wav_names, args.num_workers, ordered=False, chunk_size=args.chunk_size), n)
+        t_ordered = timeit(f'current, ordered, chunk {args.chunk_size}', lambda: current_multiprocess_run(
+            extract_mel_f0_job, wav_names, args.num_workers, ordered=True, chunk_size=args.chunk_size), n)
+        print(f"| speedup over the previous manager: pickled {t_prev / t_pickle:.2f}x, shared memory {t_prev / t_shm:.2f}x, "
+              f"chunked {t_prev / t_chunk:.2f}x, ordered {t_prev / t_ordered:.2f}x")
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,161 @@
+"""
+Parity and speed of utils/commons/window_utils against the previous per-frame window functions
+(get_win_conds of the NeRF binarizer, get_audio_features of RAD-NeRF, and the inference conditioning that
+stacked get_win_conds over every frame).
+
+    python benchmarks/bench_window_utils.py --num_frames=8000
+
+The parity checks cover zero/edge padding, att_mode 0/1/2, numpy arrays and tensors, and the sequences shorter
+than a window; they raise AssertionError on any mismatch.
+"""
+import argparse
+import time
+import numpy as np
+import torch
+
+from utils.commons.window_utils import get_wins, get_win, gather_wins, get_win_conds, get_att_win
+from data_gen.nerf.trainval_dataset import get_nested_win_conds
+
+
+def previous_get_win_conds(conds, idx, smo_win_size=8, pad_option='zero'):
+    idx = max(0, idx)
+    idx = min(idx, conds.shape[0]-1)
+    smo_half_win_size = smo_win_size//2
+    left_i = idx - smo_half_win_size
+    right_i = idx + (smo_win_size - smo_half_win_size)
+    pad_left, pad_right = 0, 0
+    if left_i < 0:
+        pad_left = -left_i
+        left_i = 0
+    if right_i > conds.shape[0]:
+        pad_right = right_i - conds.shape[0]
+        right_i = conds.shape[0]
+    conds_win = conds[left_i:right_i]
+    if pad_left > 0:
+        if pad_option == 'zero':
+            conds_win = np.concatenate([np.zeros_like(conds_win)[:pad_left], conds_win], axis=0)
+        elif pad_option == 'edge':
+            edge_value = conds[0][np.newaxis, ...]
+            conds_win = np.concatenate([edge_value] * pad_left + [conds_win], axis=0)
+    if pad_right > 0:
+        if pad_option == 'zero':
+            conds_win = np.concatenate([conds_win, np.zeros_like(conds_win)[:pad_right]], axis=0)
+        elif pad_option == 'edge':
+            edge_value = conds[-1][np.newaxis, ...]
+            conds_win = np.concatenate([conds_win] + [edge_value] * pad_right , axis=0)
+    assert conds_win.shape[0] == smo_win_size
+    return conds_win
+
+
+def previous_get_audio_features(features, att_mode, index, smo_win_size):
+    if att_mode == 0:
+        return features[[index]]
+    elif att_mode == 1:
+        left = index - smo_win_size
+        pad_left = 0
+        if left < 0:
+            pad_left = -left
+            left = 0
+        auds = features[left:index]
+        if pad_left > 0:
+            auds = torch.cat([torch.zeros(pad_left, *auds.shape[1:], device=auds.device, dtype=auds.dtype), auds], dim=0)
+        return auds
+    elif att_mode == 2:
+        left = index - smo_win_size//2
+        right = index + (smo_win_size-smo_win_size//2)
+        pad_left = 0
+        pad_right = 0
+        if left < 0:
+            pad_left = -left
+            left = 0
+        if right > features.shape[0]:
+            pad_right = right - features.shape[0]
+            right = features.shape[0]
+        auds = features[left:right]
+        if pad_left > 0:
+            auds = torch.cat([torch.zeros_like(auds[:pad_left]), auds], dim=0)
+        if pad_right > 0:
+            auds = torch.cat([auds, torch.zeros_like(auds[:pad_right])], dim=0)
+        return auds
+
+
+def check_parity():
+    rng = np.random.RandomState(0)
+    for num_frames in [3, 8, 100]:
+        conds = rng.randn(num_frames, 16, 29).astype(np.float32)
+        conds_th = torch.from_numpy(conds)
+        for win_size in [1, 4, 5, 8]:
+            # the previous zero padding broke on the sequences shorter than the padding
+            pad_options = ['zero', 'edge'] if num_frames >= win_size else ['edge']
+            for pad_option in pad_options:
+                wins, wins_th = get_wins(conds, win_size, pad_option=pad_option), get_wins(conds_th, win_size, pad_option=pad_option)
+                gathered = gather_wins(conds, np.arange(num_frames), win_size, pad_option=pad_option)
+                for i in range(-2, num_frames + 2):
+                    expected = previous_get_win_conds(conds, i, win_size, pad_option)
+                    assert np.array_equal(get_win_conds(conds, i, win_size, pad_option), expected), (num_frames, win_size, pad_option, i)
+                    if 0 <= i < num_frames:
+                        assert np.array_equal(wins[i], expected) and np.array_equal(wins_th[i].numpy(), expected)
+                        assert np.array_equal(gathered[i], expected)
+            if num_frames >= win_size:
+                for att_mode in [0, 1, 2]:
+                    for i in range(num_frames):
+                        expected = previous_get_audio_features(conds_th, att_mode, i, win_size)
+                        assert torch.equal(get_att_win(conds_th, att_mode, i, win_size), expected), (num_frames, win_size, att_mode, i)
+                causal = get_wins(conds_th, win_size, left=win_size)
+                for i in range(num_frames):
+                    assert torch.equal(causal[i], previous_get_audio_features(conds_th, 1, i, win_size))
+        # the nested windows of the lm3d conditions, over a shuffled subset of the frames
+        win_idxs = rng.permutation(num_frames)[:max(1, num_frames // 2)]
+        stacked = np.stack([previous_get_win_conds(conds, int(i), 1, 'zero') for i in win_idxs])
+        for i in range(-1, len(win_idxs) + 1):
+            expected = previous_get_win_conds(stacked, i, 5, 'zero') if len(stacked) >= 3 else None
+            if expected is not None:
+                assert np.array_equal(get_nested_win_conds(conds, win_idxs, i, 1, 5), expected), (num_frames, i)
+    print("| parity: ok")
+
+
+def timeit(desc, func, n, repeat=3):
+    t = min(_time(func) for _ in range(repeat))
+    print(f"| {desc:<44s}: {t * 1000:9.2f} ms ({n / t:12.1f} windows/s)")
+    return t
+
+
+def _time(func):
+    t = time.time()
+    func()
+    return time.time() - t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_frames', type=int, default=8000)
+    parser.add_argument('--cond_win_size', type=int, default=1)
+    parser.add_argument('--smo_win_size', type=int, default=5)
+    args = parser.parse_args()
+    check_parity()
+
+    T = args.num_frames
+    lm3d = np.random.randn(T, 204).astype(np.float32)
+    deepspeech = torch.randn(T, 16, 29)
+    cw, sw = args.cond_win_size, args.smo_win_size
+
+    # the lm3d conditioning of the inference: the windows, then the windows of the windows
+    def previous_infer():
+        win = np.stack([previous_get_win_conds(lm3d, i, cw, 'edge') for i in range(T)])
+        return [torch.from_numpy(previous_get_win_conds(win, i, sw, 'edge')) for i in range(T)]
+
+    def current_infer():
+        win = get_wins(torch.from_numpy(lm3d), cw, pad_option='edge').contiguous()
+        wins = get_wins(win, sw, pad_option='edge').contiguous()
+        return [wins[i] for i in range(T)]
+
+    assert all(torch.equal(a, b) for a, b in zip(previous_infer(), current_infer()))
+    t_prev = timeit('previous, inference lm3d windows', previous_infer, T)
+    t_cur = timeit('current, inference lm3d windows', current_infer, T)
+    print(f"| speedup: {t_prev / t_cur:.2f}x")
+
+    # the audio windows of RAD-NeRF (att_mode=2), frame by frame as in the dataset and the renderer
+    t_prev = timeit('previous, get_audio_features per frame', lambda: [previous_get_audio_features(deepspeech, 2, i, 8) for i in range(T)], T)
+    t_cur = timeit('current, get_att_win per frame', lambda: [get_att_win(deepspeech, 2, i, 8) for i in range(T)], T)
+    t_all = timeit('current, get_wins of all frames', lambda: get_wins(deepspeech, 8), T)
+    print(f"| speedup: per frame {t_prev / t_cur:.2f}x, all frames {t_prev / t_all:.2f}x")
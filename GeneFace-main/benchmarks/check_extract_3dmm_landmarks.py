@@ -0,0 +1,29 @@
+"""
+The reuse of the landmark store (ori_imgs/landmarks.npy) by data_gen/nerf/extract_3dmm.py, on a small random store.
+
+    python benchmarks/check_extract_3dmm_landmarks.py
+
+Raises AssertionError on a failure.
+"""
+import tempfile
+import numpy as np
+
+from data_util.frame_store import save_landmarks
+from data_gen.nerf.extract_3dmm import _load_lm68
+
+
+if __name__ == '__main__':
+    num_frames = 10
+    lms = np.random.rand(num_frames, 68, 2).astype(np.float32) * 512
+    valid = np.ones([num_frames], dtype=bool)
+    valid[3] = False
+    with tempfile.TemporaryDirectory() as ori_imgs_dir:
+        assert _load_lm68(ori_imgs_dir, num_frames) is None, 'no landmark store'
+        save_landmarks(ori_imgs_dir, lms, valid)
+        lm68_arr, lm68_valid = _load_lm68(ori_imgs_dir, num_frames)
+        assert np.array_equal(lm68_arr, lms) and np.array_equal(lm68_valid, valid)
+        # the workers detect the invalid frames again and write them in place
+        assert isinstance(lm68_arr, np.ndarray) and not isinstance(lm68_arr, np.memmap) and lm68_arr.flags.writeable
+        lm68_arr[3] = 0
+        assert _load_lm68(ori_imgs_dir, num_frames + 1) is None, 'the number of frames does not match'
+    print("| extract_3dmm landmark store: ok")
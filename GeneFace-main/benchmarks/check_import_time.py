@@ -0,0 +1,108 @@
+"""
+Import-time regression check of the inference and data entry points, with `python -X importtime`.
+
+    python benchmarks/check_import_time.py
+    python benchmarks/check_import_time.py --scale=2   # on a slow machine
+
+Each module is imported in a fresh interpreter, with an argv the hparams parser would reject. The import must not
+parse the command line or set the hparams, must not build Face3DHelper (the BFM .mat load), and
+its cumulative import time must stay under its threshold (seconds, multiplied by --scale). Exits with 1 on a failure.
+"""
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# module: the threshold of the cumulative import time in seconds, most of it is torch and the model code
+ENTRY_POINTS = {
+    'utils.commons.window_utils': 3.,
+    'data_gen.nerf.trainval_dataset': 5.,
+    'data_gen.nerf.binarizer': 8.,
+    'inference.nerfs.lm3d_radnerf_infer': 15.,
+    'inference.nerfs.lm3d_nerf_infer': 15.,
+    'inference.nerfs.adnerf_infer': 15.,
+    'inference.postnet.postnet_infer': 15.,
+    'inference.audio2motion.audio2motion_infer': 15.,
+}
+# the modules that must not import these ones
+FORBIDDEN_IMPORTS = {
+    'inference.nerfs.lm3d_radnerf_infer': ['data_gen.nerf.binarizer'],
+    'inference.nerfs.lm3d_nerf_infer': ['data_gen.nerf.binarizer'],
+    'inference.nerfs.adnerf_infer': ['data_gen.nerf.binarizer'],
+}
+# no Face3DHelper was constructed during the import
+CHECK_CODE = """
+import sys
+import data_util.face3d_helper as face3d_helper_module
+constructed = []
+_init = face3d_helper_module.Face3DHelper.__init__
+def _init_wrapper(self, *args, **kwargs):
+    constructed.append(1)
+    _init(self, *args, **kwargs)
+face3d_helper_module.Face3DHelper.__init__ = _init_wrapper
+import {module}
+assert len(constructed) == 0, 'Face3DHelper is constructed at import time'
+"""
+
+
+def run_python(code):
+    # --config of a missing file makes set_hparams() fail, so parsing the command line at import time is an error
+    cmd = [sys.executable, '-X', 'importtime', '-c', code, '--config=__no_such_config__.yaml']
+    ret = subprocess.run(cmd, cwd=ROOT_DIR, capture_output=True, text=True, env={**os.environ, 'PYTHONPATH': ROOT_DIR})
+    if ret.returncode != 0:
+        raise RuntimeError(f"importing failed:\n{ret.stderr[-3000:]}")
+    return ret
+
+
+def import_time(module):
+    """
+    :return: (the cumulative import time of module in seconds, the imported modules, stdout)
+    """
+    ret = run_python(f'import {module}')
+    cumulative, imported = None, set()
+    for line in ret.stderr.splitlines():
+        m = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)', line)
+        if m is None:
+            continue
+        imported.add(m.group(4))
+        if m.group(4) == module:
+            cumulative = int(m.group(2)) / 1e6
+    # in another interpreter, since the wrapper imports face3d_helper (and torch) before the module
+    run_python(CHECK_CODE.format(module=module))
+    return cumulative, imported, ret.stdout
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=float, default=1., help='multiply the thresholds')
+    parser.add_argument('--modules', type=str, default='', help='check these modules only, comma-separated')
+    args = parser.parse_args()
+
+    modules = [m for m in args.modules.split(",") if m != ''] or list(ENTRY_POINTS.keys())
+    failed = []
+    for module in modules:
+        threshold = ENTRY_POINTS.get(module, 15.) * args.scale
+        try:
+            t, imported, stdout = import_time(module)
+        except RuntimeError as e:
+            print(f"| {module:<44s}: FAIL, {e}")
+            failed.append(module)
+            continue
+        errors = []
+        if t is None or t > threshold:
+            errors.append(f"took {t}s, over the threshold of {threshold:.1f}s")
+        if '| Hparams' in stdout or '| Unknow hparams' in stdout:
+            errors.append("sets the hparams at import time")
+        for forbidden in FORBIDDEN_IMPORTS.get(module, []):
+            if forbidden in imported:
+                errors.append(f"imports {forbidden}")
+        t_str = '-' if t is None else f'{t:.2f}s'
+        print(f"| {module:<44s}: {t_str:>7s} / {threshold:.1f}s {'OK' if len(errors) == 0 else 'FAIL: ' + '; '.join(errors)}")
+        if len(errors) > 0:
+            failed.append(module)
+    if len(failed) > 0:
+        print(f"| {len(failed)} entry points failed: {failed}")
+        sys.exit(1)
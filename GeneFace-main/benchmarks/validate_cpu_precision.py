@@ -0,0 +1,100 @@
+"""
+Validation of the reduced-precision CPU inference against fp32.
+
+    # postnet (and the audio2motion inside), reports the lm3d error and the speedup
+    python benchmarks/validate_cpu_precision.py --mode=postnet --precision=int8 \
+        --config=checkpoints/May/postnet/config.yaml --hparams=infer_audio_source_name=data/raw/val_wavs/zozo.wav
+    # RAD-NeRF, reports the PSNR of the rendered frames and the speedup
+    python benchmarks/validate_cpu_precision.py --mode=nerf --precision=bf16 \
+        --config=checkpoints/May/lm3d_radnerf/config.yaml --hparams=infer_cond_name=infer_out/May/pred_lm3d/zozo.npy
+
+The precision policy is the same as the inference scripts use, i.e., the `infer_cpu_precision`
+(fp32 | bf16) and `infer_cpu_int8` hparams, see utils/nn/precision_utils.py.
+"""
+import argparse
+import copy
+import glob
+import os
+import time
+import cv2
+import numpy as np
+
+from utils.commons.hparams import hparams, set_hparams
+
+
+def psnr(img, ref):
+    mse = np.mean((img.astype(np.float64) - ref.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(255. ** 2 / mse)
+
+
+def set_precision(precision):
+    hparams['infer_cpu_precision'] = 'bf16' if precision == 'bf16' else 'fp32'
+    hparams['infer_cpu_int8'] = precision == 'int8'
+
+
+def validate_postnet(precision, out_dir):
+    from inference.postnet.postnet_infer import PostnetInfer
+    results = {}
+    for prec in ['fp32', precision]:
+        set_precision(prec)
+        infer_ins = PostnetInfer(hparams, device='cpu')
+        inp = {
+            'audio_source_name': hparams.get('infer_audio_source_name', '') or 'data/raw/val_wavs/zozo.wav',
+            'out_npy_name': os.path.join(out_dir, f'lm3d_{prec}.npy'),
+        }
+        samples = infer_ins.get_cond_from_input(inp)
+        t = time.time()
+        infer_ins.forward_system(samples, inp)
+        results[prec] = {'time': time.time() - t, 'lm3d': np.load(inp['out_npy_name'])}
+    ref = results['fp32']['lm3d'].reshape([-1, 68, 3])
+    pred = results[precision]['lm3d'].reshape([-1, 68, 3])
+    err = np.linalg.norm(pred - ref, axis=-1)  # [T, 68]
+    print(f"| lm3d error vs fp32: mean {err.mean():.6f}, max {err.max():.6f}, "
+          f"ref scale {np.abs(ref).mean():.6f}")
+    return results
+
+
+def validate_nerf(precision, out_dir, num_frames=50):
+    from inference.nerfs.lm3d_radnerf_infer import LM3d_RADNeRFInfer
+    if precision == 'int8':
+        raise ValueError("int8 quantization only applies to the postnet/audio2motion, use --precision=bf16 for nerf")
+    infer_ins = LM3d_RADNeRFInfer(hparams, device='cpu')
+    inp = {
+        'audio_source_name': hparams.get('infer_audio_source_name', '') or 'data/raw/val_wavs/zozo.wav',
+        'cond_name': hparams['infer_cond_name'],
+    }
+    infer_ins.inp = inp
+    infer_ins.use_pred_pose = False
+    samples = infer_ins.get_cond_from_input(inp)
+    batches = infer_ins.get_pose_from_ds(samples)[:num_frames]
+    results = {}
+    for prec in ['fp32', precision]:
+        infer_ins.infer_cpu_precision = prec
+        inp['tmp_imgs_dir'] = os.path.join(out_dir, f'imgs_{prec}')
+        t = time.time()
+        infer_ins.forward_system(copy.deepcopy(batches))
+        results[prec] = {'time': time.time() - t}
+    ref_names = sorted(glob.glob(os.path.join(out_dir, 'imgs_fp32', '*.png')))
+    psnrs = [psnr(cv2.imread(name.replace('imgs_fp32', f'imgs_{precision}')), cv2.imread(name)) for name in ref_names]
+    print(f"| frame PSNR vs fp32: mean {np.mean(psnrs):.2f} dB, min {np.min(psnrs):.2f} dB, over {len(psnrs)} frames")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', type=str, default='postnet', choices=['postnet', 'nerf'])
+    parser.add_argument('--precision', type=str, default='bf16', choices=['bf16', 'int8'])
+    parser.add_argument('--num_frames', type=int, default=50, help='number of frames rendered in nerf mode')
+    parser.add_argument('--out_dir', type=str, default='infer_out/validate_cpu_precision')
+    args, _ = parser.parse_known_args()
+    set_hparams()
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    if args.mode == 'postnet':
+        results = validate_postnet(args.precision, args.out_dir)
+    else:
+        results = validate_nerf(args.precision, args.out_dir, args.num_frames)
+    t_fp32, t_prec = results['fp32']['time'], results[args.precision]['time']
+    print(f"| fp32: {t_fp32:.3f}s, {args.precision}: {t_prec:.3f}s, speedup {t_fp32 / t_prec:.2f}x")
@@ -0,0 +1,18 @@
+"""
+One-time conversion of the per-frame ori_imgs/{idx}.lms text files of a processed video into the landmark store
+(ori_imgs/landmarks.npy and ori_imgs/landmarks_valid.npy, see data_util/frame_store.py).
+
+    python convert_lms_to_npy.py --video_id=May
+"""
+import argparse
+import os
+
+from data_util.frame_store import convert_lms_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video_id', type=str, default='May')
+    parser.add_argument('--processed_dir', type=str, default='data/processed/videos')
+    args = parser.parse_args()
+    convert_lms_dir(os.path.join(args.processed_dir, args.video_id, 'ori_imgs'))
@@ -1,6 +1,7 @@
 import numpy as np
 import os
-import glob
+
+from data_util.frame_store import get_frame_store, save_landmarks
 
 video_id = 'chat_response'
 processed_dir = f'data/processed/videos/{video_id}'
@@ -13,15 +14,18 @@ lm68_arr = data['lm68'] # [N, 68, 2]
 
 print(f"Found {len(lm68_arr)} frames of landmarks.")
 
-image_paths = sorted(glob.glob(os.path.join(ori_imgs_dir, '*.jpg')), key=lambda x: int(os.path.basename(x)[:-4]))
-print(f"Found {len(image_paths)} images.")
+store = get_frame_store(ori_imgs_dir)
+num_frames = len(store) if store is not None else len(lm68_arr)
+print(f"Found {num_frames} frames.")
 
-if len(image_paths) != len(lm68_arr):
-    print(f"Warning: Mismatch in frames. Images: {len(image_paths)}, Landmarks: {len(lm68_arr)}")
+if num_frames != len(lm68_arr):
+    print(f"Warning: Mismatch in frames. Frames: {num_frames}, Landmarks: {len(lm68_arr)}")
 
-for i, image_path in enumerate(image_paths):
-    if i >= len(lm68_arr): break
-    lms = lm68_arr[i]
-    np.savetxt(image_path.replace('.jpg', '.lms'), lms, '%f')
+lms = np.zeros([num_frames, 68, 2], dtype=np.float32)
+valid = np.zeros([num_frames], dtype=bool)
+n = min(num_frames, len(lm68_arr))
+lms[:n] = lm68_arr[:n]
+valid[:n] = True
+save_landmarks(ori_imgs_dir, lms, valid)
 
-print("Converted npy landmarks to .lms files.")
+print("Converted npy landmarks to the landmark store (ori_imgs/landmarks.npy).")
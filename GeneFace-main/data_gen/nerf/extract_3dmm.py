@@ -7,20 +7,39 @@ import argparse
 from tqdm import tqdm, trange
 import torch
 import face_alignment
+
+# the repo root, the worker processes re-import this file without PYTHONPATH
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
 import deep_3drecon
 from moviepy.editor import VideoFileClip
 import copy
-import psutil
+import collections
+import multiprocessing
 
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from data_util.frame_store import get_frame_store, load_landmarks, LANDMARKS_NPY
+from deep_3drecon.reconstructor import align_frame
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
-try:
-    fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, network_size=4, device=device)
-except AttributeError:
-    fa = face_alignment.FaceAlignment(face_alignment.LandmarksType.TWO_D, network_size=4, device=device)
+# the models are built lazily, the worker processes only need the face alignment when the landmarks are missing
+_fa = None
+_face_reconstructor = None
+
+
+def get_face_alignment():
+    global _fa
+    if _fa is None:
+        try:
+            _fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, network_size=4, device=device)
+        except AttributeError:
+            _fa = face_alignment.FaceAlignment(face_alignment.LandmarksType.TWO_D, network_size=4, device=device)
+    return _fa
 
-face_reconstructor = deep_3drecon.Reconstructor()
+
+def get_face_reconstructor():
+    global _face_reconstructor
+    if _face_reconstructor is None:
+        _face_reconstructor = deep_3drecon.Reconstructor()
+    return _face_reconstructor
 
 # landmark detection in Deep3DRecon
 def lm68_2_lm5(in_lm):
@@ -32,7 +51,86 @@ def lm68_2_lm5(in_lm):
     lm = lm[[1,2,0,3,4],:2]
     return lm
 
-def process_video(fname, out_name=None, skip_tmp=True):
+
+def _load_lm68(ori_imgs_dir, num_frames):
+    """
+    the landmarks of data_util/process.extract_landmarks, None if they are missing or do not match the frames
+    return: lm68 [T, 68, 2] float32, valid [T] bool
+    """
+    if not os.path.exists(os.path.join(ori_imgs_dir, LANDMARKS_NPY)):
+        return None
+    lm68_arr, valid = load_landmarks(ori_imgs_dir, mmap=False)
+    if len(lm68_arr) != num_frames:
+        print(f"WARNING: the landmarks of {ori_imgs_dir} have {len(lm68_arr)} frames but the video has {num_frames}, detect the landmarks again.")
+        return None
+    return lm68_arr, valid
+
+
+def read_video_chunks(fname, chunk_size):
+    # yields (start, end, rgb frames), only one chunk of the video is in memory
+    cap = cv2.VideoCapture(fname)
+    start = 0
+    while True:
+        frames = []
+        while len(frames) < chunk_size:
+            ret, frame_bgr = cap.read()
+            if frame_bgr is None:
+                break
+            frames.append(cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB))
+        if len(frames) == 0:
+            break
+        yield start, start + len(frames), np.stack(frames)
+        start += len(frames)
+    cap.release()
+
+
+_worker = {}
+
+
+def _init_align_worker(frame_store_dir, lm3d_std, num_threads=1):
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+    _worker['frame_store_dir'] = frame_store_dir
+    _worker['lm3d_std'] = lm3d_std
+
+
+def _align_chunk(fname, start, end, frames, lm68_arr, valid):
+    """
+    the landmarks (only the frames without valid landmarks) and the alignment of the frames [start, end)
+    frames: [n, H, W, 3] rgb, None to read them from the frame store
+    return: start, lm68 [n, 68, 2], lm5 [n, 5, 2], aligned images [n, 224, 224, 3] uint8, aligned lm5 [n, 5, 2]
+    """
+    if frames is None:
+        frames = np.ascontiguousarray(get_frame_store(_worker['frame_store_dir'])[start:end][..., ::-1])
+    n = end - start
+    if lm68_arr is None:
+        lm68_arr, valid = np.empty((n, 68, 2), dtype=np.float32), np.zeros([n], dtype=bool)
+    lm5_arr = np.empty((n, 5, 2), dtype=np.float32)
+    align_imgs, align_lms = [], []
+    for i in range(n):
+        if not valid[i]:
+            try:
+                lm68_arr[i] = get_face_alignment().get_landmarks(frames[i])[0] # 识别图片中的人脸，获得角点, shape=[68,2]
+            except:
+                print(f"WARNING: Caught errors when fa.get_landmarks, maybe No face detected at frame {start + i} in {fname}!")
+                raise ValueError("")
+        lm5_arr[i] = lm68_2_lm5(lm68_arr[i])
+        # NOTE: align_frame flips lm5_arr[i] in place, which is saved as before
+        align_img, align_lm = align_frame(frames[i], lm5_arr[i], _worker['lm3d_std'])
+        align_imgs.append(align_img)
+        align_lms.append(align_lm)
+    return start, lm68_arr, lm5_arr, np.stack(align_imgs), np.stack(align_lms)
+
+
+def process_video(fname, out_name=None, skip_tmp=True, frame_store_dir=None, chunk_size=64, batch_size=32, num_workers=4):
+    """
+    a streaming pipeline: the frames are decoded chunk by chunk, the landmarks and the alignment of the chunks run
+    in a worker pool, and the reconstructor consumes batches of the aligned frames as they come. At most
+    2 * num_workers chunks are in flight, so the memory is bounded by the chunk size instead of the video length.
+    frame_store_dir: reuse the frames decoded by data_util/process.py (ori_imgs/frames.npy) instead of decoding fname again,
+        and the landmarks of extract_landmarks (ori_imgs/landmarks.npy), only the frames without a face are detected again
+    num_workers: 0 to run the landmarks and the alignment in this process
+    """
     assert fname.endswith(".mp4")
     if out_name is None:
         out_name = fname[:-4] + '.npy'
@@ -44,56 +142,75 @@ def process_video(fname, out_name=None, skip_tmp=True):
     #     print("out exisit, skip")
     #     return
     os.system(f"touch {tmp_name}")
-    cap = cv2.VideoCapture(fname)
-    print(f"loading video ...")
-    # 获取视频相关参数
-    num_frames = int(cap.get(7))
-    h = int(cap.get(4))
-    w = int(cap.get(3))
-    # 检测系统资源是否充足
-    mem = psutil.virtual_memory()
-    a_mem = mem.available
-    min_mem=num_frames*68*2 + num_frames*5*2 + num_frames*h*w*3
-    if a_mem < min_mem:
-        print(f"WARNING: The physical memory is insufficient, which may result in memory swapping. Available Memory: {a_mem/1000000:.3f}M, the minimum memory required is:{min_mem/1000000:.3f}M.")
-    # 初始化矩阵
-    lm68_arr=np.empty((num_frames, 68, 2),dtype=np.float32)
-    lm5_arr=np.empty((num_frames, 5, 2),dtype=np.float32)
-    video_rgb=np.empty((num_frames, h, w, 3),dtype=np.uint8)
-    cnt=0
-    while cap.isOpened():
-        ret, frame_bgr = cap.read()
-        if frame_bgr is None:
-            break
-        frame_rgb = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
-        video_rgb[cnt]=frame_rgb
-        cnt += 1
-    for i in trange(num_frames, desc="extracting 2D facial landmarks ..."):
-        try:
-            lm68 = fa.get_landmarks(video_rgb[i])[0] # 识别图片中的人脸，获得角点, shape=[68,2]
-        except:
-            print(f"WARNING: Caught errors when fa.get_landmarks, maybe No face detected at frame {i} in {fname}!")
-            raise ValueError("")
-        lm5 = lm68_2_lm5(lm68)
-        lm68_arr[i]=lm68
-        lm5_arr[i]=lm5
-    # num_frames = cnt
-    batch_size = 32
-    iter_times = num_frames // batch_size
-    last_bs = num_frames % batch_size
-    coeff_lst = []
-    for i_iter in trange(iter_times, desc="start extracting 3DMM..."):
-        start_idx = i_iter * batch_size
-        batched_images = video_rgb[start_idx: start_idx + batch_size]
-        batched_lm5 = lm5_arr[start_idx: start_idx + batch_size]
-        coeff, align_img = face_reconstructor.recon_coeff(batched_images, batched_lm5, return_image = True)
-        coeff_lst.append(coeff)
-    if last_bs != 0:
-        batched_images = video_rgb[-last_bs:]
-        batched_lm5 = lm5_arr[-last_bs:]
-        coeff, align_img = face_reconstructor.recon_coeff(batched_images, batched_lm5, return_image = True)
-        coeff_lst.append(coeff)
+    store = get_frame_store(frame_store_dir) if frame_store_dir is not None else None
+    landmarks = None
+    if store is not None:
+        # the workers read the frames from the memmap, only the frame indices are sent to them
+        num_frames = len(store)
+        landmarks = _load_lm68(frame_store_dir, num_frames)
+        chunks = ((start, min(start + chunk_size, num_frames), None) for start in range(0, num_frames, chunk_size))
+    else:
+        num_frames = int(cv2.VideoCapture(fname).get(cv2.CAP_PROP_FRAME_COUNT)) # only for the progress bar
+        chunks = read_video_chunks(fname, chunk_size)
+    if landmarks is not None:
+        print(f"reuse the 2D facial landmarks in {frame_store_dir}, {int((~landmarks[1]).sum())} frames to detect")
+
+    face_reconstructor = get_face_reconstructor()
+    lm3d_std = face_reconstructor.lm3d_std
+    lm68_lst, lm5_lst, coeff_lst = [], [], []
+    align_imgs_buf, align_lms_buf = [], []
+
+    def recon_batches(flush=False):
+        # feed batches of batch_size to the reconstructor, the remainder waits for the next chunk
+        align_imgs, align_lms = np.concatenate(align_imgs_buf), np.concatenate(align_lms_buf)
+        align_imgs_buf.clear(), align_lms_buf.clear()
+        num_batched = len(align_imgs) if flush else len(align_imgs) // batch_size * batch_size
+        for start_idx in range(0, num_batched, batch_size):
+            end_idx = min(start_idx + batch_size, num_batched)
+            coeff_lst.append(face_reconstructor.recon_coeff_aligned(align_imgs[start_idx: end_idx], align_lms[start_idx: end_idx]))
+        if num_batched < len(align_imgs):
+            align_imgs_buf.append(align_imgs[num_batched:])
+            align_lms_buf.append(align_lms[num_batched:])
+
+    def consume(result):
+        _, lm68_arr, lm5_arr, align_imgs, align_lms = result
+        lm68_lst.append(lm68_arr)
+        lm5_lst.append(lm5_arr)
+        align_imgs_buf.append(align_imgs)
+        align_lms_buf.append(align_lms)
+        recon_batches()
+        pbar.update(len(lm68_arr))
+
+    def chunk_args(chunk):
+        start, end, frames = chunk
+        if landmarks is None:
+            return fname, start, end, frames, None, None
+        return fname, start, end, frames, landmarks[0][start:end].copy(), landmarks[1][start:end]
+
+    pbar = tqdm(total=num_frames, desc="extracting 3DMM ...")
+    if num_workers == 0:
+        _init_align_worker(frame_store_dir, lm3d_std, num_threads=torch.get_num_threads())
+        for chunk in chunks:
+            consume(_align_chunk(*chunk_args(chunk)))
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(num_workers, initializer=_init_align_worker, initargs=(frame_store_dir, lm3d_std)) as pool:
+            # the chunks are consumed in order while the workers prepare the next ones
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_align_chunk, chunk_args(chunk)))
+                if len(pending) >= 2 * num_workers:
+                    consume(pending.popleft().get())
+            while len(pending) > 0:
+                consume(pending.popleft().get())
+    if len(align_imgs_buf) > 0:
+        recon_batches(flush=True)
+    pbar.close()
+
+    lm68_arr = np.concatenate(lm68_lst, axis=0)
+    lm5_arr = np.concatenate(lm5_lst, axis=0)
     coeff_arr = np.concatenate(coeff_lst,axis=0)
+    cnt = len(lm68_arr)
     result_dict = {
         'coeff': coeff_arr.reshape([cnt, -1]),
         'lm68': lm68_arr,
@@ -123,5 +240,6 @@ if __name__ == '__main__':
     video_id = args.video_id
     video_fname = f"data/raw/videos/{video_id}.mp4"
     out_fname = f"data/processed/videos/{video_id}/vid_coeff.npy"
-    process_video(video_fname, out_fname, skip_tmp=False)
+    frame_store_dir = f"data/processed/videos/{video_id}/ori_imgs"
+    process_video(video_fname, out_fname, skip_tmp=False, frame_store_dir=frame_store_dir)
     print(f"3DMM coeff extracted at {out_fname}")
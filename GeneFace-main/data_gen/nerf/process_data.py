@@ -0,0 +1,356 @@
+"""
+Preprocessing runner of the target person video, which replaces the task list of process_data.sh.
+
+    python data_gen/nerf/process_data.py --video_id=May --num_workers=2
+
+Each step declares the files (or glob patterns) it reads and writes, and the dependencies are
+derived from them. Independent steps run concurrently in a pool of `num_workers` processes.
+A step is skipped when the content hash of its inputs (and its version) matches the record in
+data/processed/videos/<video_id>/process_manifest.json and all its outputs exist, so a failed binarization does not
+rerun the landmark or parsing steps. The outputs may be edited afterwards (e.g., an inpainted bc.jpg, or the image caches
+added to trainval/meta.json by the training), only the steps reading them are rerun; pass --force to regenerate them.
+The manifest also records the timing of each step.
+Only the audio features required by the target configs of the video are extracted (resolve_audio_features).
+"""
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from data_util import process
+from utils.commons.hparams import set_hparams
+
+
+class Step:
+    def __init__(self, name, func, args=(), inputs=(), outputs=(), version='1'):
+        """
+        :param func: a module-level function, so that it can be sent to the worker processes; it must raise
+            on a failure (e.g., subprocess.run(..., check=True)), the step is only recorded in the manifest if it returns
+        :param inputs/outputs: file names or glob patterns
+        :param version: bump it when the implementation of the step changes, to invalidate its outputs
+        """
+        self.name = name
+        self.func = func
+        self.args = args
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.version = version
+        self.deps = []
+
+
+##############
+# steps
+##############
+def run_extract_hubert_mel_f0(video_id):
+    from data_gen.nerf.extract_hubert_mel_f0 import extract_hubert_mel_f0
+    extract_hubert_mel_f0(video_id)
+
+
+def run_extract_3dmm(video_path, out_fname, frame_store_dir):
+    from data_gen.nerf.extract_3dmm import process_video
+    process_video(video_path, out_fname, skip_tmp=False, frame_store_dir=frame_store_dir)
+
+
+def run_binarizer(config):
+    from data_gen.nerf.binarizer import Binarizer
+    hparams_ = set_hparams(config=config, print_hparams=False, global_hparams=False)
+    Binarizer(hparams_).parse(hparams_['video_id'])
+
+
+##############
+# audio features
+##############
+# the audio feature families and the files of their extractors
+AUDIO_FEATURES = {
+    'esperanto': ['aud_esperanto.npy'],
+    'deepspeech': ['aud_deepspeech.npy'],
+    'hubert_mel_f0': ['aud_hubert.npy', 'aud_mel_f0.npy'],
+}
+# the configs trained on the processed video by default, the ones that exist are used
+DEFAULT_TARGET_CONFIGS = ['lm3d_radnerf.yaml', 'lm3d_radnerf_torso.yaml', 'lm3d_postnet_sync.yaml']
+
+
+def get_target_configs(video_id):
+    config_dir = f"egs/datasets/videos/{video_id}"
+    return [os.path.join(config_dir, c) for c in DEFAULT_TARGET_CONFIGS if os.path.exists(os.path.join(config_dir, c))]
+
+
+def resolve_audio_features(configs):
+    """
+    the audio feature families required by the configs: the cond_type of the NeRFs (idexp_lm3d_normalized needs
+    none of them, the 3DMM is always extracted), the deepspeech windows of the lm3d_nerf torso, and the
+    HuBERT, mel and F0 read from the binarized dataset by the postnet and the syncnet
+    """
+    features = set()
+    for config in configs:
+        config_hparams = set_hparams(config=config, print_hparams=False, global_hparams=False)
+        cond_type = config_hparams.get('cond_type', '')
+        task_cls = config_hparams.get('task_cls', '')
+        if cond_type in ['esperanto', 'deepspeech']:
+            features.add(cond_type)
+        if 'lm3d_nerf_torso' in task_cls:
+            features.add('deepspeech')
+        if 'postnet' in task_cls or 'syncnet' in task_cls:
+            features.add('hubert_mel_f0')
+    return [feature for feature in AUDIO_FEATURES if feature in features]
+
+
+def get_steps(video_id, export_jpg=False, audio_features=tuple(AUDIO_FEATURES)):
+    video_path = f"data/raw/videos/{video_id}.mp4"
+    processed_dir = f"data/processed/videos/{video_id}"
+    binary_dir = f"data/binary/videos/{video_id}"
+    config = f"egs/datasets/videos/{video_id}/lm3d_radnerf.yaml"
+    wav_path = os.path.join(processed_dir, 'aud.wav')
+    ori_imgs_dir = os.path.join(processed_dir, 'ori_imgs')
+    parsing_dir = os.path.join(processed_dir, 'parsing')
+    for d in ['ori_imgs', 'parsing', 'head_imgs', 'gt_imgs', 'torso_imgs']:
+        os.makedirs(os.path.join(processed_dir, d), exist_ok=True)
+
+    p = lambda *names: [os.path.join(processed_dir, name) for name in names]
+    # the frame store of data_util/frame_store.py, the jpgs are only exported for debugging
+    frames, lmss = p('ori_imgs/frames.npy', 'ori_imgs/frames.json'), p('ori_imgs/landmarks.npy', 'ori_imgs/landmarks_valid.npy')
+    # the parsing labels, the colored parsing maps are only exported with export_jpg
+    parsings = p('parsing/labels.npy', 'parsing/labels.json')
+    steps = [
+        Step('extract_audio', process.extract_audio, (video_path, wav_path),
+             inputs=[video_path], outputs=p('aud.wav')),
+    ] + [
+        # only the audio features required by the target configs, see resolve_audio_features
+        Step(f'extract_{feature}', func, args, inputs=p('aud.wav'), outputs=p(*AUDIO_FEATURES[feature]))
+        for feature, func, args in [
+            ('esperanto', process.extract_esperanto, (wav_path,)),
+            ('deepspeech', process.extract_deepspeech, (wav_path,)),
+            ('hubert_mel_f0', run_extract_hubert_mel_f0, (video_id,)),
+        ] if feature in audio_features
+    ] + [
+        Step('extract_frames', process.extract_frame_store, (video_path, ori_imgs_dir, 25, export_jpg),
+             inputs=[video_path], outputs=frames),
+        Step('extract_landmarks', process.extract_landmarks, (ori_imgs_dir,),
+             inputs=frames, outputs=lmss, version='3'),
+        Step('extract_semantics', process.extract_semantics, (ori_imgs_dir, parsing_dir, 8, 4, export_jpg),
+             inputs=frames, outputs=parsings, version='2'),
+        Step('face_tracking', process.face_tracking, (video_id, ori_imgs_dir),
+             inputs=frames + lmss, outputs=p('track_params.pt')),
+        Step('extract_background', process.extract_background, (processed_dir, ori_imgs_dir),
+             inputs=frames + parsings, outputs=p('bc.jpg'), version='2'),
+        Step('extract_head_torso_gt', process.extract_head_torso_and_gt, (processed_dir, ori_imgs_dir),
+             inputs=frames + parsings + p('bc.jpg'),
+             outputs=p('head_imgs/*.jpg', 'gt_imgs/*.jpg', 'torso_imgs/*.png')),
+        Step('save_transforms', process.save_transforms, (processed_dir, ori_imgs_dir),
+             inputs=frames + lmss + p('track_params.pt'), outputs=p('transforms_train.json', 'transforms_val.json')),
+        Step('extract_3dmm', run_extract_3dmm, (video_path, os.path.join(processed_dir, 'vid_coeff.npy'), ori_imgs_dir),
+             inputs=frames + lmss, outputs=p('vid_coeff.npy'), version='2'),
+        Step('binarize', run_binarizer, (config,),
+             inputs=[config] + lmss + p('bc.jpg', 'track_params.pt', 'transforms_train.json', 'transforms_val.json', 'vid_coeff.npy',
+                'head_imgs/*.jpg', 'gt_imgs/*.jpg', 'torso_imgs/*.png') + parsings
+                + p(*[fname for feature in audio_features for fname in AUDIO_FEATURES[feature]]),
+             outputs=[os.path.join(binary_dir, 'trainval', 'meta.json')], version='2'),
+    ]
+    producers = {out: step for step in steps for out in step.outputs}
+    for step in steps:
+        step.deps = sorted(set(producers[inp].name for inp in step.inputs if inp in producers))
+    return steps
+
+
+##############
+# fingerprints
+##############
+class Fingerprinter:
+    """
+    content hash of files and glob patterns, the digest of each file is cached by (size, mtime),
+    so only the modified files are read again.
+    """
+    def __init__(self, file_hashes=None):
+        self.file_hashes = file_hashes if file_hashes is not None else {}
+
+    def hash_file(self, fname):
+        stat = os.stat(fname)
+        cached = self.file_hashes.get(fname)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        h = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self.file_hashes[fname] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def hash_patterns(self, patterns):
+        """
+        :return: the digest of all matched files, None if any pattern matches nothing
+        """
+        h = hashlib.sha1()
+        for pattern in patterns:
+            fnames = sorted(glob.glob(pattern))
+            if len(fnames) == 0:
+                return None
+            for fname in fnames:
+                h.update(fname.encode())
+                h.update(self.hash_file(fname).encode())
+        return h.hexdigest()
+
+    def hash_step_inputs(self, step):
+        inputs_hash = self.hash_patterns(step.inputs)
+        if inputs_hash is None:
+            return None
+        return hashlib.sha1(f"{step.version}|{step.args}|{inputs_hash}".encode()).hexdigest()
+
+
+def load_manifest(manifest_name):
+    if os.path.exists(manifest_name):
+        with open(manifest_name) as f:
+            return json.load(f)
+    return {'steps': {}, 'file_hashes': {}}
+
+
+def save_manifest(manifest, manifest_name):
+    tmp_name = manifest_name + '.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_name, manifest_name)
+
+
+def clean_outputs(step):
+    # a stale step starts from scratch, e.g., ffmpeg would otherwise ask before overwriting
+    for pattern in step.outputs:
+        for fname in glob.glob(pattern):
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+
+##############
+# scheduler
+##############
+def run_steps(video_id, num_workers=2, force=(), export_jpg=False, audio_features=None):
+    """
+    audio_features: the audio feature families to extract, None to resolve them from the target configs
+    """
+    if audio_features is None:
+        target_configs = get_target_configs(video_id)
+        audio_features = resolve_audio_features(target_configs)
+        print(f"| audio features required by {target_configs}: {audio_features}")
+    steps = get_steps(video_id, export_jpg, audio_features)
+    name2step = {step.name: step for step in steps}
+    for name in force:
+        assert name == 'all' or name in name2step, f"Unknown step: {name}, choose from {list(name2step.keys())}"
+    manifest_name = f"data/processed/videos/{video_id}/process_manifest.json"
+    manifest = load_manifest(manifest_name)
+    fingerprinter = Fingerprinter(manifest['file_hashes'])
+    manifest['file_hashes'] = fingerprinter.file_hashes
+    timings = {}
+    status = {} # name: done | skipped | failed | blocked
+    running = {} # future: (step, inputs_hash, start_time)
+
+    def is_up_to_date(step, inputs_hash):
+        record = manifest['steps'].get(step.name)
+        if record is None or 'all' in force or step.name in force or inputs_hash is None:
+            return False
+        # the changes of the outputs themselves do not rerun the step, so the manual edits are kept
+        return record['inputs_hash'] == inputs_hash and all(len(glob.glob(o)) > 0 for o in step.outputs)
+
+    t_start = time.time()
+    ctx = multiprocessing.get_context('spawn') # the steps may use CUDA
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx) as pool:
+        while len(status) < len(steps):
+            for step in steps:
+                if step.name in status or any(fut_step.name == step.name for fut_step, _, _ in running.values()):
+                    continue
+                dep_status = [status.get(dep) for dep in step.deps]
+                if any(s in ['failed', 'blocked'] for s in dep_status):
+                    status[step.name] = 'blocked'
+                    print(f"| [{step.name}] blocked by failed dependencies.")
+                    continue
+                if not all(s in ['done', 'skipped'] for s in dep_status):
+                    continue
+                inputs_hash = fingerprinter.hash_step_inputs(step)
+                if is_up_to_date(step, inputs_hash):
+                    status[step.name] = 'skipped'
+                    timings[step.name] = {'status': 'skipped', 'time': 0.}
+                    print(f"| [{step.name}] is up-to-date, skipped.")
+                    continue
+                if len(running) >= num_workers:
+                    continue
+                clean_outputs(step)
+                print(f"| [{step.name}] started.")
+                future = pool.submit(step.func, *step.args)
+                running[future] = (step, inputs_hash, time.time())
+            if len(running) == 0:
+                continue
+            finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in finished:
+                step, inputs_hash, t = running.pop(future)
+                elapsed = time.time() - t
+                try:
+                    future.result()
+                    outputs_hash = fingerprinter.hash_patterns(step.outputs)
+                    if outputs_hash is None:
+                        raise RuntimeError(f"missing outputs: {[o for o in step.outputs if len(glob.glob(o)) == 0]}")
+                    if inputs_hash is None:
+                        inputs_hash = fingerprinter.hash_step_inputs(step)
+                    manifest['steps'][step.name] = {
+                        'inputs_hash': inputs_hash,
+                        'outputs_hash': outputs_hash,
+                        'time': elapsed,
+                        'finished_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    }
+                    status[step.name] = 'done'
+                    timings[step.name] = {'status': 'done', 'time': elapsed}
+                    print(f"| [{step.name}] done in {elapsed:.1f}s.")
+                except Exception as e:
+                    manifest['steps'].pop(step.name, None)
+                    status[step.name] = 'failed'
+                    timings[step.name] = {'status': 'failed', 'time': elapsed, 'error': repr(e)}
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                    print(f"| [{step.name}] failed after {elapsed:.1f}s.")
+                save_manifest(manifest, manifest_name)
+
+    manifest['last_run'] = {
+        'started_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t_start)),
+        'total_time': time.time() - t_start,
+        'num_workers': num_workers,
+        'steps': {step.name: timings.get(step.name, {'status': status[step.name]}) for step in steps},
+        'audio_features': list(audio_features),
+    }
+    save_manifest(manifest, manifest_name)
+    print(f"| Preprocessing of {video_id} finished in {time.time() - t_start:.1f}s, manifest saved at {manifest_name}")
+    for step in steps:
+        print(f"|   {step.name}: {status[step.name]}")
+    print(f"| Audio feature extractors (required: {list(audio_features)}):")
+    for feature in AUDIO_FEATURES:
+        timing = timings.get(f'extract_{feature}')
+        if timing is None:
+            print(f"|   {feature}: not required")
+        else:
+            print(f"|   {feature}: {timing['status']}, {timing['time']:.1f}s")
+    return all(s in ['done', 'skipped'] for s in status.values())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video_id', type=str, default='May', help="data/raw/videos/<video_id>.mp4")
+    parser.add_argument('--num_workers', type=int, default=2, help="number of steps running concurrently")
+    parser.add_argument('--export_jpg', action='store_true', help="also export ori_imgs/{idx}.jpg and parsing/{idx}.png for debugging")
+    parser.add_argument('--force', type=str, default='', help="comma separated steps to rerun, or `all`")
+    parser.add_argument('--audio_features', type=str, default='',
+                        help=f"comma separated audio features from {list(AUDIO_FEATURES)} or `all`, empty to resolve them from the target configs")
+    args = parser.parse_args()
+
+    force = [name for name in args.force.split(',') if name != '']
+    audio_features = None
+    if args.audio_features == 'all':
+        audio_features = list(AUDIO_FEATURES)
+    elif args.audio_features != '':
+        audio_features = args.audio_features.split(',')
+        for feature in audio_features:
+            assert feature in AUDIO_FEATURES, f"Unknown audio feature: {feature}, choose from {list(AUDIO_FEATURES)}"
+    success = run_steps(args.video_id, num_workers=args.num_workers, force=force, export_jpg=args.export_jpg,
+                        audio_features=audio_features)
+    sys.exit(0 if success else 1)
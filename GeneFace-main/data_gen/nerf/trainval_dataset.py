@@ -0,0 +1,370 @@
+"""
+Columnar (struct-of-arrays) format of the binarized NeRF dataset of a video, data/binary/videos/<video_id>/trainval/
+
+    meta.json            the header: H, W, focal, cx, cy, the number of train/val samples, the window sizes,
+                         the image file name templates and the dtype/shape of every field
+    sample_{field}.npy   the fields of the transforms (idx, face_rect, c2w, euler, trans), one row per sample,
+                         the train samples first, then the val samples
+    frame_{field}.npy    the per-frame fields (3dmm, lm3d, audio features), indexed by the frame idx of a sample
+    global_{field}.npy   the arrays of the whole video: bg_img, idexp_lm3d_mean/std, hubert, mel, f0
+    img_{kind}.npy       optional packed image caches, [num_samples, H, W, C] uint8 (RGB/RGBA, as imageio.imread),
+                         in the order of the samples; img_{kind}_x{downscale}.npy are the downscaled variants
+
+The windows of the conditions (`*_win`, `*_wins`) are not stored, they are computed from the per-frame arrays
+on access. All arrays are opened with mmap_mode='r', so loading the dataset is instant and the pages are shared
+by the DataLoader workers. A sample behaves as the dict of tensors the datasets built with convert_to_tensor.
+The previous pickled trainval_dataset.npy is converted by convert_legacy_dataset (once, see load_trainval_dataset).
+"""
+import os
+import json
+from collections.abc import Mapping, Sequence
+import numpy as np
+import torch
+import cv2
+import imageio
+import tqdm
+from multiprocessing.pool import ThreadPool
+
+from utils.commons.window_utils import get_win_conds, gather_wins
+
+
+TRAINVAL_DIR = 'trainval'
+META_JSON = 'meta.json'
+LEGACY_NPY = 'trainval_dataset.npy'
+# the global arrays below this size are loaded into memory, the larger ones (hubert, mel) are memory-mapped
+MAX_IN_MEMORY_BYTES = 64 * 1024 ** 2
+
+SAMPLE_FIELDS = ['idx', 'face_rect', 'c2w', 'euler', 'trans']
+FRAME_FIELDS = ['exp', 'identity', 'pose_deep3drecon', 'idexp_lm3d', 'idexp_lm3d_normalized']
+# the optional audio features, {name}_win is the frame itself and {name}_wins the window around it
+AUDIO_FIELDS = ['deepspeech', 'esperanto']
+# the per-frame image files; the frames and the parsing labels are in the stores of data_util/frame_store.py,
+# the ori_img_fname/parsing_fname templates of the datasets binarized before are ignored
+FNAME_FIELDS = ['head_img_fname', 'torso_img_fname', 'gt_img_fname']
+
+
+def get_nested_win_conds(conds, win_idxs, idx, cond_win_size, smo_win_size):
+    """
+    the window of the windows of the samples, i.e., get_win_conds(np.stack([get_win_conds(conds, i, cond_win_size)
+    for i in win_idxs]), idx, smo_win_size), without building the windows of all samples
+    :param win_idxs: the frame idx of each sample (train samples, then val samples), the windows are stacked in this order
+    :return: [smo_win_size, cond_win_size, ...]
+    """
+    num_wins = len(win_idxs)
+    idx = min(max(0, idx), num_wins - 1)
+    pos = np.arange(smo_win_size) + idx - smo_win_size // 2
+    wins = gather_wins(conds, np.asarray(win_idxs)[np.clip(pos, 0, num_wins - 1)], cond_win_size, pad_option='zero')
+    wins[(pos < 0) | (pos >= num_wins)] = 0
+    return wins
+
+
+##############
+# writer
+##############
+def save_trainval_dataset(out_dir, meta, sample_fields, frame_fields, global_fields):
+    """
+    :param meta: the scalars of the header (H, W, focal, cx, cy, num_train, num_val, window sizes, fname_templates)
+    :param sample_fields: {field: [num_train + num_val, ...]}
+    :param frame_fields: {field: [T, ...]}, indexed by the idx of the samples
+    :param global_fields: {name: array}
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    meta = dict(meta)
+    meta['fields'] = {}
+    for group, fields in [('sample', sample_fields), ('frame', frame_fields), ('global', global_fields)]:
+        for name, arr in fields.items():
+            arr = np.ascontiguousarray(arr)
+            np.save(os.path.join(out_dir, f'{group}_{name}.npy'), arr)
+            meta['fields'][name] = {'group': group, 'dtype': str(arr.dtype), 'shape': list(arr.shape)}
+    # the header is written last, a directory without meta.json is incomplete
+    with open(os.path.join(out_dir, META_JSON), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def convert_legacy_dataset(npy_name, out_dir):
+    """
+    convert the pickled dict of the previous binarizer (train_samples/val_samples with the windows of every sample)
+    into the columnar format, the windows computed on access are identical to the stored ones
+    """
+    ds_dict = np.load(npy_name, allow_pickle=True).tolist()
+    samples = ds_dict['train_samples'] + ds_dict['val_samples']
+    idxs = np.array([s['idx'] for s in samples], dtype=np.int64)
+    num_frames = int(idxs.max()) + 1
+    first = samples[0]
+    meta = {
+        'H': int(ds_dict['H']), 'W': int(ds_dict['W']),
+        'focal': float(ds_dict['focal']), 'cx': float(ds_dict['cx']), 'cy': float(ds_dict['cy']),
+        'num_train': len(ds_dict['train_samples']), 'num_val': len(ds_dict['val_samples']),
+        'audio_smo_win_size': int(first['deepspeech_wins'].shape[0]) if 'deepspeech_wins' in first else 8,
+        'exp_cond_win_size': int(first['idexp_lm3d_normalized_win'].shape[0]),
+        'exp_smo_win_size': int(first['idexp_lm3d_normalized_wins'].shape[0]),
+        'fname_templates': {k: os.path.join(os.path.dirname(first[k]), '{idx}' + os.path.splitext(first[k])[1])
+                            for k in FNAME_FIELDS if k in first},
+    }
+    sample_fields = {k: np.stack([np.asarray(s[k]) for s in samples]) for k in SAMPLE_FIELDS}
+    sample_fields['idx'] = idxs
+    frame_fields = {}
+    for k in FRAME_FIELDS:
+        arr = np.zeros([num_frames, *np.shape(first[k])], dtype=np.asarray(first[k]).dtype)
+        arr[idxs] = np.stack([s[k] for s in samples])
+        frame_fields[k] = arr
+    last = samples[int(np.argmax(idxs))]
+    for k in AUDIO_FIELDS:
+        if f'{k}_win' not in first:
+            continue
+        # the frames after the last sample only appear in its window, recover them from it
+        smo_win_size = meta['audio_smo_win_size']
+        num_tail = smo_win_size - smo_win_size // 2 - 1
+        arr = np.zeros([num_frames + num_tail, *np.shape(first[f'{k}_win'])], dtype=np.asarray(first[f'{k}_win']).dtype)
+        arr[idxs] = np.stack([s[f'{k}_win'] for s in samples])
+        left_i = last['idx'] - smo_win_size // 2
+        arr[num_frames:] = last[f'{k}_wins'][num_frames - left_i:]
+        frame_fields[k] = arr
+    global_fields = {k: v for k, v in ds_dict.items() if isinstance(v, np.ndarray)}
+    save_trainval_dataset(out_dir, meta, sample_fields, frame_fields, global_fields)
+    print(f"| converted {npy_name} to the columnar dataset at {out_dir}")
+
+
+##############
+# packed image cache
+##############
+def get_image_cache_name(kind, downscale=1):
+    return f'img_{kind}.npy' if downscale == 1 else f'img_{kind}_x{downscale}.npy'
+
+
+def _read_image(fname, downscales):
+    img = imageio.imread(fname)
+    h, w = img.shape[:2]
+    return [img if d == 1 else cv2.resize(img, (w // d, h // d), interpolation=cv2.INTER_AREA) for d in downscales]
+
+
+def build_image_cache(data_dir, kind, downscales=(1,), num_workers=8):
+    """
+    decode the images of all samples (the files of fname_templates['{kind}_fname']) into data_dir/img_{kind}.npy,
+    plus a variant downscaled by each factor in downscales (the size is floored, as cv2.INTER_AREA of the whole image)
+    """
+    with open(os.path.join(data_dir, META_JSON)) as f:
+        meta = json.load(f)
+    template = meta['fname_templates'][f'{kind}_fname']
+    idxs = np.load(os.path.join(data_dir, 'sample_idx.npy'))
+    downscales = sorted(set([int(d) for d in downscales]))
+    caches = {}
+    with ThreadPool(num_workers) as pool:
+        imgs_iter = pool.imap(lambda idx: _read_image(template.format(idx=idx), downscales), idxs.tolist(), chunksize=4)
+        for i, imgs in enumerate(tqdm.tqdm(imgs_iter, total=len(idxs), desc=f'packing {kind}')):
+            if i == 0:
+                for d, img in zip(downscales, imgs):
+                    caches[d] = np.lib.format.open_memmap(os.path.join(data_dir, get_image_cache_name(kind, d) + '.tmp'),
+                                                          mode='w+', dtype=np.uint8, shape=(len(idxs), *img.shape))
+            for d, img in zip(downscales, imgs):
+                caches[d][i] = img
+    image_caches = meta.get('image_caches', {})
+    for d, cache in caches.items():
+        cache.flush()
+        shape = list(cache.shape)
+        name = get_image_cache_name(kind, d)
+        os.replace(os.path.join(data_dir, name + '.tmp'), os.path.join(data_dir, name))
+        image_caches[name] = {'kind': kind, 'downscale': d, 'shape': shape}
+    caches.clear()
+    meta['image_caches'] = image_caches
+    with open(os.path.join(data_dir, META_JSON), 'w') as f:
+        json.dump(meta, f, indent=2)
+    print(f"| packed the {kind} of {len(idxs)} samples into {data_dir}, downscales: {downscales}")
+
+
+##############
+# reader
+##############
+def _to_tensor(arr):
+    # the same as convert_to_tensor: ndarrays become float tensors
+    return torch.from_numpy(np.array(arr)).float()
+
+
+class TrainvalSample(Mapping):
+    """
+    a read-only dict of one sample, the fields are read from the memory maps on access
+    """
+    def __init__(self, ds, pos):
+        self.ds = ds
+        self.pos = pos
+
+    def __getitem__(self, key):
+        return self.ds.get_field(self.pos, key)
+
+    def __iter__(self):
+        return iter(self.ds.sample_keys)
+
+    def __len__(self):
+        return len(self.ds.sample_keys)
+
+
+class TrainvalSamples(Sequence):
+    """
+    the lazy list of the samples of a split
+    """
+    def __init__(self, ds, positions):
+        self.ds = ds
+        self.positions = np.asarray(positions, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return TrainvalSamples(self.ds, self.positions[i])
+        return TrainvalSample(self.ds, int(self.positions[i]))
+
+    def __add__(self, other):
+        assert other.ds is self.ds
+        return TrainvalSamples(self.ds, np.concatenate([self.positions, other.positions]))
+
+    def sorted_by_idx(self):
+        order = np.argsort(self.ds.arrays['idx'][self.positions], kind='stable')
+        return TrainvalSamples(self.ds, self.positions[order])
+
+    def column(self, key):
+        """
+        the field of all samples at once, [len(self), ...], float32 for the float fields (as convert_to_tensor)
+        """
+        ds = self.ds
+        if key in ds.sample_group:
+            arr = ds.arrays[key][self.positions]
+        elif key in ds.frame_group:
+            arr = ds.arrays[key][ds.arrays['idx'][self.positions]]
+        elif key.endswith('_win') and key[:-4] in ds.audio_fields:
+            arr = ds.arrays[key[:-4]][ds.arrays['idx'][self.positions]]
+        else:
+            arr = np.stack([np.asarray(ds.get_field(int(p), key, to_tensor=False)) for p in self.positions])
+        arr = np.asarray(arr)
+        return arr.astype(np.float32) if arr.dtype.kind == 'f' else arr
+
+
+class TrainvalDataset(Mapping):
+    """
+    dict-like access to the header and the global arrays, e.g., ds['H'], ds['bg_img'], ds['hubert'],
+    and ds['train_samples'], ds['val_samples'] as TrainvalSamples
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        with open(os.path.join(data_dir, META_JSON)) as f:
+            self.meta = json.load(f)
+        self.arrays = {}
+        self.globals = {}
+        self.sample_group, self.frame_group = [], []
+        for name, info in self.meta['fields'].items():
+            fname = os.path.join(data_dir, f"{info['group']}_{name}.npy")
+            if info['group'] == 'global':
+                nbytes = np.dtype(info['dtype']).itemsize * int(np.prod(info['shape']))
+                self.globals[name] = np.load(fname, mmap_mode='r' if nbytes > MAX_IN_MEMORY_BYTES else None)
+            else:
+                self.arrays[name] = np.load(fname, mmap_mode='r')
+                (self.sample_group if info['group'] == 'sample' else self.frame_group).append(name)
+        self.audio_fields = [k for k in AUDIO_FIELDS if k in self.frame_group]
+        self.fname_templates = {k: v for k, v in self.meta['fname_templates'].items() if k in FNAME_FIELDS}
+        self.sample_keys = SAMPLE_FIELDS + list(self.fname_templates.keys()) + FRAME_FIELDS \
+            + ['idexp_lm3d_normalized_win', 'idexp_lm3d_normalized_wins'] \
+            + [f'{k}_{s}' for k in self.audio_fields for s in ['win', 'wins']]
+        self.num_train, self.num_val = self.meta['num_train'], self.meta['num_val']
+        self.image_caches = {}
+
+    def image_cache(self, kind, downscale=1, required=False):
+        """
+        the packed image cache [num_samples, H, W, C] (uint8, memory-mapped), None if it does not exist.
+        The caches are packed by the binarizer or by this file's __main__, never here: the datasets of all DDP ranks
+        would write the same files at the same time.
+        :param required: raise FileNotFoundError instead of returning None
+        """
+        name = get_image_cache_name(kind, downscale)
+        if name not in self.image_caches:
+            if name not in self.meta.get('image_caches', {}):
+                if not required:
+                    return None
+                video_dir = os.path.dirname(os.path.abspath(self.data_dir))
+                raise FileNotFoundError(
+                    f"the packed image cache {name} is missing in {self.data_dir}, pack it once before the training with "
+                    f"`python data_gen/nerf/trainval_dataset.py --binary_dir={os.path.dirname(video_dir)} "
+                    f"--video_id={os.path.basename(video_dir)} --img_cache_kinds={kind} --img_cache_downscales={downscale}`, "
+                    f"or set load_imgs_to_memory: false")
+            self.image_caches[name] = np.load(os.path.join(self.data_dir, name), mmap_mode='r')
+        return self.image_caches[name]
+
+    def get_field(self, pos, key, to_tensor=True):
+        arrays, meta = self.arrays, self.meta
+        idx = int(arrays['idx'][pos])
+        if key == 'idx':
+            return idx
+        if key in self.fname_templates:
+            return self.fname_templates[key].format(idx=idx)
+        if key in self.sample_group:
+            value = arrays[key][pos]
+        elif key in self.frame_group:
+            value = arrays[key][idx]
+        elif key == 'idexp_lm3d_normalized_win':
+            value = get_win_conds(np.asarray(arrays['idexp_lm3d_normalized']), idx, smo_win_size=meta['exp_cond_win_size'], pad_option='zero')
+        elif key == 'idexp_lm3d_normalized_wins':
+            value = get_nested_win_conds(np.asarray(arrays['idexp_lm3d_normalized']), arrays['idx'], idx,
+                                         meta['exp_cond_win_size'], meta['exp_smo_win_size'])
+        elif key.endswith('_wins') and key[:-5] in self.audio_fields:
+            value = get_win_conds(np.asarray(arrays[key[:-5]]), idx, smo_win_size=meta['audio_smo_win_size'], pad_option='zero')
+        elif key.endswith('_win') and key[:-4] in self.audio_fields:
+            value = arrays[key[:-4]][idx]
+        else:
+            raise KeyError(key)
+        return _to_tensor(value) if to_tensor else value
+
+    def samples(self, prefix):
+        num_samples = self.num_train + self.num_val
+        if prefix == 'train':
+            return TrainvalSamples(self, np.arange(0, self.num_train))
+        elif prefix == 'val':
+            return TrainvalSamples(self, np.arange(self.num_train, num_samples))
+        elif prefix == 'trainval':
+            return TrainvalSamples(self, np.arange(0, num_samples))
+        raise ValueError("prefix should be in train/val/trainval!")
+
+    def _keys(self):
+        return [k for k in self.meta if k not in ['fields', 'fname_templates', 'image_caches']] + list(self.globals.keys()) + ['train_samples', 'val_samples']
+
+    def __getitem__(self, key):
+        if key == 'train_samples':
+            return self.samples('train')
+        if key == 'val_samples':
+            return self.samples('val')
+        if key in self.globals:
+            return self.globals[key]
+        if key in self.meta and key not in ['fields', 'fname_templates', 'image_caches']:
+            return self.meta[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+
+def load_trainval_dataset(data_dir):
+    """
+    :param data_dir: data/binary/videos/<video_id>, the previous trainval_dataset.npy is converted on the first load
+    """
+    trainval_dir = os.path.join(data_dir, TRAINVAL_DIR)
+    if not os.path.exists(os.path.join(trainval_dir, META_JSON)):
+        legacy_name = os.path.join(data_dir, LEGACY_NPY)
+        assert os.path.exists(legacy_name), f"no binarized dataset in {data_dir}, run data_gen/nerf/binarizer.py first."
+        convert_legacy_dataset(legacy_name, trainval_dir)
+    return TrainvalDataset(trainval_dir)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video_id', type=str, default='May')
+    parser.add_argument('--binary_dir', type=str, default='data/binary/videos')
+    parser.add_argument('--img_cache_kinds', type=str, default='', help='comma separated, e.g., torso_img,gt_img, pack the images of the dataset')
+    parser.add_argument('--img_cache_downscales', type=str, default='1', help='comma separated downscale factors of the packed images')
+    args = parser.parse_args()
+    data_dir = os.path.join(args.binary_dir, args.video_id)
+    # converts the previous trainval_dataset.npy if the dataset is not in the columnar format yet
+    load_trainval_dataset(data_dir)
+    for kind in filter(None, args.img_cache_kinds.split(',')):
+        build_image_cache(os.path.join(data_dir, TRAINVAL_DIR), kind, [int(d) for d in args.img_cache_downscales.split(',')])
@@ -6,7 +6,7 @@ from tqdm import trange
 import pickle
 from copy import deepcopy
 
-from data_util.face3d_helper import Face3DHelper
+from data_util.face3d_helper import get_face3d_helper
 from utils.commons.indexed_datasets import IndexedDataset, IndexedDatasetBuilder
 
 
@@ -37,55 +37,70 @@ def load_audio_npy(fn):
     return audio_dict
 
 
+# the frames of these fields of each item are recorded in the index for the bucketing of LRS3SeqDataset
+SIZE_FIELDS = ['mel', 'hubert', 'idexp_lm3d']
+
+
+def build_item(mp4_name, raw_base_dir, spk_idx):
+    """
+    the item of a clip, None if its features are missing or it is too short
+    """
+    # loaded once in each worker
+    face3d_helper = get_face3d_helper(use_gpu=False)
+    lst = mp4_name.split("/")
+    spk_id = lst[-2]
+    clip_id = lst[-1][:-4]
+    audio_npy_name = os.path.join(raw_base_dir, spk_id, clip_id+"_audio.npy")
+    hubert_npy_name = os.path.join(raw_base_dir, spk_id, clip_id+"_hubert.npy")
+    video_npy_name = os.path.join(raw_base_dir, spk_id, clip_id+"_coeff_pt.npy")
+    if (not os.path.exists(audio_npy_name)) or (not os.path.exists(video_npy_name)):
+        print(f"Skip item for not found.")
+        return None
+    if (not os.path.exists(hubert_npy_name)):
+        print(f"Skip item for hubert_npy not found.")
+        return None
+    audio_dict = load_audio_npy(audio_npy_name)
+    hubert = np.load(hubert_npy_name)
+    video_dict = load_video_npy(video_npy_name)
+    cal_lm3d_in_video_dict(video_dict, face3d_helper)
+    mel = audio_dict['mel']
+    if mel.shape[0] < 64: # the video is shorter than 0.6s
+        print(f"Skip item for too short.")
+        return None
+    audio_dict.update(video_dict)
+    audio_dict['spk_id'] = spk_id
+    audio_dict['spk_idx'] = spk_idx
+    audio_dict['item_id'] = spk_id + "_" + clip_id
+
+    audio_dict['hubert'] = hubert # [T_x, hid=1024]
+    return audio_dict
+
+
 if __name__ == '__main__':
-    face3d_helper = Face3DHelper(use_gpu=False)
-    
-    import glob,tqdm
+    import glob
     prefixs = ['val', 'train']
     binarized_ds_path = "data/binary/lrs3"
     os.makedirs(binarized_ds_path, exist_ok=True)
     for prefix in prefixs:
-        databuilder = IndexedDatasetBuilder(os.path.join(binarized_ds_path, prefix), gzip=False)
+        # typed records: the arrays are read back without unpickling, see utils/commons/indexed_datasets.py
+        databuilder = IndexedDatasetBuilder(os.path.join(binarized_ds_path, prefix), record=True, compression='none',
+                                           size_fields=SIZE_FIELDS)
         raw_base_dir =  '/home/yezhenhui/datasets/raw/lrs3_raw'
         spk_ids = sorted([dir_name.split("/")[-1] for dir_name in glob.glob(raw_base_dir + "/*")])
         spk_id2spk_idx = {spk_id : i for i,spk_id in enumerate(spk_ids) }
         np.save(os.path.join(binarized_ds_path, "spk_id2spk_idx.npy"), spk_id2spk_idx, allow_pickle=True)
-        mp4_names = glob.glob(raw_base_dir + "/*/*.mp4")
-        cnt = 0
-        for i, mp4_name in tqdm.tqdm(enumerate(mp4_names), total=len(mp4_names)):
+        # sorted, so the every-100th val split is stable and matches process_lrs3_sharded.py
+        mp4_names = sorted(glob.glob(raw_base_dir + "/*/*.mp4"))
+        args = []
+        for i, mp4_name in enumerate(mp4_names):
             if prefix == 'train':
                 if i % 100 == 0:
                     continue
             else:
                 if i % 100 != 0:
                     continue
-            lst = mp4_name.split("/")
-            spk_id = lst[-2]
-            clip_id = lst[-1][:-4]
-            audio_npy_name = os.path.join(raw_base_dir, spk_id, clip_id+"_audio.npy")
-            hubert_npy_name = os.path.join(raw_base_dir, spk_id, clip_id+"_hubert.npy")
-            video_npy_name = os.path.join(raw_base_dir, spk_id, clip_id+"_coeff_pt.npy")
-            if (not os.path.exists(audio_npy_name)) or (not os.path.exists(video_npy_name)):
-                print(f"Skip item for not found.")
-                continue
-            if (not os.path.exists(hubert_npy_name)):
-                print(f"Skip item for hubert_npy not found.")
-                continue
-            audio_dict = load_audio_npy(audio_npy_name)
-            hubert = np.load(hubert_npy_name)
-            video_dict = load_video_npy(video_npy_name)
-            cal_lm3d_in_video_dict(video_dict, face3d_helper)
-            mel = audio_dict['mel']
-            if mel.shape[0] < 64: # the video is shorter than 0.6s
-                print(f"Skip item for too short.")
-                continue
-            audio_dict.update(video_dict)
-            audio_dict['spk_id'] = spk_id
-            audio_dict['spk_idx'] = spk_id2spk_idx[spk_id]
-            audio_dict['item_id'] = spk_id + "_" + clip_id
-            
-            audio_dict['hubert'] = hubert # [T_x, hid=1024]
-            databuilder.add_item(audio_dict)
-            cnt += 1
+            args.append((mp4_name, raw_base_dir, spk_id2spk_idx[mp4_name.split("/")[-2]]))
+        # the items are built and encoded in the workers, and appended in order
+        cnt = databuilder.add_items(build_item, args, num_workers=int(os.getenv('N_PROC', 8)), desc=f'binarizing {prefix}')
         databuilder.finalize()
-        print(f"{prefix} set has {cnt} samples!")
\ No newline at end of file
+        print(f"{prefix} set has {cnt} samples!")
@@ -11,13 +11,23 @@ from transformers import Wav2Vec2FeatureExtractor, HubertModel
 import soundfile as sf
 import numpy as np
 
-print("Loading the Wav2Vec2 Processor...")
-# Load from local path directly as requested
-wav2vec2_processor = Wav2Vec2FeatureExtractor.from_pretrained("checkpoints/hubert")
+wav2vec2_processor = None
+hubert_model = None
 
-print("Loading the HuBERT Model...")
-# Load from local path directly as requested
-hubert_model = HubertModel.from_pretrained("checkpoints/hubert")
+
+def load_hubert_model():
+    """
+    load the processor and the model on the first call, so importing this file does not load them
+    """
+    global wav2vec2_processor, hubert_model
+    if hubert_model is None:
+        print("Loading the Wav2Vec2 Processor...")
+        # Load from local path directly as requested
+        wav2vec2_processor = Wav2Vec2FeatureExtractor.from_pretrained("checkpoints/hubert")
+        print("Loading the HuBERT Model...")
+        # Load from local path directly as requested
+        hubert_model = HubertModel.from_pretrained("checkpoints/hubert")
+    return wav2vec2_processor, hubert_model
 
 
 def get_hubert_from_16k_wav(wav_16k_name):
@@ -28,6 +38,7 @@ def get_hubert_from_16k_wav(wav_16k_name):
 @torch.no_grad()
 def get_hubert_from_16k_speech(speech, device="cpu"):
     global hubert_model
+    load_hubert_model()
     hubert_model = hubert_model.to(device)
     if speech.ndim ==2:
         speech = speech[:, 0] # [T, 2] ==> [T,]
@@ -94,5 +94,5 @@ if __name__ == '__main__':
     wav_name_pattern = os.path.join(lrs3_dir, "*/*.wav")
     wav_names = glob.glob(wav_name_pattern)
     wav_names = sorted(wav_names)
-    for _ in multiprocess_run_tqdm(extract_mel_f0_from_fname, args=wav_names, num_workers=32,desc='extracting Mel and f0'):
+    for _ in multiprocess_run_tqdm(extract_mel_f0_from_fname, args=wav_names, num_workers=32, chunk_size=8, desc='extracting Mel and f0'):
         pass
\ No newline at end of file
@@ -0,0 +1,298 @@
+"""
+Sharded and resumable processing of LRS3, from the raw clips to the binarized dataset.
+
+    python data_gen/process_lrs3/process_lrs3_sharded.py --raw_dir=data/raw/lrs3_raw --work_dir=data/processed/lrs3_shards \
+        --num_shards=256 --num_workers=16 --gpu_ids=0,1 --workers_per_gpu=2
+
+The sorted clips (<raw_dir>/<spk_id>/<clip_id>.mp4) are partitioned once into shards, each with a manifest
+(<work_dir>/shards/shard_XXXX.json, the clips and their train/val split). Every stage runs the shards across
+worker processes, and each worker loads the models of the stage (HuBERT, face_alignment and deep_3drecon) once:
+    wav:      <clip_id>.wav, the 16k audio of the clip
+    mel_f0:   <clip_id>_audio.npy
+    hubert:   <clip_id>_hubert.npy
+    3dmm:     <clip_id>_coeff_pt.npy
+    binarize: <work_dir>/shards/shard_XXXX/{train,val}.data, the items of the shard
+The outputs of the clips are written next to them as in the other scripts of this folder, through a temporary file and a rename,
+and each finished clip is appended to the log of its shard (shard_XXXX.<stage>.log). A killed run resumes exactly from the logs,
+with the same shards; the clips that failed are logged and skipped on resume unless --retry_failed.
+At last the binarized shards are concatenated, without decoding the items, into <out_dir>/{train,val}.data.
+"""
+import os
+import json
+import glob
+import traceback
+from functools import partial
+import numpy as np
+
+from utils.commons.multiprocess_utils import multiprocess_run_tqdm
+from utils.commons.indexed_datasets import IndexedDatasetBuilder
+
+STAGES = ['wav', 'mel_f0', 'hubert', '3dmm', 'binarize']
+GPU_STAGES = ['hubert', '3dmm']
+
+
+##############
+# shards
+##############
+def make_shards(raw_dir, work_dir, num_shards):
+    """
+    partition the sorted clips into contiguous shards and write their manifests, the existing manifests are reused
+    :return: the manifest of the run
+    """
+    manifest_fname = os.path.join(work_dir, 'manifest.json')
+    if os.path.exists(manifest_fname):
+        with open(manifest_fname) as f:
+            manifest = json.load(f)
+        if manifest['num_shards'] != num_shards:
+            print(f"| reuse the {manifest['num_shards']} shards of {manifest_fname}, ignore --num_shards={num_shards}")
+        return manifest
+    mp4_names = sorted(glob.glob(os.path.join(raw_dir, '*/*.mp4')))
+    assert len(mp4_names) > 0, f"no clip found in {raw_dir}"
+    # the same split as data_gen/process_lrs3/binarizer.py: every 100th clip is for validation
+    splits = ['val' if i % 100 == 0 else 'train' for i in range(len(mp4_names))]
+    os.makedirs(os.path.join(work_dir, 'shards'), exist_ok=True)
+    bounds = np.linspace(0, len(mp4_names), num_shards + 1).astype(int)
+    for shard_id in range(num_shards):
+        clips = [[mp4_names[i], splits[i]] for i in range(bounds[shard_id], bounds[shard_id + 1])]
+        write_json(get_shard_fname(work_dir, shard_id), {'shard_id': shard_id, 'clips': clips})
+    manifest = {
+        'raw_dir': raw_dir,
+        'num_shards': num_shards,
+        'num_clips': len(mp4_names),
+        'spk_ids': sorted(set(mp4_name.split("/")[-2] for mp4_name in mp4_names)),
+    }
+    # written last, so the shards are complete once the manifest exists
+    write_json(manifest_fname, manifest)
+    print(f"| {len(mp4_names)} clips in {num_shards} shards, the manifests are in {work_dir}/shards")
+    return manifest
+
+
+def get_shard_fname(work_dir, shard_id):
+    return os.path.join(work_dir, 'shards', f'shard_{shard_id:04d}.json')
+
+
+def write_json(fname, obj):
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(fname + '.tmp', fname)
+
+
+def load_stage_log(log_fname, retry_failed=False):
+    """
+    :return: the clips finished (or failed, unless retry_failed) in the stage
+    """
+    done = set()
+    if not os.path.exists(log_fname):
+        return done
+    with open(log_fname) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue # the last line of a killed run
+            if record['ok'] or not retry_failed:
+                done.add(record['clip'])
+    return done
+
+
+##############
+# stages
+##############
+def save_npy(out_name, obj):
+    # through a temporary file, so a killed job does not leave a truncated output
+    tmp_name = out_name[:-4] + '.tmp.npy'
+    np.save(tmp_name, obj)
+    os.replace(tmp_name, out_name)
+
+
+def process_wav(mp4_name, ctx):
+    from moviepy.editor import VideoFileClip
+    wav_name = mp4_name[:-4] + '.wav'
+    tmp_name = mp4_name[:-4] + '.tmp.wav'
+    video = VideoFileClip(mp4_name, verbose=False)
+    assert video.audio is not None, f"no audio in {mp4_name}"
+    video.audio.write_audiofile(tmp_name, fps=16000, verbose=False, logger=None)
+    video.close()
+    os.replace(tmp_name, wav_name)
+
+
+def process_mel_f0(mp4_name, ctx):
+    from data_gen.process_lrs3.process_audio_mel_f0 import extract_mel_from_fname, extract_f0_from_wav_and_mel
+    wav, mel = extract_mel_from_fname(mp4_name[:-4] + '.wav')
+    f0, _ = extract_f0_from_wav_and_mel(wav, mel)
+    save_npy(mp4_name[:-4] + '_audio.npy', {'mel': mel, 'f0': f0})
+
+
+def process_hubert(mp4_name, ctx):
+    import soundfile as sf
+    from data_gen.process_lrs3.process_audio_hubert import get_hubert_from_16k_speech
+    speech_16k, _ = sf.read(mp4_name[:-4] + '.wav')
+    hubert = get_hubert_from_16k_speech(speech_16k, device=ctx['device'])
+    save_npy(mp4_name[:-4] + '_hubert.npy', hubert.detach().numpy())
+
+
+def process_3dmm(mp4_name, ctx):
+    from data_gen.process_lrs3.process_video_3dmm import extract_3dmm_from_video
+    save_npy(mp4_name[:-4] + '_coeff_pt.npy', extract_3dmm_from_video(mp4_name))
+
+
+STAGE_FUNCS = {
+    'wav': process_wav,
+    'mel_f0': process_mel_f0,
+    'hubert': process_hubert,
+    '3dmm': process_3dmm,
+}
+
+
+def init_stage_ctx(stage, gpu_ids, worker_id):
+    """
+    bind the worker to a GPU and load the models of the stage, once in each worker
+    """
+    device = 'cpu'
+    if stage in GPU_STAGES:
+        # before CUDA is initialized in this process, no GPU is visible on the cpu path,
+        # so the models that pick cuda when it is available (e.g., the 3DMM reconstructor) run on cpu too
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu_ids[worker_id % len(gpu_ids)]) if len(gpu_ids) > 0 else ''
+        device = 'cuda' if len(gpu_ids) > 0 else 'cpu'
+    if stage == 'hubert':
+        from data_gen.process_lrs3.process_audio_hubert import load_hubert_model
+        load_hubert_model()
+    elif stage == '3dmm':
+        from data_gen.process_lrs3.process_video_3dmm import load_models
+        load_models(device=device)
+    return {'stage': stage, 'device': device}
+
+
+def run_shard_stage(stage, shard_fname, retry_failed=False, ctx=None):
+    """
+    process the clips of a shard that are not in the log of the stage yet
+    :return: (the number of processed, failed, skipped clips)
+    """
+    with open(shard_fname) as f:
+        shard = json.load(f)
+    log_fname = shard_fname[:-len('.json')] + f'.{stage}.log'
+    done = load_stage_log(log_fname, retry_failed)
+    n_ok = n_failed = 0
+    with open(log_fname, 'a') as log_file:
+        for mp4_name, _ in shard['clips']:
+            if mp4_name in done:
+                continue
+            try:
+                STAGE_FUNCS[stage](mp4_name, ctx)
+                record = {'clip': mp4_name, 'ok': True}
+                n_ok += 1
+            except Exception as e:
+                traceback.print_exc()
+                record = {'clip': mp4_name, 'ok': False, 'err': repr(e)}
+                n_failed += 1
+            log_file.write(json.dumps(record) + '\n')
+            log_file.flush()
+            os.fsync(log_file.fileno())
+    return n_ok, n_failed, len(shard['clips']) - n_ok - n_failed
+
+
+def binarize_shard(shard_fname, raw_dir, spk_id2spk_idx, ctx=None):
+    """
+    write the items of a shard into <shard_dir>/{train,val}.data
+    :return: (the number of items of train, val)
+    """
+    from data_gen.process_lrs3.binarizer import build_item, SIZE_FIELDS
+    with open(shard_fname) as f:
+        shard = json.load(f)
+    log_fname = shard_fname[:-len('.json')] + '.binarize.log'
+    if os.path.exists(log_fname):
+        with open(log_fname) as f:
+            record = json.load(f)
+        return record['train'], record['val']
+    shard_dir = shard_fname[:-len('.json')]
+    os.makedirs(shard_dir, exist_ok=True)
+    record = {}
+    for prefix in ['train', 'val']:
+        builder = IndexedDatasetBuilder(os.path.join(shard_dir, prefix), record=True, compression='none',
+                                        size_fields=SIZE_FIELDS)
+        cnt = 0
+        for mp4_name, split in shard['clips']:
+            if split != prefix:
+                continue
+            item = build_item(mp4_name, raw_dir, spk_id2spk_idx[mp4_name.split("/")[-2]])
+            if item is not None:
+                builder.add_item(item)
+                cnt += 1
+        builder.finalize()
+        record[prefix] = cnt
+    write_json(log_fname, record)
+    return record['train'], record['val']
+
+
+def merge_shards(work_dir, out_dir, num_shards):
+    """
+    concatenate the binarized shards into <out_dir>/{train,val}.data, the encoded items are copied as they are
+    """
+    from data_gen.process_lrs3.binarizer import SIZE_FIELDS
+    os.makedirs(out_dir, exist_ok=True)
+    for prefix in ['val', 'train']:
+        builder = IndexedDatasetBuilder(os.path.join(out_dir, prefix), record=True, compression='none',
+                                        size_fields=SIZE_FIELDS)
+        cnt = 0
+        for shard_id in range(num_shards):
+            shard_dir = get_shard_fname(work_dir, shard_id)[:-len('.json')]
+            cnt += builder.add_dataset(os.path.join(shard_dir, prefix))
+        builder.finalize()
+        print(f"| {prefix} set has {cnt} samples!")
+
+
+def run_stage(stage, manifest, work_dir, num_workers, gpu_ids, workers_per_gpu, retry_failed):
+    shard_fnames = [get_shard_fname(work_dir, i) for i in range(manifest['num_shards'])]
+    if stage in GPU_STAGES and len(gpu_ids) > 0:
+        num_workers = len(gpu_ids) * workers_per_gpu
+    init_ctx_func = partial(init_stage_ctx, stage, gpu_ids)
+    if stage == 'binarize':
+        spk_id2spk_idx = {spk_id: i for i, spk_id in enumerate(manifest['spk_ids'])}
+        args = [(shard_fname, manifest['raw_dir'], spk_id2spk_idx) for shard_fname in shard_fnames]
+        n_train = n_val = 0
+        # the failed clips are skipped in the shard, a failed shard is a bug
+        for _, (n_train_, n_val_) in multiprocess_run_tqdm(binarize_shard, args, num_workers, ordered=False,
+                                                           init_ctx_func=init_ctx_func, on_error='raise',
+                                                           desc=f'[{stage}] shards'):
+            n_train, n_val = n_train + n_train_, n_val + n_val_
+        print(f"| binarize: {n_train} train and {n_val} val items in the shards")
+        return
+    args = [(stage, shard_fname, retry_failed) for shard_fname in shard_fnames]
+    n_ok = n_failed = n_skipped = 0
+    for _, (n_ok_, n_failed_, n_skipped_) in multiprocess_run_tqdm(run_shard_stage, args, num_workers, ordered=False,
+                                                                   init_ctx_func=init_ctx_func, on_error='raise',
+                                                                   desc=f'[{stage}] shards'):
+        n_ok, n_failed, n_skipped = n_ok + n_ok_, n_failed + n_failed_, n_skipped + n_skipped_
+    print(f"| {stage}: {n_ok} clips processed, {n_failed} failed, {n_skipped} done before")
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--raw_dir', type=str, default='data/raw/lrs3_raw')
+    parser.add_argument('--work_dir', type=str, default='data/processed/lrs3_shards', help='the manifests, logs and binarized shards')
+    parser.add_argument('--out_dir', type=str, default='data/binary/lrs3')
+    parser.add_argument('--num_shards', type=int, default=256)
+    parser.add_argument('--stages', type=str, default=','.join(STAGES), help=f'a subset of {",".join(STAGES)}, run in this order')
+    parser.add_argument('--num_workers', type=int, default=int(os.getenv('N_PROC', 8)), help='the workers of the cpu stages')
+    parser.add_argument('--gpu_ids', type=str, default='0', help='the GPUs of the hubert and 3dmm stages (physical ids, set as CUDA_VISIBLE_DEVICES of the workers), empty for cpu')
+    parser.add_argument('--workers_per_gpu', type=int, default=1)
+    parser.add_argument('--retry_failed', action='store_true', help='process the clips that failed in the previous runs again')
+    parser.add_argument('--redo_stages', type=str, default='', help='clear the logs of these stages and run them from scratch')
+    args = parser.parse_args()
+
+    stages = [s for s in args.stages.split(",") if s != '']
+    assert all(s in STAGES for s in stages), stages
+    gpu_ids = [int(i) for i in args.gpu_ids.split(",") if i != '']
+    manifest = make_shards(args.raw_dir, args.work_dir, args.num_shards)
+    for stage in [s for s in args.redo_stages.split(",") if s != '']:
+        for log_fname in glob.glob(os.path.join(args.work_dir, 'shards', f'shard_*.{stage}.log')):
+            os.remove(log_fname)
+    for stage in STAGES:
+        if stage in stages:
+            run_stage(stage, manifest, args.work_dir, args.num_workers, gpu_ids, args.workers_per_gpu, args.retry_failed)
+    if 'binarize' in stages:
+        spk_id2spk_idx = {spk_id: i for i, spk_id in enumerate(manifest['spk_ids'])}
+        os.makedirs(args.out_dir, exist_ok=True)
+        np.save(os.path.join(args.out_dir, "spk_id2spk_idx.npy"), spk_id2spk_idx, allow_pickle=True)
+        merge_shards(args.work_dir, args.out_dir, manifest['num_shards'])
@@ -14,8 +14,20 @@ import psutil
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, network_size=4, device='cuda')
-face_reconstructor = deep_3drecon.Reconstructor()
+fa = None
+face_reconstructor = None
+
+
+def load_models(device='cuda'):
+    """
+    load the landmark detector and the 3DMM reconstructor on the first call, once in each process
+    (the reconstructor runs on cuda:0 if CUDA is visible, otherwise on cpu)
+    """
+    global fa, face_reconstructor
+    if fa is None:
+        fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, network_size=4, device=device)
+        face_reconstructor = deep_3drecon.Reconstructor()
+    return fa, face_reconstructor
 
 # landmark detection in Deep3DRecon
 def lm68_2_lm5(in_lm):
@@ -27,18 +39,11 @@ def lm68_2_lm5(in_lm):
     lm = lm[[1,2,0,3,4],:2]
     return lm
 
-def process_video(fname, out_name=None):
-    assert fname.endswith(".mp4")
-    if out_name is None:
-        out_name = fname[:-4] + '.npy'
-    tmp_name = out_name[:-4] + '.doi'
-    # if os.path.exists(tmp_name):
-    #     print("tmp exist, skip")
-    #     return
-    # if os.path.exists(out_name):
-        # print("out exisit, skip")
-        # return
-    os.system(f"touch {tmp_name}")
+def extract_3dmm_from_video(fname):
+    """
+    :return: {'coeff': [T, 257], 'lm68': [T, 68, 2], 'lm5': [T, 5, 2]}
+    """
+    fa, face_reconstructor = load_models()
     cap = cv2.VideoCapture(fname)
     print(f"loading video ...")
     # 获取视频相关参数
@@ -94,6 +99,22 @@ def process_video(fname, out_name=None):
         'lm68': lm68_arr,
         'lm5': lm5_arr,
     }
+    return result_dict
+
+
+def process_video(fname, out_name=None):
+    assert fname.endswith(".mp4")
+    if out_name is None:
+        out_name = fname[:-4] + '.npy'
+    tmp_name = out_name[:-4] + '.doi'
+    # if os.path.exists(tmp_name):
+    #     print("tmp exist, skip")
+    #     return
+    # if os.path.exists(out_name):
+        # print("out exisit, skip")
+        # return
+    os.system(f"touch {tmp_name}")
+    result_dict = extract_3dmm_from_video(fname)
     np.save(out_name, result_dict)
     os.system(f"rm {tmp_name}")
 
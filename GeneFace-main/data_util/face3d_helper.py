@@ -4,11 +4,77 @@ import torch
 from scipy.io import loadmat
 
 
+# the bases of the 68 keypoints, extracted from BFM_model_front.mat into this file of the bfm_dir on the first use
+KEYPOINT_BASIS_NPZ = 'BFM_keypoint_basis.npz'
+
+
+def build_keypoint_basis(bfm_dir):
+    """
+    read the keypoint bases from BFM_model_front.mat, and save them into KEYPOINT_BASIS_NPZ if the bfm_dir is writable
+    """
+    mat_name = os.path.join(bfm_dir, "BFM_model_front.mat")
+    model = loadmat(mat_name, variable_names=['meanshape', 'idBase', 'exBase', 'keypoints'])
+    key_points = model['keypoints'].squeeze().astype(np.int64)
+    stat = os.stat(mat_name)
+    basis = {
+        'key_points': key_points, # [68]
+        'key_mean_shape': model['meanshape'].transpose().astype(np.float32).reshape([-1, 3])[key_points], # [68, 3]
+        'key_id_base': model['idBase'].astype(np.float32).reshape([-1, 3, 80])[key_points].reshape([-1, 80]), # [3*68, 80]
+        'key_exp_base': model['exBase'].astype(np.float32).reshape([-1, 3, 64])[key_points].reshape([-1, 64]), # [3*68, 64]
+        'src_stat': np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64), # to rebuild it when the .mat changes
+    }
+    npz_name = os.path.join(bfm_dir, KEYPOINT_BASIS_NPZ)
+    try:
+        np.savez(npz_name[:-4] + '.tmp.npz', **basis)
+        os.replace(npz_name[:-4] + '.tmp.npz', npz_name)
+        print(f"| saved the keypoint bases of the BFM to {npz_name}")
+    except OSError as e:
+        print(f"| Warning: cannot save the keypoint bases of the BFM to {npz_name}: {e}")
+    return basis
+
+
+def load_keypoint_basis(bfm_dir):
+    npz_name = os.path.join(bfm_dir, KEYPOINT_BASIS_NPZ)
+    mat_name = os.path.join(bfm_dir, "BFM_model_front.mat")
+    if os.path.exists(npz_name):
+        with np.load(npz_name) as f:
+            basis = dict(f)
+        # the cache alone is enough, e.g., when only the npz is deployed
+        if not os.path.exists(mat_name):
+            return basis
+        stat = os.stat(mat_name)
+        if basis['src_stat'].tolist() == [stat.st_size, stat.st_mtime_ns]:
+            return basis
+    return build_keypoint_basis(bfm_dir)
+
+
 class Face3DHelper:
+    """
+    The keypoint bases (key_mean_shape, key_id_base, key_exp_base), which are all that the landmark functions need,
+    are loaded from the small KEYPOINT_BASIS_NPZ cache. The full mesh bases (mean_shape, id_base, exp_base, texture
+    and triangles, 35709 vertices) are loaded from the .mat on their first access, e.g., by reconstruct_face_mesh.
+    get_face3d_helper returns an instance shared in the process.
+    """
+    FULL_MESH_ATTRS = ['mean_shape', 'id_base', 'exp_base', 'mean_texure', 'tex_base', 'point_buf', 'face_buf']
+
     def __init__(self, bfm_dir='deep_3drecon/BFM', use_gpu=True):
         self.bfm_dir = bfm_dir
         self.device = 'cuda' if use_gpu and torch.cuda.is_available() else 'cpu'
-        self.load_3dmm()
+        self.load_keypoint_basis()
+
+    def __getattr__(self, name):
+        # only called for the missing attributes: load the full mesh bases on the first access
+        if name in Face3DHelper.FULL_MESH_ATTRS and 'bfm_dir' in self.__dict__:
+            self.load_3dmm()
+            return self.__dict__[name]
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def load_keypoint_basis(self):
+        basis = load_keypoint_basis(self.bfm_dir)
+        self.key_points = torch.from_numpy(basis['key_points']).long().to(self.device) # vertex indices of 68 facial landmarks. starts from 1. [68]
+        self.key_mean_shape = torch.from_numpy(basis['key_mean_shape']).float().to(self.device) # [68, 3]
+        self.key_id_base = torch.from_numpy(basis['key_id_base']).float().to(self.device) # [3*68, 80]
+        self.key_exp_base = torch.from_numpy(basis['key_exp_base']).float().to(self.device) # [3*68, 64]
 
     def load_3dmm(self):
         try:
@@ -33,11 +99,6 @@ class Face3DHelper:
 
         self.point_buf = torch.from_numpy(model['point_buf']).float().to(self.device) # triangle indices for each vertex that lies in. starts from 1. [N,8] (1-F)
         self.face_buf = torch.from_numpy(model['tri']).float().to(self.device) # vertex indices in each triangle. starts from 1. [F,3] (1-N)
-        self.key_points = torch.from_numpy(model['keypoints'].squeeze().astype(np.long)).long().to(self.device) # vertex indices of 68 facial landmarks. starts from 1. [68,1]
-
-        self.key_mean_shape = self.mean_shape.reshape([-1,3])[self.key_points,:].to(self.device)
-        self.key_id_base = self.id_base.reshape([-1,3,80])[self.key_points, :, :].reshape([-1,80]).to(self.device)
-        self.key_exp_base = self.exp_base.reshape([-1,3,64])[self.key_points, :, :].reshape([-1,64]).to(self.device)
 
     def split_coeff(self, coeff):
         """
@@ -167,6 +228,22 @@ class Face3DHelper:
         
         return idexp_lm3d
 
+
+# the instances shared in the process, the bases are read-only
+face3d_helpers = {}
+
+
+def get_face3d_helper(bfm_dir='deep_3drecon/BFM', use_gpu=True):
+    """
+    the Face3DHelper shared in the process, one per bfm_dir and device
+    """
+    device = 'cuda' if use_gpu and torch.cuda.is_available() else 'cpu'
+    key = (os.path.abspath(bfm_dir), device)
+    if key not in face3d_helpers:
+        face3d_helpers[key] = Face3DHelper(bfm_dir, use_gpu=use_gpu)
+    return face3d_helpers[key]
+
+
 if __name__ == '__main__':
     import cv2
     
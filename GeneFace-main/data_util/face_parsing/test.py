@@ -14,44 +14,60 @@ import torchvision.transforms as transforms
 import cv2
 from pathlib import Path
 import configargparse
+import sys
+
+sys.path.insert(0, osp.abspath(osp.join(osp.dirname(__file__), '../..')))
+from data_util.frame_store import get_frame_store, list_frames, read_frame, colorize_parsing, LABELS_NPY, LABELS_JSON
+import json
+from torch.utils.data import Dataset, DataLoader
 
 
 def vis_parsing_maps(im, parsing_anno, stride, save_im=False, save_path='vis_results/parsing_map_on_im.jpg',
                      img_size=(512, 512)):
-    im = np.array(im)
-    vis_im = im.copy().astype(np.uint8)
-    vis_parsing_anno = parsing_anno.copy().astype(np.uint8)
-    vis_parsing_anno = cv2.resize(
-        vis_parsing_anno, None, fx=stride, fy=stride, interpolation=cv2.INTER_NEAREST)
-    vis_parsing_anno_color = np.zeros(
-        (vis_parsing_anno.shape[0], vis_parsing_anno.shape[1], 3)) + np.array([255, 255, 255])  # + 255
-
-    num_of_class = np.max(vis_parsing_anno)
-    # print(num_of_class)
-    for pi in range(1, 14):
-        index = np.where(vis_parsing_anno == pi)
-        vis_parsing_anno_color[index[0], index[1], :] = np.array([255, 0, 0])
-
-    for pi in range(14, 16):
-        index = np.where(vis_parsing_anno == pi)
-        vis_parsing_anno_color[index[0], index[1], :] = np.array([0, 255, 0])
-    for pi in range(16, 17):
-        index = np.where(vis_parsing_anno == pi)
-        vis_parsing_anno_color[index[0], index[1], :] = np.array([0, 0, 255])
-    for pi in range(17, num_of_class+1):
-        index = np.where(vis_parsing_anno == pi)
-        vis_parsing_anno_color[index[0], index[1], :] = np.array([255, 0, 0])
-
-    vis_parsing_anno_color = vis_parsing_anno_color.astype(np.uint8)
-    index = np.where(vis_parsing_anno == num_of_class-1)
-    vis_im = cv2.resize(vis_parsing_anno_color, img_size,
-                        interpolation=cv2.INTER_NEAREST)
+    vis_parsing_anno = parsing_anno.astype(np.uint8)
+    if stride != 1:
+        vis_parsing_anno = cv2.resize(
+            vis_parsing_anno, None, fx=stride, fy=stride, interpolation=cv2.INTER_NEAREST)
+    # a single lookup of the class colors, resized to the image size with nearest interpolation
+    vis_im = colorize_parsing(vis_parsing_anno, img_size)
     if save_im:
         cv2.imwrite(save_path, vis_im)
-
-
-def evaluate(respth='./res/test_res', dspth='./data', cp='model_final_diss.pth'):
-
+    return vis_im
+
+
+class ParsingDataset(Dataset):
+    """
+    decodes and resizes the frames in the DataLoader workers
+    """
+    def __init__(self, dspth, image_names, use_frame_store):
+        self.dspth = dspth
+        self.image_names = image_names
+        self.use_frame_store = use_frame_store
+        self.to_tensor = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+        ])
+
+    def __len__(self):
+        return len(self.image_names)
+
+    def __getitem__(self, i):
+        image_name = self.image_names[i]
+        if self.use_frame_store:
+            img = Image.fromarray(cv2.cvtColor(read_frame(osp.join(self.dspth, image_name)), cv2.COLOR_BGR2RGB))
+        else:
+            img = Image.open(osp.join(self.dspth, image_name))
+        ori_size = img.size
+        image = img.resize((512, 512), Image.BILINEAR)
+        image = image.convert("RGB")
+        return self.to_tensor(image), int(image_name[:-4]), torch.tensor(ori_size)
+
+
+def evaluate(respth='./res/test_res', dspth='./data', cp='model_final_diss.pth', batch_size=8, num_workers=4, save_png=False):
+    """
+    saves the labels of all frames to {respth}/labels.npy, [T, 512, 512] uint8 (see data_util/frame_store.read_parsing),
+    the colored {respth}/{idx}.png parsing maps are only saved when save_png
+    """
     Path(respth).mkdir(parents=True, exist_ok=True)
 
     n_classes = 19
@@ -61,31 +77,40 @@ def evaluate(respth='./res/test_res', dspth='./data', cp='model_final_diss.pth')
     net.load_state_dict(torch.load(cp, map_location=device))
     net.eval()
 
-    to_tensor = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
-    ])
+    use_frame_store = get_frame_store(dspth) is not None
+    if use_frame_store:
+        image_names = [osp.basename(p) for p in list_frames(dspth)]
+    else:
+        image_names = [p for p in os.listdir(dspth) if p.endswith('.jpg') or p.endswith('.png')]
+    image_names = sorted(image_names, key=lambda name: int(name[:-4]))
+    num_frames = int(image_names[-1][:-4]) + 1 if len(image_names) > 0 else 0
+    dataset = ParsingDataset(dspth, image_names, use_frame_store)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False,
+                        pin_memory=device == 'cuda', prefetch_factor=4 if num_workers > 0 else None)
+
+    labels_store = np.lib.format.open_memmap(osp.join(respth, LABELS_NPY), mode='w+', dtype=np.uint8, shape=(num_frames, 512, 512))
+    ori_size = None
     processed_num = 0
     with torch.no_grad():
-        for image_path in os.listdir(dspth):
-            if image_path.endswith('.jpg') or image_path.endswith('.png'):
-                img = Image.open(osp.join(dspth, image_path))
-                ori_size = img.size
-                image = img.resize((512, 512), Image.BILINEAR)
-                image = image.convert("RGB")
-                img = to_tensor(image)
-                img = torch.unsqueeze(img, 0)
-                img = img.to(device)
-                out = net(img)[0]
-                parsing = out.squeeze(0).cpu().numpy().argmax(0)
-                image_path = int(image_path[:-4])
-                image_path = str(image_path) + '.png'
-
-                vis_parsing_maps(image, parsing, stride=1, save_im=True,
-                                 save_path=osp.join(respth, image_path), img_size=ori_size)
-                processed_num = processed_num + 1
-                if processed_num % 100 == 0:
-                    print('processed parsing', processed_num)
+        for imgs, idxs, ori_sizes in loader:
+            imgs = imgs.to(device, non_blocking=True)
+            out = net(imgs)[0]
+            parsings = out.argmax(1).byte().cpu().numpy() # [B, 512, 512]
+            idxs = idxs.numpy()
+            labels_store[idxs] = parsings
+            ori_size = tuple(ori_sizes[0].tolist())
+            if save_png:
+                for idx, parsing, size in zip(idxs, parsings, ori_sizes.tolist()):
+                    vis_parsing_maps(None, parsing, stride=1, save_im=True,
+                                     save_path=osp.join(respth, f'{idx}.png'), img_size=tuple(size))
+            if (processed_num + len(idxs)) // 100 > processed_num // 100:
+                print('processed parsing', processed_num + len(idxs))
+            processed_num = processed_num + len(idxs)
+    labels_store.flush()
+    del labels_store
+    meta = {'num_frames': num_frames, 'W': ori_size[0] if ori_size else 0, 'H': ori_size[1] if ori_size else 0, 'label_size': 512}
+    with open(osp.join(respth, LABELS_JSON), 'w') as f:
+        json.dump(meta, f, indent=2)
 
 
 if __name__ == "__main__":
@@ -96,5 +121,9 @@ if __name__ == "__main__":
                         default='./imgs/', help='path for input images')
     parser.add_argument('--modelpath', type=str,
                         default='data_util/face_parsing/79999_iter.pth')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, default=4, help='workers decoding and resizing the frames')
+    parser.add_argument('--save_png', action='store_true', help='also save the colored parsing maps {idx}.png')
     args = parser.parse_args()
-    evaluate(respth=args.respath, dspth=args.imgpath, cp=args.modelpath)
+    evaluate(respth=args.respath, dspth=args.imgpath, cp=args.modelpath,
+             batch_size=args.batch_size, num_workers=args.num_workers, save_png=args.save_png)
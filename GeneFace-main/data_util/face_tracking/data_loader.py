@@ -2,18 +2,15 @@ import torch
 import cv2
 import numpy as np
 import os
+from data_util.frame_store import load_landmarks
 
 
 def load_dir(path, start, end):
-    lmss = []
-    imgs_paths = []
-    for i in range(start, end):
-        if os.path.isfile(os.path.join(path, str(i) + '.lms')):
-            lms = np.loadtxt(os.path.join(
-                path, str(i) + '.lms'), dtype=np.float32)
-            lmss.append(lms)
-            imgs_paths.append(os.path.join(path, str(i) + '.jpg'))
-    lmss = np.stack(lmss)
+    # the frames with a valid face in [start, end), from the landmark store (ori_imgs/landmarks.npy)
+    lms, valid = load_landmarks(path)
+    ids = np.nonzero(valid[start:end])[0] + start
+    lmss = np.asarray(lms[ids], dtype=np.float32)
+    imgs_paths = [os.path.join(path, str(i) + '.jpg') for i in ids]
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     lmss = torch.as_tensor(lmss).to(device)
     return lmss, imgs_paths
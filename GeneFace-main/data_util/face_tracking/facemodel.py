@@ -47,6 +47,12 @@ class Face_3DMM(nn.Module):
         self.rigid_ids = torch.as_tensor(keys_info['rigid_ids']).to(device)
 
     def get_3dlandmarks(self, id_para, exp_para, euler_angle, trans, focal_length, cxy):
+        if exp_para.dim() == 3:
+            # the candidates of the focal search: [K, B, ...] params with the focal_length [K] of each candidate
+            num_cands, batch_size = exp_para.shape[:2]
+            lands_3d = self.get_3dlandmarks(id_para.flatten(0, 1), exp_para.flatten(0, 1), euler_angle.flatten(0, 1),
+                                            trans.flatten(0, 1), flatten_focal(focal_length, batch_size), cxy)
+            return lands_3d.view(num_cands, batch_size, -1, 3)
         id_para = id_para*self.sig_id
         exp_para = exp_para*self.sig_exp
         batch_size = id_para.shape[0]
@@ -73,7 +73,17 @@ def forward_rott(geometry, euler_angle, trans):
     rott_geo = rot_trans_pts(geometry, rot, trans)
     return rott_geo
 
+def flatten_focal(focal_length, batch_size):
+    # [K] focals of K candidates -> [K*batch_size, 1], broadcast with the [K*batch_size, N] points in proj_pts
+    return focal_length.view(-1, 1).expand(-1, batch_size).reshape(-1, 1)
+
 def forward_transform(geometry, euler_angle, trans, focal_length, cxy):
+    if geometry.dim() == 4:
+        # [K, B, N, 3] geometry of K focal candidates, focal_length [K]
+        num_cands, batch_size = geometry.shape[:2]
+        proj_geo = forward_transform(geometry.flatten(0, 1), euler_angle.flatten(0, 1), trans.flatten(0, 1),
+                                     flatten_focal(focal_length, batch_size), cxy)
+        return proj_geo.view(num_cands, batch_size, -1, 3)
     rot = euler2rot(euler_angle)
     rott_geo = rot_trans_pts(geometry, rot, trans)
     proj_geo = proj_pts(rott_geo, focal_length, cxy)
@@ -0,0 +1,265 @@
+"""
+Frame store of the processed videos: the video is decoded once into a uint8 memory-mapped array.
+
+    ori_imgs/frames.npy   [T, H, W, 3], uint8, BGR (the same as cv2.imread), a standard .npy file
+    ori_imgs/frames.json  index header: num_frames, H, W, fps, color, source video
+
+Every stage reads the frames through read_frame/list_frames, which are zero-copy views of the
+memory map. The per-frame jpgs (ori_imgs/{idx}.jpg) are optional now and only exported for debugging,
+the frame paths are still used as the keys of the frames so the names of the outputs are unchanged.
+NOTE: the frames are views of a read-only memmap, copy them before in-place modification.
+The face parsing labels and the landmarks are stored in the same way, see read_parsing and load_landmarks.
+"""
+import os
+import glob
+import json
+import subprocess
+import cv2
+import numpy as np
+import tqdm
+
+
+FRAMES_NPY = 'frames.npy'
+FRAMES_JSON = 'frames.json'
+_frame_stores = {}
+
+
+def probe_frame_size(video_path):
+    """
+    the (H, W) of the frames that ffmpeg decodes from the video, i.e., rotated by the display matrix
+    (ffmpeg autorotates), the sample aspect ratio does not change the decoded size
+    """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_streams', '-of', 'json', video_path]
+    stream = json.loads(subprocess.run(cmd, check=True, capture_output=True, text=True).stdout)['streams'][0]
+    h, w = int(stream['height']), int(stream['width'])
+    rotation = stream.get('tags', {}).get('rotate', 0)
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if abs(int(float(rotation))) % 180 == 90:
+        h, w = w, h
+    return h, w
+
+
+def build_frame_store(video_path, out_dir, fps=25, export_jpg=False):
+    """
+    decode the video with ffmpeg (resampled to fps, as extract_images does) into out_dir/frames.npy
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    h, w = probe_frame_size(video_path)
+    frame_bytes = h * w * 3
+    npy_name = os.path.join(out_dir, FRAMES_NPY)
+    header_len = 128 # the npy header is written after decoding, when the number of frames is known
+
+    print(f'[INFO] ===== decode frames from {video_path} to {npy_name} =====')
+    # the scale filter pins the size of the raw frames to (H, W), it is a no-op if the probe is right
+    cmd = ['ffmpeg', '-v', 'error', '-i', video_path, '-vf', f'fps={fps},scale={w}:{h}',
+           '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    num_frames = 0
+    with open(npy_name, 'wb') as f:
+        f.write(b'\0' * header_len)
+        while True:
+            buf = proc.stdout.read(frame_bytes)
+            if len(buf) < frame_bytes:
+                break
+            f.write(buf)
+            num_frames += 1
+    if proc.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {video_path}")
+    # the decoded bytes must be whole frames of [H, W, 3]
+    if len(buf) != 0 or num_frames == 0 or os.path.getsize(npy_name) != header_len + num_frames * frame_bytes:
+        raise RuntimeError(f"the frames decoded from {video_path} do not match the size {h}x{w}: "
+                           f"{num_frames} frames and {len(buf)} bytes left")
+    _write_npy_header(npy_name, (num_frames, h, w, 3), header_len)
+
+    meta = {'num_frames': num_frames, 'H': h, 'W': w, 'fps': fps, 'color': 'BGR', 'video': video_path}
+    with open(os.path.join(out_dir, FRAMES_JSON), 'w') as f:
+        json.dump(meta, f, indent=2)
+    _frame_stores.pop(os.path.abspath(out_dir), None)
+    print(f'[INFO] ===== decoded {num_frames} frames, {num_frames * frame_bytes / 1024**3:.2f} GB =====')
+
+    if export_jpg:
+        export_jpgs(out_dir)
+    return meta
+
+
+def _write_npy_header(npy_name, shape, header_len):
+    # write the npy v1.0 header into the reserved header_len bytes
+    magic = np.lib.format.magic(1, 0)
+    header = repr({'descr': '|u1', 'fortran_order': False, 'shape': shape}).encode('latin1')
+    pad = header_len - len(magic) - 2 - len(header) - 1
+    assert pad >= 0, "the npy header is too long"
+    header = header + b' ' * pad + b'\n'
+    with open(npy_name, 'r+b') as f:
+        f.write(magic + len(header).to_bytes(2, 'little') + header)
+
+
+def export_jpgs(store_dir):
+    """
+    export ori_imgs/{idx}.jpg for debugging
+    """
+    store = FrameStore(store_dir)
+    for idx in tqdm.trange(len(store), desc='exporting jpgs'):
+        cv2.imwrite(os.path.join(store_dir, f'{idx}.jpg'), store[idx], [cv2.IMWRITE_JPEG_QUALITY, 100])
+
+
+class FrameStore:
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, FRAMES_JSON)) as f:
+            self.meta = json.load(f)
+        self.store_dir = store_dir
+        self.frames = np.load(os.path.join(store_dir, FRAMES_NPY), mmap_mode='r') # [T, H, W, 3]
+        self.H, self.W = self.meta['H'], self.meta['W']
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def __getitem__(self, idx):
+        # int or slice, returns a read-only view of the memmap
+        return self.frames[idx]
+
+    @staticmethod
+    def exists(store_dir):
+        return os.path.exists(os.path.join(store_dir, FRAMES_NPY)) and os.path.exists(os.path.join(store_dir, FRAMES_JSON))
+
+
+def get_frame_store(store_dir):
+    """
+    the opened frame stores are cached, None if store_dir has no frame store
+    """
+    key = os.path.abspath(store_dir)
+    if key not in _frame_stores:
+        if not FrameStore.exists(store_dir):
+            return None
+        _frame_stores[key] = FrameStore(store_dir)
+    return _frame_stores[key]
+
+
+def list_frames(ori_imgs_dir):
+    """
+    the frame paths ({ori_imgs_dir}/{idx}.jpg) of the frame store, or the jpgs on the disk
+    """
+    store = get_frame_store(ori_imgs_dir)
+    if store is not None:
+        return [os.path.join(ori_imgs_dir, f'{idx}.jpg') for idx in range(len(store))]
+    return glob.glob(os.path.join(ori_imgs_dir, '*.jpg'))
+
+
+def read_frame(image_path):
+    """
+    a drop-in replacement of cv2.imread for the frames, reads from the frame store when it exists
+    :return: [H, W, 3], uint8, BGR
+    """
+    store = get_frame_store(os.path.dirname(image_path))
+    if store is not None:
+        idx = int(os.path.basename(image_path)[:-4])
+        return store[idx]
+    return cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+
+
+def get_frame_size(ori_imgs_dir):
+    """
+    :return: num_frames, h, w
+    """
+    store = get_frame_store(ori_imgs_dir)
+    if store is not None:
+        return len(store), store.H, store.W
+    image_paths = glob.glob(os.path.join(ori_imgs_dir, '*.jpg'))
+    h, w = cv2.imread(image_paths[0], cv2.IMREAD_UNCHANGED).shape[:2]
+    return len(image_paths), h, w
+
+
+##############
+# parsing store
+##############
+# parsing/labels.npy   [T, 512, 512], uint8, the BiSeNet labels of each frame
+# parsing/labels.json  num_frames, H, W of the frames, label_size
+LABELS_NPY = 'labels.npy'
+LABELS_JSON = 'labels.json'
+_parsing_stores = {}
+
+# the color of each BiSeNet class in the parsing maps (in the channel order of cv2.imread):
+# 0 background (white), 1-13 and 17-18 head (255,0,0), 14-15 neck (0,255,0), 16 torso (0,0,255)
+PARSING_LUT = np.array([[255, 255, 255]] + [[255, 0, 0]] * 13 + [[0, 255, 0]] * 2 + [[0, 0, 255]] + [[255, 0, 0]] * 2, dtype=np.uint8)
+
+
+def colorize_parsing(labels, size=None):
+    """
+    :param labels: [h, w] uint8 labels
+    :param size: (W, H), resize the parsing map to the frame size with nearest interpolation
+    :return: [H, W, 3] the parsing map
+    """
+    if size is not None and (labels.shape[1], labels.shape[0]) != tuple(size):
+        labels = cv2.resize(np.ascontiguousarray(labels), tuple(size), interpolation=cv2.INTER_NEAREST)
+    return PARSING_LUT[labels]
+
+
+def get_parsing_store(parsing_dir):
+    key = os.path.abspath(parsing_dir)
+    if key not in _parsing_stores:
+        if not (os.path.exists(os.path.join(parsing_dir, LABELS_NPY)) and os.path.exists(os.path.join(parsing_dir, LABELS_JSON))):
+            return None
+        with open(os.path.join(parsing_dir, LABELS_JSON)) as f:
+            meta = json.load(f)
+        _parsing_stores[key] = (np.load(os.path.join(parsing_dir, LABELS_NPY), mmap_mode='r'), meta)
+    return _parsing_stores[key]
+
+
+def read_parsing(parsing_path):
+    """
+    a drop-in replacement of cv2.imread for the parsing maps ({parsing_dir}/{idx}.png), reads from the label store when it exists
+    :return: [H, W, 3], uint8
+    """
+    store = get_parsing_store(os.path.dirname(parsing_path))
+    if store is not None:
+        labels, meta = store
+        idx = int(os.path.basename(parsing_path)[:-4])
+        return colorize_parsing(labels[idx], (meta['W'], meta['H']))
+    return cv2.imread(parsing_path)
+
+
+##############
+# landmark store
+##############
+# ori_imgs/landmarks.npy        [T, 68, 2], float32, the 2D landmarks of each frame (x, y)
+# ori_imgs/landmarks_valid.npy  [T], bool, False if no face is detected in the frame
+LANDMARKS_NPY = 'landmarks.npy'
+LANDMARKS_VALID_NPY = 'landmarks_valid.npy'
+
+
+def save_landmarks(ori_imgs_dir, lms, valid):
+    np.save(os.path.join(ori_imgs_dir, LANDMARKS_NPY), np.asarray(lms, dtype=np.float32))
+    np.save(os.path.join(ori_imgs_dir, LANDMARKS_VALID_NPY), np.asarray(valid, dtype=bool))
+
+
+def convert_lms_dir(ori_imgs_dir, num_frames=None):
+    """
+    one-time conversion of the per-frame ori_imgs/{idx}.lms text files into the landmark store,
+    the frames without a .lms file are invalid
+    """
+    lms_names = glob.glob(os.path.join(ori_imgs_dir, '*.lms'))
+    assert len(lms_names) > 0, f"no .lms files in {ori_imgs_dir}"
+    idxs = [int(os.path.basename(name)[:-4]) for name in lms_names]
+    if num_frames is None:
+        store = get_frame_store(ori_imgs_dir)
+        num_frames = len(store) if store is not None else max(idxs) + 1
+    lms = np.zeros([num_frames, 68, 2], dtype=np.float32)
+    valid = np.zeros([num_frames], dtype=bool)
+    for idx, name in zip(idxs, tqdm.tqdm(lms_names, desc='converting .lms')):
+        lms[idx] = np.loadtxt(name, dtype=np.float32)
+        valid[idx] = True
+    save_landmarks(ori_imgs_dir, lms, valid)
+    print(f'| converted the landmarks of {valid.sum()}/{num_frames} frames to {os.path.join(ori_imgs_dir, LANDMARKS_NPY)}')
+    return lms, valid
+
+
+def load_landmarks(ori_imgs_dir, mmap=True):
+    """
+    the landmark store of ori_imgs_dir, converted from the .lms files if it does not exist yet
+    :return: lms [T, 68, 2] float32 (memory-mapped if mmap), valid [T] bool
+    """
+    lms_name = os.path.join(ori_imgs_dir, LANDMARKS_NPY)
+    valid_name = os.path.join(ori_imgs_dir, LANDMARKS_VALID_NPY)
+    if not (os.path.exists(lms_name) and os.path.exists(valid_name)):
+        return convert_lms_dir(ori_imgs_dir)
+    return np.load(lms_name, mmap_mode='r' if mmap else None), np.load(valid_name)
@@ -1,300 +1,450 @@
 import os
+import sys
 import glob
+import subprocess
 import tqdm
 import json
+import time
 import argparse
 import cv2
 import numpy as np
 
+from data_util.frame_store import build_frame_store, list_frames, read_frame, read_parsing, get_frame_size, save_landmarks, load_landmarks
+
 def extract_audio(path, out_path, sample_rate=16000):
     
     print(f'[INFO] ===== extract audio from {path} to {out_path} =====')
-    cmd = f'ffmpeg -i {path} -f wav -ar {sample_rate} {out_path}'
-    os.system(cmd)
+    cmd = ['ffmpeg', '-i', path, '-f', 'wav', '-ar', str(sample_rate), out_path]
+    subprocess.run(cmd, check=True)
     print(f'[INFO] ===== extracted audio =====')
 
 
-def extract_audio_features(path):
-    print(f'[INFO] ===== extract audio labels for {path} =====')
-
+def extract_esperanto(path):
     print(f'[INFO] ===== start extract esperanto =====')
     # 修改点：去掉之前的 --model checkpoints/esperanto，恢复使用默认的模型名称
     # 这样配合上面的 HF_ENDPOINT 环境变量，它就会自动从镜像站下载模型
-    cmd = f'python data_util/extract_esperanto.py --wav {path} --save_feats'
-    os.system(cmd)
+    cmd = [sys.executable, 'data_util/extract_esperanto.py', '--wav', path, '--save_feats']
+    subprocess.run(cmd, check=True)
     print(f'[INFO] ===== extracted esperanto =====')
 
+
+def extract_deepspeech(path):
     print(f'[INFO] ===== extract deepspeech =====')
-    cmd = f'python data_util/deepspeech_features/extract_ds_features.py --input {path} --output {path.replace(".wav", "_deepspeech.npy")}'
-    os.system(cmd)
+    cmd = [sys.executable, 'data_util/deepspeech_features/extract_ds_features.py', '--input', path, '--output', path.replace(".wav", "_deepspeech.npy")]
+    subprocess.run(cmd, check=True)
     print(f'[INFO] ===== extracted deepspeech =====')
 
+
+def extract_audio_features(path, features=('esperanto', 'deepspeech')):
+    """
+    features: the audio conditions of the NeRFs to extract, each extractor runs in its own process
+    """
+    print(f'[INFO] ===== extract audio labels for {path} =====')
+    if 'esperanto' in features:
+        extract_esperanto(path)
+    if 'deepspeech' in features:
+        extract_deepspeech(path)
     print(f'[INFO] ===== extracted all audio labels =====')
 
 
 def extract_images(path, out_path, fps=25):
 
     print(f'[INFO] ===== extract images from {path} to {out_path} =====')
-    cmd = f'ffmpeg -i {path} -vf fps={fps} -qmin 1 -q:v 1 -start_number 0 {os.path.join(out_path, "%d.jpg")}'
-    os.system(cmd)
+    cmd = ['ffmpeg', '-i', path, '-vf', f'fps={fps}', '-qmin', '1', '-q:v', '1', '-start_number', '0', os.path.join(out_path, "%d.jpg")]
+    subprocess.run(cmd, check=True)
     print(f'[INFO] ===== extracted images =====')
 
 
-def extract_semantics(ori_imgs_dir, parsing_dir):
+def extract_frame_store(path, ori_imgs_dir, fps=25, export_jpg=False):
+    # decode the video once into ori_imgs/frames.npy, the jpgs are only exported for debugging
+    build_frame_store(path, ori_imgs_dir, fps=fps, export_jpg=export_jpg)
 
-    print(f'[INFO] ===== extract semantics from {ori_imgs_dir} to {parsing_dir} =====')
-    cmd = f'python data_util/face_parsing/test.py --respath={parsing_dir} --imgpath={ori_imgs_dir}'
-    os.system(cmd)
-    print(f'[INFO] ===== extracted semantics =====')
 
+def extract_semantics(ori_imgs_dir, parsing_dir, batch_size=8, num_workers=4, save_png=False):
 
-def extract_landmarks(ori_imgs_dir):
+    print(f'[INFO] ===== extract semantics from {ori_imgs_dir} to {parsing_dir} =====')
+    # the labels are saved to parsing/labels.npy, the colored parsing/{idx}.png are optional
+    cmd = [sys.executable, 'data_util/face_parsing/test.py', f'--respath={parsing_dir}', f'--imgpath={ori_imgs_dir}',
+           f'--batch_size={batch_size}', f'--num_workers={num_workers}'] + (['--save_png'] if save_png else [])
+    subprocess.run(cmd, check=True)
+    print(f'[INFO] ===== extracted semantics =====')
 
-    print(f'[INFO] ===== extract face landmarks from {ori_imgs_dir} =====')
 
+def build_face_alignment(device='cpu'):
     import face_alignment
     try:
-        fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, flip_input=False, device='cpu')
+        fa = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, flip_input=False, device=device)
     except AttributeError:
-        fa = face_alignment.FaceAlignment(face_alignment.LandmarksType.TWO_D, flip_input=False, device='cpu')
-        
-    image_paths = glob.glob(os.path.join(ori_imgs_dir, '*.jpg'))
-    for image_path in tqdm.tqdm(image_paths):
-        input = cv2.imread(image_path, cv2.IMREAD_UNCHANGED) # [H, W, 3]
-        input = cv2.cvtColor(input, cv2.COLOR_BGR2RGB)
-        preds = fa.get_landmarks(input)
-        if preds is not None and len(preds) > 0:
-            lands = preds[0].reshape(-1, 2)[:,:2]
-            np.savetxt(image_path.replace('jpg', 'lms'), lands, '%f')
+        fa = face_alignment.FaceAlignment(face_alignment.LandmarksType.TWO_D, flip_input=False, device=device)
+    return fa
+
+
+def _landmarks_in_box(lms, box):
+    # the landmarks of a reused face box are trusted only if they are centered in the box and fill it
+    x1, y1, x2, y2 = box[:4]
+    min_xy, max_xy = lms.min(0), lms.max(0)
+    cx, cy = (min_xy + max_xy) / 2
+    return x1 < cx < x2 and y1 < cy < y2 and (max_xy[0] - min_xy[0]) > 0.3 * (x2 - x1)
+
+
+def _detect_landmarks_chunk(image_paths, device='cpu', cpu_ids=None, redetect_interval=25):
+    """
+    detect the landmarks of consecutive frames with one FaceAlignment instance.
+    The face box of the last detection is reused (shifted by the motion of the landmarks) to skip the
+    face detector on most frames, it is detected again every redetect_interval frames or when the landmarks leave the box.
+    :return: lms [N, 68, 2] float32, valid [N] bool
+    """
+    import torch
+    if cpu_ids is not None:
+        # pin the worker to its own cores, so the workers do not fight for the intra-op threads
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpu_ids)
+        torch.set_num_threads(len(cpu_ids))
+    fa = build_face_alignment(device)
+    lms = np.zeros([len(image_paths), 68, 2], dtype=np.float32)
+    valid = np.zeros([len(image_paths)], dtype=bool)
+    det_box, det_center, num_reused = None, None, 0
+    for i, image_path in enumerate(image_paths):
+        input = cv2.cvtColor(read_frame(image_path), cv2.COLOR_BGR2RGB) # [H, W, 3]
+        preds = None
+        if det_box is not None and num_reused < redetect_interval:
+            box = det_box.copy()
+            box[[0, 2]] += center[0] - det_center[0]
+            box[[1, 3]] += center[1] - det_center[1]
+            preds = fa.get_landmarks(input, detected_faces=[box])
+            if preds is not None and len(preds) > 0 and _landmarks_in_box(preds[0][:, :2], box):
+                num_reused += 1
+            else:
+                preds = None
+        if preds is None:
+            faces = fa.face_detector.detect_from_image(input.copy())
+            if len(faces) == 0:
+                det_box = None
+                continue
+            preds = fa.get_landmarks(input, detected_faces=[faces[0]])
+            if preds is None or len(preds) == 0:
+                det_box = None
+                continue
+            det_box = np.array(faces[0], dtype=np.float32)
+            det_center = preds[0][:, :2].mean(0)
+            num_reused = 0
+        lms[i] = preds[0].reshape(-1, 2)[:, :2]
+        valid[i] = True
+        center = lms[i].mean(0)
+    del fa
+    return lms, valid
+
+
+def _detect_landmarks_batched(image_paths, device='cuda', batch_size=16):
+    """
+    the batched detector path of FaceAlignment.get_landmarks_from_batch, the face detector runs on the whole batch
+    """
+    import torch
+    fa = build_face_alignment(device)
+    lms = np.zeros([len(image_paths), 68, 2], dtype=np.float32)
+    valid = np.zeros([len(image_paths)], dtype=bool)
+    for start in tqdm.trange(0, len(image_paths), batch_size):
+        batch_paths = image_paths[start: start + batch_size]
+        imgs = np.stack([cv2.cvtColor(read_frame(p), cv2.COLOR_BGR2RGB) for p in batch_paths]) # [B, H, W, 3]
+        imgs = torch.from_numpy(imgs).permute(0, 3, 1, 2).float().to(device) # [B, 3, H, W]
+        preds = fa.get_landmarks_from_batch(imgs)
+        for i, pred in enumerate(preds):
+            if pred is not None and len(pred) >= 68:
+                lms[start + i] = pred[:68, :2]
+                valid[start + i] = True
     del fa
-    print(f'[INFO] ===== extracted face landmarks =====')
+    return lms, valid
+
+
+def detect_landmarks(image_paths, device=None, num_workers=None, batch_size=16):
+    """
+    :param image_paths: frame paths, in the temporal order
+    :param num_workers: number of processes of the cpu path, each holds a FaceAlignment instance
+    :return: lms [N, 68, 2] float32, valid [N] bool
+    """
+    import torch
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if device != 'cpu':
+        import face_alignment
+        if hasattr(face_alignment.FaceAlignment, 'get_landmarks_from_batch'):
+            return _detect_landmarks_batched(image_paths, device, batch_size)
+        return _detect_landmarks_chunk(image_paths, device)
+
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    num_cpus = len(cpus)
+    if num_workers is None:
+        num_workers = min(max(1, num_cpus // 4), 8)
+    num_workers = max(1, min(num_workers, len(image_paths)))
+    if num_workers == 1:
+        return _detect_landmarks_chunk(image_paths, device)
+    # consecutive chunks, so that each worker reuses the face boxes of its previous frames
+    chunk_size = (len(image_paths) + num_workers - 1) // num_workers
+    threads_per_worker = max(1, num_cpus // num_workers)
+    args = []
+    for k in range(num_workers):
+        cpu_ids = cpus[k * threads_per_worker: (k + 1) * threads_per_worker] if num_cpus >= num_workers else None
+        args.append((image_paths[k * chunk_size: (k + 1) * chunk_size], device, cpu_ids))
+    import multiprocessing
+    with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+        results = pool.starmap(_detect_landmarks_chunk, args)
+    lms = np.concatenate([r[0] for r in results])
+    valid = np.concatenate([r[1] for r in results])
+    return lms, valid
+
+
+def extract_landmarks(ori_imgs_dir, num_workers=None, save_lms=False):
+    """
+    save the landmarks of all frames into ori_imgs/landmarks.npy ([T, 68, 2], float32)
+    and ori_imgs/landmarks_valid.npy ([T], bool, False if no face is detected), see data_util/frame_store.load_landmarks.
+    save_lms: also save the per-frame ori_imgs/{idx}.lms text files for debugging
+    """
+    print(f'[INFO] ===== extract face landmarks from {ori_imgs_dir} =====')
+
+    image_paths = sorted(list_frames(ori_imgs_dir), key=lambda p: int(os.path.basename(p)[:-4]))
+    t = time.time()
+    lms, valid = detect_landmarks(image_paths, num_workers=num_workers)
+    elapsed = time.time() - t
+    save_landmarks(ori_imgs_dir, lms, valid)
+    if save_lms:
+        for image_path, lands, is_valid in zip(image_paths, lms, valid):
+            if is_valid:
+                np.savetxt(image_path.replace('jpg', 'lms'), lands, '%f')
+    print(f'[INFO] ===== extracted face landmarks of {valid.sum()}/{len(valid)} frames, {len(valid) / elapsed:.1f} frames/s =====')
 
 
 def extract_background(base_dir, ori_imgs_dir):
-    
+    """
+    the background is composed of the pixels that are far away (> 5 pixels) from the foreground in some frame,
+    taken from the frame where it is the farthest, and the remaining holes are filled with the nearest background pixel.
+    Both nearest-foreground queries are euclidean distance transforms (O(HW) per frame), which replace the
+    KD-trees over all H*W pixels and give the same distances; the hole fill may pick another pixel
+    of the same distance on ties.
+    """
     print(f'[INFO] ===== extract background image from {ori_imgs_dir} =====')
 
-    from sklearn.neighbors import NearestNeighbors
+    from scipy.ndimage import distance_transform_edt
 
-    image_paths = glob.glob(os.path.join(ori_imgs_dir, '*.jpg'))
+    image_paths = list_frames(ori_imgs_dir)
     # only use 1/20 image_paths 
     image_paths = image_paths[::20]
     # read one image to get H/W
-    tmp_image = cv2.imread(image_paths[0], cv2.IMREAD_UNCHANGED) # [H, W, 3]
+    tmp_image = read_frame(image_paths[0]) # [H, W, 3]
     h, w = tmp_image.shape[:2]
 
-    # nearest neighbors
-    all_xys = np.mgrid[0:h, 0:w].reshape(2, -1).transpose()
-    distss = []
+    # running max of the distance to the foreground over frames, and the color of the frame with the max distance
+    max_dist = np.full((h, w), -1, dtype=np.float64)
+    bg_img = np.zeros((h, w, 3), dtype=np.uint8)
     for image_path in tqdm.tqdm(image_paths):
-        parse_img = cv2.imread(image_path.replace('ori_imgs', 'parsing').replace('.jpg', '.png'))
+        parse_img = read_parsing(image_path.replace('ori_imgs', 'parsing').replace('.jpg', '.png'))
         bg = (parse_img[..., 0] == 255) & (parse_img[..., 1] == 255) & (parse_img[..., 2] == 255)
-        fg_xys = np.stack(np.nonzero(~bg)).transpose(1, 0)
-        nbrs = NearestNeighbors(n_neighbors=1, algorithm='kd_tree').fit(fg_xys)
-        dists, _ = nbrs.kneighbors(all_xys)
-        distss.append(dists)
-
-    distss = np.stack(distss)
-    max_dist = np.max(distss, 0)
-    max_id = np.argmax(distss, 0)
+        if bg.all():
+            continue # no foreground
+        dist = distance_transform_edt(bg) # distance of each pixel to its nearest foreground pixel
+        # strictly greater, so the first frame wins the ties, as np.argmax does
+        update = dist > max_dist
+        max_dist[update] = dist[update]
+        bg_img[update] = read_frame(image_path)[update]
 
     bc_pixs = max_dist > 5
-    bc_pixs_id = np.nonzero(bc_pixs)
-    bc_ids = max_id[bc_pixs]
-
-    imgs = []
-    num_pixs = distss.shape[1]
-    for image_path in image_paths:
-        img = cv2.imread(image_path)
-        imgs.append(img)
-    imgs = np.stack(imgs).reshape(-1, num_pixs, 3)
-
-    bg_img = np.zeros((h*w, 3), dtype=np.uint8)
-    bg_img[bc_pixs_id, :] = imgs[bc_ids, bc_pixs_id, :]
-    bg_img = bg_img.reshape(h, w, 3)
-
-    max_dist = max_dist.reshape(h, w)
-    bc_pixs = max_dist > 5
-    bg_xys = np.stack(np.nonzero(~bc_pixs)).transpose()
-    fg_xys = np.stack(np.nonzero(bc_pixs)).transpose()
-    nbrs = NearestNeighbors(n_neighbors=1, algorithm='kd_tree').fit(fg_xys)
-    distances, indices = nbrs.kneighbors(bg_xys)
-    bg_fg_xys = fg_xys[indices[:, 0]]
-    bg_img[bg_xys[:, 0], bg_xys[:, 1], :] = bg_img[bg_fg_xys[:, 0], bg_fg_xys[:, 1], :]
+    bg_img[~bc_pixs] = 0
+    # fill the other pixels with their nearest background pixel
+    inds = distance_transform_edt(~bc_pixs, return_distances=False, return_indices=True) # [2, H, W]
+    bg_img = bg_img[inds[0], inds[1]]
 
     cv2.imwrite(os.path.join(base_dir, 'bc.jpg'), bg_img)
 
     print(f'[INFO] ===== extracted background image =====')
 
-def extract_head(base_dir):
-    bg_img = cv2.imread(os.path.join(base_dir, 'bc.jpg'), cv2.IMREAD_UNCHANGED)
-    ori_imgs_dir = os.path.join(base_dir, 'ori_imgs')
-    image_paths = glob.glob(os.path.join(ori_imgs_dir, '*.jpg'))
+def _column_top_pixels(mask):
+    """
+    the top pixel of each column of the mask, i.e., the first pixel of each column after sorting the coords by (column, row).
+    :return: coords [m, 2] of (row, col) in the ascending order of columns, and the number of mask pixels in these columns [m]
+    """
+    cols = np.nonzero(mask.any(0))[0]
+    rows = mask.argmax(0)[cols]
+    return np.stack([rows, cols], axis=-1), mask.sum(0)[cols]
+
+
+_bg_image = None
+
+def _init_synthesis_worker(bg_img_name):
+    # the shared background is loaded once per worker
+    global _bg_image
+    cv2.setNumThreads(1)
+    _bg_image = cv2.imread(bg_img_name, cv2.IMREAD_UNCHANGED)
+
+
+def _synthesize_frame(image_path):
+    """
+    reads the frame and its parsing map once, and saves the head, gt and torso (with alpha) images
+    """
+    from scipy.ndimage import binary_dilation
+    bg_image = _bg_image
+
+    # read ori image
+    ori_image = read_frame(image_path) # [H, W, 3]
+
+    # read semantics
+    seg = read_parsing(image_path.replace('ori_imgs', 'parsing').replace('.jpg', '.png'))
+    head_part = (seg[..., 0] == 255) & (seg[..., 1] == 0) & (seg[..., 2] == 0)
+    neck_part = (seg[..., 0] == 0) & (seg[..., 1] == 255) & (seg[..., 2] == 0)
+    torso_part = (seg[..., 0] == 0) & (seg[..., 1] == 0) & (seg[..., 2] == 255)
+    bg_part = (seg[..., 0] == 255) & (seg[..., 1] == 255) & (seg[..., 2] == 255)
+
+    # get head image
+    head_image = ori_image.copy()
+    head_image[~head_part] = bg_image[~head_part]
+    cv2.imwrite(image_path.replace('ori_imgs', 'head_imgs'), head_image)
+
+    # get gt image
+    gt_image = ori_image.copy()
+    gt_image[bg_part] = bg_image[bg_part]
+    cv2.imwrite(image_path.replace('ori_imgs', 'gt_imgs'), gt_image)
+
+    # get torso image
+    torso_image = gt_image.copy() # rgb
+    torso_image[head_part] = bg_image[head_part]
+    torso_alpha = 255 * np.ones((gt_image.shape[0], gt_image.shape[1], 1), dtype=np.uint8) # alpha
     
-    print(f'[INFO] ===== extract head images for {base_dir} =====')
-
-    for image_path in tqdm.tqdm(image_paths):    
-        # read ori image
-        img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED) # [H, W, 3]
-
-        # read semantics
-        parsing_img = cv2.imread(image_path.replace('ori_imgs', 'parsing').replace('.jpg', '.png'))
-
-        head_part = (parsing_img[:, :, 0] == 255) & (
-            parsing_img[:, :, 1] == 0) & (parsing_img[:, :, 2] == 0)
-        img[~head_part] = bg_img[~head_part]
-        cv2.imwrite(image_path.replace('ori_imgs', 'head_imgs'), img)
-    print(f'[INFO] ===== extracted head images =====')
-
-
-def extract_torso_and_gt(base_dir, ori_imgs_dir):
-
-    print(f'[INFO] ===== extract torso and gt images for {base_dir} =====')
-
-    from scipy.ndimage import binary_erosion, binary_dilation
-
-    # load bg
-    bg_image = cv2.imread(os.path.join(base_dir, 'bc.jpg'), cv2.IMREAD_UNCHANGED)
-    
-    image_paths = glob.glob(os.path.join(ori_imgs_dir, '*.jpg'))
-
-    for image_path in tqdm.tqdm(image_paths):
-        # read ori image
-        ori_image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED) # [H, W, 3]
-
-        # read semantics
-        seg = cv2.imread(image_path.replace('ori_imgs', 'parsing').replace('.jpg', '.png'))
-        head_part = (seg[..., 0] == 255) & (seg[..., 1] == 0) & (seg[..., 2] == 0)
-        neck_part = (seg[..., 0] == 0) & (seg[..., 1] == 255) & (seg[..., 2] == 0)
-        torso_part = (seg[..., 0] == 0) & (seg[..., 1] == 0) & (seg[..., 2] == 255)
-        bg_part = (seg[..., 0] == 255) & (seg[..., 1] == 255) & (seg[..., 2] == 255)
-
-        # get gt image
-        gt_image = ori_image.copy()
-        gt_image[bg_part] = bg_image[bg_part]
-        cv2.imwrite(image_path.replace('ori_imgs', 'gt_imgs'), gt_image)
-
-        # get torso image
-        torso_image = gt_image.copy() # rgb
-        torso_image[head_part] = bg_image[head_part]
-        torso_alpha = 255 * np.ones((gt_image.shape[0], gt_image.shape[1], 1), dtype=np.uint8) # alpha
-        
-        # torso part "vertical" in-painting...
-        L = 8 + 1
-        torso_coords = np.stack(np.nonzero(torso_part), axis=-1) # [M, 2]
-        # lexsort: sort 2D coords first by y then by x, 
-        # ref: https://stackoverflow.com/questions/2706605/sorting-a-2d-numpy-array-by-multiple-axes
-        inds = np.lexsort((torso_coords[:, 0], torso_coords[:, 1]))
-        torso_coords = torso_coords[inds]
-        # choose the top pixel for each column
-        u, uid, ucnt = np.unique(torso_coords[:, 1], return_index=True, return_counts=True)
-        top_torso_coords = torso_coords[uid] # [m, 2]
-        # only keep top-is-head pixels
-        top_torso_coords_up = top_torso_coords.copy() - np.array([1, 0])
-        mask = head_part[tuple(top_torso_coords_up.T)] 
-        if mask.any():
-            top_torso_coords = top_torso_coords[mask]
-            # get the color
-            top_torso_colors = gt_image[tuple(top_torso_coords.T)] # [m, 3]
-            # construct inpaint coords (vertically up, or minus in x)
-            inpaint_torso_coords = top_torso_coords[None].repeat(L, 0) # [L, m, 2]
-            inpaint_offsets = np.stack([-np.arange(L), np.zeros(L, dtype=np.int32)], axis=-1)[:, None] # [L, 1, 2]
-            inpaint_torso_coords += inpaint_offsets
-            inpaint_torso_coords = inpaint_torso_coords.reshape(-1, 2) # [Lm, 2]
-            inpaint_torso_colors = top_torso_colors[None].repeat(L, 0) # [L, m, 3]
-            darken_scaler = 0.98 ** np.arange(L).reshape(L, 1, 1) # [L, 1, 1]
-            inpaint_torso_colors = (inpaint_torso_colors * darken_scaler).reshape(-1, 3) # [Lm, 3]
-            # set color
-            torso_image[tuple(inpaint_torso_coords.T)] = inpaint_torso_colors
-
-            inpaint_torso_mask = np.zeros_like(torso_image[..., 0]).astype(bool)
-            inpaint_torso_mask[tuple(inpaint_torso_coords.T)] = True
-        else:
-            inpaint_torso_mask = None
-            
-
-        # neck part "vertical" in-painting...
-        push_down = 4
-        L = 48 + push_down + 1
-
-        neck_part = binary_dilation(neck_part, structure=np.array([[0, 1, 0], [0, 1, 0], [0, 1, 0]], dtype=bool), iterations=3)
-
-        neck_coords = np.stack(np.nonzero(neck_part), axis=-1) # [M, 2]
-        # lexsort: sort 2D coords first by y then by x, 
-        # ref: https://stackoverflow.com/questions/2706605/sorting-a-2d-numpy-array-by-multiple-axes
-        inds = np.lexsort((neck_coords[:, 0], neck_coords[:, 1]))
-        neck_coords = neck_coords[inds]
-        # choose the top pixel for each column
-        u, uid, ucnt = np.unique(neck_coords[:, 1], return_index=True, return_counts=True)
-        top_neck_coords = neck_coords[uid] # [m, 2]
-        # only keep top-is-head pixels
-        top_neck_coords_up = top_neck_coords.copy() - np.array([1, 0])
-        mask = head_part[tuple(top_neck_coords_up.T)] 
-        
-        top_neck_coords = top_neck_coords[mask]
-        # push these top down for 4 pixels to make the neck inpainting more natural...
-        offset_down = np.minimum(ucnt[mask] - 1, push_down)
-        top_neck_coords += np.stack([offset_down, np.zeros_like(offset_down)], axis=-1)
+    # torso part "vertical" in-painting...
+    L = 8 + 1
+    # choose the top pixel for each column
+    top_torso_coords, _ = _column_top_pixels(torso_part) # [m, 2]
+    # only keep top-is-head pixels
+    top_torso_coords_up = top_torso_coords.copy() - np.array([1, 0])
+    mask = head_part[tuple(top_torso_coords_up.T)] 
+    if mask.any():
+        top_torso_coords = top_torso_coords[mask]
         # get the color
-        top_neck_colors = gt_image[tuple(top_neck_coords.T)] # [m, 3]
+        top_torso_colors = gt_image[tuple(top_torso_coords.T)] # [m, 3]
         # construct inpaint coords (vertically up, or minus in x)
-        inpaint_neck_coords = top_neck_coords[None].repeat(L, 0) # [L, m, 2]
+        inpaint_torso_coords = top_torso_coords[None].repeat(L, 0) # [L, m, 2]
         inpaint_offsets = np.stack([-np.arange(L), np.zeros(L, dtype=np.int32)], axis=-1)[:, None] # [L, 1, 2]
-        inpaint_neck_coords += inpaint_offsets
-        inpaint_neck_coords = inpaint_neck_coords.reshape(-1, 2) # [Lm, 2]
-        inpaint_neck_colors = top_neck_colors[None].repeat(L, 0) # [L, m, 3]
+        inpaint_torso_coords += inpaint_offsets
+        inpaint_torso_coords = inpaint_torso_coords.reshape(-1, 2) # [Lm, 2]
+        inpaint_torso_colors = top_torso_colors[None].repeat(L, 0) # [L, m, 3]
         darken_scaler = 0.98 ** np.arange(L).reshape(L, 1, 1) # [L, 1, 1]
-        inpaint_neck_colors = (inpaint_neck_colors * darken_scaler).reshape(-1, 3) # [Lm, 3]
+        inpaint_torso_colors = (inpaint_torso_colors * darken_scaler).reshape(-1, 3) # [Lm, 3]
         # set color
-        torso_image[tuple(inpaint_neck_coords.T)] = inpaint_neck_colors
-
-        # apply blurring to the inpaint area to avoid vertical-line artifects...
-        inpaint_mask = np.zeros_like(torso_image[..., 0]).astype(bool)
-        inpaint_mask[tuple(inpaint_neck_coords.T)] = True
+        torso_image[tuple(inpaint_torso_coords.T)] = inpaint_torso_colors
 
-        blur_img = torso_image.copy()
-        blur_img = cv2.GaussianBlur(blur_img, (5, 5), cv2.BORDER_DEFAULT)
-
-        torso_image[inpaint_mask] = blur_img[inpaint_mask]
+        inpaint_torso_mask = np.zeros_like(torso_image[..., 0]).astype(bool)
+        inpaint_torso_mask[tuple(inpaint_torso_coords.T)] = True
+    else:
+        inpaint_torso_mask = None
+        
 
-        # set mask
-        mask = (neck_part | torso_part | inpaint_mask)
-        if inpaint_torso_mask is not None:
-            mask = mask | inpaint_torso_mask
-        torso_image[~mask] = 0
-        torso_alpha[~mask] = 0
+    # neck part "vertical" in-painting...
+    push_down = 4
+    L = 48 + push_down + 1
 
-        cv2.imwrite(image_path.replace('ori_imgs', 'torso_imgs').replace('.jpg', '.png'), np.concatenate([torso_image, torso_alpha], axis=-1))
+    neck_part = binary_dilation(neck_part, structure=np.array([[0, 1, 0], [0, 1, 0], [0, 1, 0]], dtype=bool), iterations=3)
 
-    print(f'[INFO] ===== extracted torso and gt images =====')
+    # choose the top pixel for each column
+    top_neck_coords, ucnt = _column_top_pixels(neck_part) # [m, 2]
+    # only keep top-is-head pixels
+    top_neck_coords_up = top_neck_coords.copy() - np.array([1, 0])
+    mask = head_part[tuple(top_neck_coords_up.T)] 
+    
+    top_neck_coords = top_neck_coords[mask]
+    # push these top down for 4 pixels to make the neck inpainting more natural...
+    offset_down = np.minimum(ucnt[mask] - 1, push_down)
+    top_neck_coords += np.stack([offset_down, np.zeros_like(offset_down)], axis=-1)
+    # get the color
+    top_neck_colors = gt_image[tuple(top_neck_coords.T)] # [m, 3]
+    # construct inpaint coords (vertically up, or minus in x)
+    inpaint_neck_coords = top_neck_coords[None].repeat(L, 0) # [L, m, 2]
+    inpaint_offsets = np.stack([-np.arange(L), np.zeros(L, dtype=np.int32)], axis=-1)[:, None] # [L, 1, 2]
+    inpaint_neck_coords += inpaint_offsets
+    inpaint_neck_coords = inpaint_neck_coords.reshape(-1, 2) # [Lm, 2]
+    inpaint_neck_colors = top_neck_colors[None].repeat(L, 0) # [L, m, 3]
+    darken_scaler = 0.98 ** np.arange(L).reshape(L, 1, 1) # [L, 1, 1]
+    inpaint_neck_colors = (inpaint_neck_colors * darken_scaler).reshape(-1, 3) # [Lm, 3]
+    # set color
+    torso_image[tuple(inpaint_neck_coords.T)] = inpaint_neck_colors
+
+    # apply blurring to the inpaint area to avoid vertical-line artifects...
+    inpaint_mask = np.zeros_like(torso_image[..., 0]).astype(bool)
+    inpaint_mask[tuple(inpaint_neck_coords.T)] = True
+
+    blur_img = torso_image.copy()
+    blur_img = cv2.GaussianBlur(blur_img, (5, 5), cv2.BORDER_DEFAULT)
+
+    torso_image[inpaint_mask] = blur_img[inpaint_mask]
+
+    # set mask
+    mask = (neck_part | torso_part | inpaint_mask)
+    if inpaint_torso_mask is not None:
+        mask = mask | inpaint_torso_mask
+    torso_image[~mask] = 0
+    torso_alpha[~mask] = 0
+
+    cv2.imwrite(image_path.replace('ori_imgs', 'torso_imgs').replace('.jpg', '.png'), np.concatenate([torso_image, torso_alpha], axis=-1))
+
+
+def extract_head_torso_and_gt(base_dir, ori_imgs_dir, num_workers=None):
+    """
+    synthesize the head, gt and torso images of all frames in a single pass, in a process pool.
+    """
+    print(f'[INFO] ===== extract head, torso and gt images for {base_dir} =====')
+
+    bg_img_name = os.path.join(base_dir, 'bc.jpg')
+    image_paths = list_frames(ori_imgs_dir)
+    if num_workers is None:
+        num_workers = min(os.cpu_count() or 1, 16)
+    if num_workers <= 1:
+        _init_synthesis_worker(bg_img_name)
+        for image_path in tqdm.tqdm(image_paths):
+            _synthesize_frame(image_path)
+    else:
+        import multiprocessing
+        with multiprocessing.get_context('spawn').Pool(num_workers, initializer=_init_synthesis_worker, initargs=(bg_img_name,)) as pool:
+            for _ in tqdm.tqdm(pool.imap_unordered(_synthesize_frame, image_paths, chunksize=16), total=len(image_paths)):
+                pass
+
+    print(f'[INFO] ===== extracted head, torso and gt images =====')
 
 
 def face_tracking(video_id, ori_imgs_dir):
 
     print(f'[INFO] ===== perform face tracking =====')
 
-    image_paths = glob.glob(os.path.join(ori_imgs_dir, '*.jpg'))
-    # read one image to get H/W
-    tmp_image = cv2.imread(image_paths[0], cv2.IMREAD_UNCHANGED) # [H, W, 3]
-    h, w = tmp_image.shape[:2]
+    num_frames, h, w = get_frame_size(ori_imgs_dir)
 
-    cmd = f'python data_util/face_tracking/face_tracker.py --idname={video_id} --img_h={h} --img_w={w} --frame_num={len(image_paths)}'
+    cmd = [sys.executable, 'data_util/face_tracking/face_tracker.py', f'--idname={video_id}', f'--img_h={h}', f'--img_w={w}', f'--frame_num={num_frames}']
 
-    os.system(cmd)
+    subprocess.run(cmd, check=True)
 
     print(f'[INFO] ===== finished face tracking =====')
 
 
+def get_face_rects(lms, h, w):
+    """
+    the face rects of all frames at once
+    :param lms: [T, 68, 2] landmarks
+    :return: [T, 4] int32, (x, y, w, h)
+    """
+    lms = np.asarray(lms, dtype=np.float64)
+    min_x, max_x = lms[:, :, 0].min(1), lms[:, :, 0].max(1)
+    # astype truncates toward zero, the same as int()
+    cx = ((min_x + max_x) / 2.0).astype(np.int64)
+    cy = lms[:, 27, 1].astype(np.int64)
+    h_w = ((max_x - cx) * 1.5).astype(np.int64)
+    h_h = ((lms[:, 8, 1] - cy) * 1.15).astype(np.int64)
+    rect_x = np.maximum(cx - h_w, 0)
+    rect_y = np.maximum(cy - h_h, 0)
+    rect_w = np.minimum(w - 1 - rect_x, 2 * h_w)
+    rect_h = np.minimum(h - 1 - rect_y, 2 * h_h)
+    return np.stack([rect_x, rect_y, rect_w, rect_h], axis=1).astype(np.int32)
+
+
 def save_transforms(base_dir, ori_imgs_dir):
     print(f'[INFO] ===== save transforms =====')
 
     import torch
 
-    image_paths = glob.glob(os.path.join(ori_imgs_dir, '*.jpg'))
-    
-    # read one image to get H/W
-    tmp_image = cv2.imread(image_paths[0], cv2.IMREAD_UNCHANGED) # [H, W, 3]
-    h, w = tmp_image.shape[:2]
+    _, h, w = get_frame_size(ori_imgs_dir)
 
     params_dict = torch.load(os.path.join(base_dir, 'track_params.pt'), map_location='cpu')
     focal_len = params_dict['focal']
@@ -342,6 +492,8 @@ def save_transforms(base_dir, ori_imgs_dir):
     save_ids = ['train', 'val']
     train_val_ids = [train_ids, val_ids]
     mean_z = -float(torch.mean(trans[:, 2]).item())
+    lms, _ = load_landmarks(ori_imgs_dir)
+    face_rects = get_face_rects(lms[:valid_num], h, w)
 
     for split in range(2):
         transform_dict = dict()
@@ -363,22 +515,7 @@ def save_transforms(base_dir, ori_imgs_dir):
 
             frame_dict['transform_matrix'] = pose.numpy().tolist()
 
-            lms = np.loadtxt(os.path.join(ori_imgs_dir, str(i) + '.lms'))
-            min_x, max_x = np.min(lms, 0)[0], np.max(lms, 0)[0]
-            cx = int((min_x+max_x)/2.0)
-            cy = int(lms[27, 1])
-            h_w = int((max_x-cx)*1.5)
-            h_h = int((lms[8, 1]-cy)*1.15)
-            rect_x = cx - h_w
-            rect_y = cy - h_h
-            if rect_x < 0:
-                rect_x = 0
-            if rect_y < 0:
-                rect_y = 0
-            rect_w = min(w-1-rect_x, 2*h_w)
-            rect_h = min(h-1-rect_y, 2*h_h)
-            rect = np.array((rect_x, rect_y, rect_w, rect_h), dtype=np.int32)
-            frame_dict['face_rect'] = rect.tolist()
+            frame_dict['face_rect'] = face_rects[i].tolist()
             
             transform_dict['frames'].append(frame_dict)
 
@@ -392,6 +529,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--video_id', type=str, default='May', help="data/raw/<video_id>.mp4")
     parser.add_argument('--task', type=int, default=-1, help="-1 means all")
+    parser.add_argument('--export_jpg', action='store_true', help="also export ori_imgs/{idx}.jpg from the frame store and the colored parsing/{idx}.png")
 
     opt = parser.parse_args()
 
@@ -421,13 +559,13 @@ if __name__ == '__main__':
     if opt.task == -1 or opt.task == 2:
         extract_audio_features(wav_path)
 
-    # extract images
+    # extract images into the frame store
     if opt.task == -1 or opt.task == 3:
-        extract_images(video_path, ori_imgs_dir)
+        extract_frame_store(video_path, ori_imgs_dir, export_jpg=opt.export_jpg)
 
     # face parsing
     if opt.task == -1 or opt.task == 4:
-        extract_semantics(ori_imgs_dir, parsing_dir)
+        extract_semantics(ori_imgs_dir, parsing_dir, save_png=opt.export_jpg)
 
     # extract bg
     if opt.task == -1 or opt.task == 5:
@@ -435,8 +573,7 @@ if __name__ == '__main__':
 
     # extract torso images and gt_images
     if opt.task == -1 or opt.task == 6:
-        extract_head(processed_dir)
-        extract_torso_and_gt(processed_dir, ori_imgs_dir)
+        extract_head_torso_and_gt(processed_dir, ori_imgs_dir)
 
     # extract face landmarks
     if opt.task == -1 or opt.task == 7:
@@ -19,7 +19,22 @@ from utils.commons.tensor_utils import convert_to_tensor, convert_to_np
 
 with open("deep_3drecon/reconstructor_opt.pkl", "rb") as f:
     opt = pkl.load(f) 
-    
+
+
+def align_frame(im, lm5, lm3d_std):
+    """
+    the alignment of preprocess_data without the model, so it can run in the worker processes
+    im: [H, W, 3] uint8 rgb
+    lm5: [5, 2], NOTE: its y direction is flipped in place, as preprocess_data always did
+    return: the aligned [224, 224, 3] uint8 image and the aligned [5, 2] landmarks
+    """
+    H,W,_ = im.shape
+    lm = lm5.reshape([-1, 2])
+    lm[:, -1] = H - 1 - lm[:, -1]
+    _, im, lm, _ = align_img(Image.fromarray(convert_to_np(im)), convert_to_np(lm), convert_to_np(lm3d_std))
+    return np.array(im), lm
+
+
 class Reconstructor(nn.Module):
     def __init__(self):
         super().__init__()
@@ -33,12 +48,8 @@ class Reconstructor(nn.Module):
     
     def preprocess_data(self, im, lm, lm3d_std):
         # to RGB 
-        H,W,_ = im.shape
-        lm = lm.reshape([-1, 2])
-        lm[:, -1] = H - 1 - lm[:, -1]
-
-        _, im, lm, _ = align_img(Image.fromarray(convert_to_np(im)), convert_to_np(lm), convert_to_np(lm3d_std))
-        im = torch.tensor(np.array(im)/255., dtype=torch.float32).permute(2, 0, 1).unsqueeze(0)
+        im, lm = align_frame(im, lm, lm3d_std)
+        im = torch.tensor(im/255., dtype=torch.float32).permute(2, 0, 1).unsqueeze(0)
         lm = torch.tensor(lm).unsqueeze(0)
         return im, lm
     
@@ -81,6 +92,19 @@ class Reconstructor(nn.Module):
             batch_align_img = (imgs.permute(0,2,3,1)*255).int().numpy().astype(np.uint8)
         return batch_coeff, batch_align_img
     
+    @torch.no_grad()
+    def recon_coeff_aligned(self, align_imgs, align_lms):
+        """
+        the batched forward of recon_coeff on frames already aligned by align_frame
+        align_imgs: [B, 224, 224, 3] uint8
+        align_lms: [B, 5, 2]
+        """
+        imgs = torch.tensor(align_imgs/255., dtype=torch.float32).permute(0, 3, 1, 2)
+        lms = torch.tensor(align_lms)
+        self.model.set_input({'imgs': imgs, 'lms': lms})
+        self.model.forward()
+        return self.model.output_coeff.cpu().numpy()
+
     # todo: batch-wise recon!
         
     def forward(self, batched_images, batched_lm5, return_image=True):
@@ -8,6 +8,7 @@ import tqdm
 from utils.commons.tensor_utils import move_to_cuda
 from utils.commons.ckpt_utils import load_ckpt, get_last_checkpoint
 from utils.commons.hparams import hparams, set_hparams
+from utils.nn.precision_utils import infer_autocast, quantize_dynamic_int8
 
 
 class Audio2MotionInfer:
@@ -20,6 +21,12 @@ class Audio2MotionInfer:
         self.audio2motion_task = self.build_audio2motion_task()
         self.audio2motion_task.eval()
         self.audio2motion_task.to(self.device)
+        # precision policy of cpu inference, see utils/nn/precision_utils.py
+        self.infer_cpu_precision = hparams.get('infer_cpu_precision', 'fp32')
+        if self.device == 'cpu' and hparams.get('infer_cpu_int8', False):
+            self.audio2motion_task.model = quantize_dynamic_int8(self.audio2motion_task.model)
+            self.infer_cpu_precision = 'fp32'
+            print("| Audio2motion model is quantized to int8.")
         
     def build_audio2motion_task(self):
         assert hparams['task_cls'] != ''
@@ -91,8 +98,9 @@ class Audio2MotionInfer:
                 if self.device == 'cuda':
                     batch = move_to_cuda(batch)
 
-                model_out = self.audio2motion_task.run_model(batch, infer=True)
-                pred = model_out['pred'].squeeze().cpu().numpy()
+                with infer_autocast(self.device, self.infer_cpu_precision):
+                    model_out = self.audio2motion_task.run_model(batch, infer=True)
+                pred = model_out['pred'].squeeze().float().cpu().numpy()
                 pred_lst.append(pred)
         np.save(inp['out_npy_name'], pred_lst)
         return inp['out_npy_name']
@@ -2,7 +2,7 @@ import os
 import numpy as np
 import torch
 from inference.nerfs.base_nerf_infer import BaseNeRFInfer
-from data_gen.nerf.binarizer import get_win_conds
+from utils.commons.window_utils import get_wins
 
 
 class AdNeRFInfer(BaseNeRFInfer):
@@ -29,10 +29,12 @@ class AdNeRFInfer(BaseNeRFInfer):
             deepspeech_arr = np.load(deepspeech_name) # [T, w=16, c=29]
         
         num_samples = min(len(deepspeech_arr), self.infer_max_length)
+        deepspeech_arr = torch.from_numpy(deepspeech_arr).float()
+        deepspeech_wins = get_wins(deepspeech_arr, 8)[:num_samples].contiguous() # the windows of all frames at once, [T, W=8, w=16, C=29]
         samples = [{} for _ in range(num_samples)]
         for idx, sample in enumerate(samples):
-            sample['cond_win'] = torch.from_numpy(deepspeech_arr[idx]).float().unsqueeze(0) # [B=1, w=16, C=29]
-            sample['cond_wins'] = torch.from_numpy(get_win_conds(deepspeech_arr, idx, smo_win_size=8)).float() #.unsqueeze(0) # [B=1,W=8, w=16, C=29]
+            sample['cond_win'] = deepspeech_arr[idx].unsqueeze(0) # [B=1, w=16, C=29]
+            sample['cond_wins'] = deepspeech_wins[idx] #.unsqueeze(0) # [B=1,W=8, w=16, C=29]
         return samples
 
 if __name__ == '__main__':
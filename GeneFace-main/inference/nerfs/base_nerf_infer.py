@@ -17,6 +17,8 @@ from utils.commons.hparams import hparams, set_hparams
 from utils.commons.ckpt_utils import load_ckpt, get_last_checkpoint
 from utils.commons.euler2rot import euler_trans_2_c2w, c2w_to_euler_trans
 from utils.commons.tensor_utils import move_to_cpu, move_to_cuda, convert_to_tensor
+from utils.commons.meters import InferProfiler
+from utils.nn.precision_utils import infer_autocast
 
 from tasks.nerfs.dataset_utils import NeRFDataset
 from scipy.ndimage import gaussian_filter1d
@@ -53,6 +55,10 @@ class BaseNeRFInfer:
         self.hparams = hparams
         self.infer_max_length = hparams.get('infer_max_length', 500000) # default render 10 seconds long
         self.device = device
+        self.infer_cpu_precision = hparams.get('infer_cpu_precision', 'fp32') # fp32 | bf16, only applies to cpu inference
+        self.profiler = InferProfiler(enable=hparams.get('infer_profile', False),
+                                      torch_profile_start=hparams.get('infer_profile_torch_start', 0),
+                                      torch_profile_frames=hparams.get('infer_profile_torch_frames', 0))
         self.dataset_cls = NeRFDataset # the dataset only provides head pose 
         self.dataset = self.dataset_cls('trainval')
 
@@ -84,28 +90,108 @@ class BaseNeRFInfer:
         H, W = batches[0]['H'], batches[0]['W']
         H = int(hparams['infer_scale_factor']*H)
         W = int(hparams['infer_scale_factor']*W)
+        num_frames_per_batch = self.get_infer_frames_per_batch(H, W)
+        if num_frames_per_batch > 1:
+            return self._forward_nerf_task_multi_frames(batches, num_frames_per_batch)
         idx_batch_lst = [(idx, batch) for idx,batch in enumerate(batches)]
+        profiler = self.profiler
+        self.enable_march_stats()
 
         print(f"The tmp imge dir is {tmp_imgs_dir}.")
         with torch.no_grad():
             for (idx, batch) in tqdm.tqdm(idx_batch_lst, total=len(idx_batch_lst),
                                 desc=f"NeRF is rendering frames..."):
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-                if self.device == 'cuda':
-                    batch = move_to_cuda(batch)
-                model_out = self.nerf_task.run_model(batch, infer=True)
-                pred_rgb = model_out['rgb_map'] * 255
-                pred_img = pred_rgb.view([H, W, 3]).cpu().numpy().astype(np.uint8)
+                profiler.step(idx)
+                with profiler.stage('empty_cache'):
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+                with profiler.stage('move_to_cuda'):
+                    if self.device == 'cuda':
+                        batch = move_to_cuda(batch)
+                with profiler.stage('run_model'):
+                    with infer_autocast(self.device, self.infer_cpu_precision):
+                        model_out = self.nerf_task.run_model(batch, infer=True)
+                with profiler.stage('to_numpy'):
+                    pred_rgb = model_out['rgb_map'].float() * 255
+                    pred_img = pred_rgb.view([H, W, 3]).cpu().numpy().astype(np.uint8)
                 out_name = os.path.join(tmp_imgs_dir, format(idx, '05d')+".png")
-                bgr_img = cv2.cvtColor(pred_img, cv2.COLOR_RGB2BGR)
-                cv2.imwrite(out_name, bgr_img)
-                batches[idx] = move_to_cpu(batch)
-                for k in list(batch.keys()):
-                    del batch[k]
-                torch.cuda.empty_cache()
+                with profiler.stage('cvtColor'):
+                    bgr_img = cv2.cvtColor(pred_img, cv2.COLOR_RGB2BGR)
+                with profiler.stage('imwrite'):
+                    cv2.imwrite(out_name, bgr_img)
+                with profiler.stage('move_to_cpu'):
+                    batches[idx] = move_to_cpu(batch)
+                    for k in list(batch.keys()):
+                        del batch[k]
+                with profiler.stage('empty_cache'):
+                    torch.cuda.empty_cache()
+        profiler.stop_torch_profile()
+        self.collect_march_stats()
         return tmp_imgs_dir
 
+    def get_infer_frames_per_batch(self, H, W):
+        """
+        the number of frames that are rendered together by self.nerf_task.run_model_batch
+        """
+        return 1
+
+    def _forward_nerf_task_multi_frames(self, batches, num_frames_per_batch):
+        tmp_imgs_dir = self.inp['tmp_imgs_dir']
+        H, W = batches[0]['H'], batches[0]['W']
+        H = int(hparams['infer_scale_factor']*H)
+        W = int(hparams['infer_scale_factor']*W)
+        start_idx_lst = list(range(0, len(batches), num_frames_per_batch))
+        profiler = self.profiler
+        self.enable_march_stats()
+
+        print(f"The tmp imge dir is {tmp_imgs_dir}.")
+        print(f"NeRF renders {num_frames_per_batch} frames in each batch.")
+        with torch.no_grad():
+            for start_idx in tqdm.tqdm(start_idx_lst, total=len(start_idx_lst),
+                                desc=f"NeRF is rendering frames..."):
+                profiler.step(start_idx)
+                with profiler.stage('empty_cache'):
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+                frame_batches = batches[start_idx: start_idx + num_frames_per_batch]
+                with profiler.stage('move_to_cuda'):
+                    if self.device == 'cuda':
+                        frame_batches = [move_to_cuda(batch) for batch in frame_batches]
+                with profiler.stage('run_model'):
+                    with infer_autocast(self.device, self.infer_cpu_precision):
+                        model_out = self.nerf_task.run_model_batch(frame_batches)
+                with profiler.stage('to_numpy'):
+                    pred_rgb = model_out['rgb_map'].float() * 255
+                    pred_imgs = pred_rgb.view([-1, H, W, 3]).cpu().numpy().astype(np.uint8)
+                for i, pred_img in enumerate(pred_imgs):
+                    idx = start_idx + i
+                    out_name = os.path.join(tmp_imgs_dir, format(idx, '05d')+".png")
+                    with profiler.stage('cvtColor'):
+                        bgr_img = cv2.cvtColor(pred_img, cv2.COLOR_RGB2BGR)
+                    with profiler.stage('imwrite'):
+                        cv2.imwrite(out_name, bgr_img)
+                with profiler.stage('move_to_cpu'):
+                    for i, batch in enumerate(frame_batches):
+                        batches[start_idx + i] = move_to_cpu(batch)
+                    for batch in frame_batches:
+                        for k in list(batch.keys()):
+                            del batch[k]
+                with profiler.stage('empty_cache'):
+                    torch.cuda.empty_cache()
+        profiler.stop_torch_profile()
+        self.collect_march_stats()
+        return tmp_imgs_dir
+
+    def enable_march_stats(self):
+        # let the renderer count the rays/samples of its march loop
+        if self.profiler.enable and hasattr(self.nerf_task.model, 'infer_stats'):
+            self.nerf_task.model.infer_stats = {}
+
+    def collect_march_stats(self):
+        if self.profiler.enable and getattr(self.nerf_task.model, 'infer_stats', None) is not None:
+            self.profiler.add_counters(self.nerf_task.model.infer_stats)
+            self.nerf_task.model.infer_stats = None
+
     def init_ddp_connection(self, proc_rank, world_size):
         root_node = '127.0.0.1'
         root_node = self.resolve_root_node_address(root_node)
@@ -187,9 +273,10 @@ class BaseNeRFInfer:
             mp.spawn(self._forward_nerf_task_ddp, nprocs=self.num_gpus, args=[batches, copy.deepcopy(hparams)])
             img_dir = self.inp['tmp_imgs_dir']
         else:
-            self.nerf_task = self.build_nerf_task()
-            self.nerf_task.eval()
-            self.nerf_task.to(self.device)
+            with self.profiler.stage('build_nerf_task'):
+                self.nerf_task = self.build_nerf_task()
+                self.nerf_task.eval()
+                self.nerf_task.to(self.device)
             img_dir = self._forward_nerf_task_single_process(batches)
         return img_dir
 
@@ -256,18 +343,48 @@ class BaseNeRFInfer:
     def postprocess_output(self, output):
         tmp_imgs_dir = self.inp['tmp_imgs_dir']
         out_video_name = self.inp['out_video_name']
-        self.save_mp4(tmp_imgs_dir, self.wav16k_name, out_video_name) 
+        with self.profiler.stage('ffmpeg'):
+            self.save_mp4(tmp_imgs_dir, self.wav16k_name, out_video_name) 
         return out_video_name
 
     def infer_once(self, inp):
         self.inp = inp
         self.use_pred_pose = True if self.inp.get('c2w_name','') != '' else False
-        samples = self.get_cond_from_input(inp)
-        batches = self.get_pose_from_ds(samples)
-        image_dir = self.forward_system(batches)
+        with self.profiler.stage('get_cond_from_input'):
+            samples = self.get_cond_from_input(inp)
+        with self.profiler.stage('get_pose_from_ds'):
+            batches = self.get_pose_from_ds(samples)
+        num_frames, H, W = len(batches), batches[0]['H'], batches[0]['W']
+        with self.profiler.stage('forward_system'):
+            image_dir = self.forward_system(batches)
         if self.proc_rank == 0:
             out_name = self.postprocess_output(image_dir)
             print(f"The synthesized video is saved at {out_name}")
+            self.save_profile(num_frames, H, W)
+
+    def save_profile(self, num_frames, H, W):
+        """
+        save the report of hparams['infer_profile'] next to the output video, i.e., {out_video_name}_profile.json
+        """
+        if not self.profiler.enable:
+            return
+        summary = self.profiler.summary()
+        render_time = summary['stages'].get('forward_system', {}).get('total', 0)
+        counters = summary['counters']
+        meta = {
+            'out_video_name': self.inp['out_video_name'],
+            'device': self.device,
+            'infer_cpu_precision': self.infer_cpu_precision,
+            'num_frames': num_frames,
+            'H': int(hparams['infer_scale_factor']*H),
+            'W': int(hparams['infer_scale_factor']*W),
+            'render_fps': num_frames / render_time if render_time > 0 else None,
+            'samples_per_ray': counters['num_samples'] / counters['num_rays'] if counters.get('num_rays', 0) > 0 else None,
+        }
+        if self.use_ddp:
+            meta['note'] = 'the per-frame stages are not recorded in the ddp mode'
+        profile_name = os.path.splitext(self.inp['out_video_name'])[0] + '_profile.json'
+        self.profiler.save(profile_name, meta)
 
     @classmethod
     def example_run(cls, inp=None):
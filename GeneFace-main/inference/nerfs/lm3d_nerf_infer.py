@@ -13,6 +13,7 @@ from utils.commons.ckpt_utils import load_ckpt
 from utils.commons.hparams import hparams, set_hparams
 from utils.commons.tensor_utils import move_to_cuda, convert_to_tensor, convert_to_np
 from utils.commons.euler2rot import euler_trans_2_c2w, c2w_to_euler_trans
+from utils.commons.window_utils import get_wins
 from modules.postnet.lle import compute_LLE_projection, find_k_nearest_neighbors
 
 
@@ -46,12 +47,13 @@ class LM3dNeRFInfer(BaseNeRFInfer):
         deepspeech_arr = np.load(deepspeech_name) # [T, w=16, c=29]
         print(f"Loaded deepspeech features from {deepspeech_name}.")
         # get window condition of deepspeech
-        from data_gen.nerf.binarizer import get_win_conds
         num_samples = min(len(lm3d_arr), len(deepspeech_arr), self.infer_max_length)
+        deepspeech_arr = torch.from_numpy(deepspeech_arr).float()
+        deepspeech_wins = get_wins(deepspeech_arr, 8)[:num_samples].contiguous() # the windows of all frames at once, [T, W=8, w=16, C=29]
         samples = [{} for _ in range(num_samples)]
         for idx, sample in enumerate(samples):
-            sample['deepspeech_win'] = torch.from_numpy(deepspeech_arr[idx]).float().unsqueeze(0) # [B=1, w=16, C=29]
-            sample['deepspeech_wins'] = torch.from_numpy(get_win_conds(deepspeech_arr, idx, smo_win_size=8)).float() # [W=8, w=16, C=29]
+            sample['deepspeech_win'] = deepspeech_arr[idx].unsqueeze(0) # [B=1, w=16, C=29]
+            sample['deepspeech_wins'] = deepspeech_wins[idx] # [W=8, w=16, C=29]
         
         idexp_lm3d_mean = self.dataset.idexp_lm3d_mean
         idexp_lm3d_std = self.dataset.idexp_lm3d_std
@@ -129,15 +131,15 @@ class LM3dNeRFInfer(BaseNeRFInfer):
             idexp_lm3d_normalized[:, :48*3] = convert_to_tensor(gaussian_filter1d(idexp_lm3d_normalized[:, :48*3].numpy(), sigma=lm3d_smooth_sigma))
             # idexp_lm3d_normalized = convert_to_tensor(gaussian_filter1d(idexp_lm3d_normalized.numpy(), sigma=lm3d_smooth_sigma))
         
-        idexp_lm3d_normalized_numpy = idexp_lm3d_normalized.cpu().numpy()
-        idexp_lm3d_normalized_win_numpy = np.stack([get_win_conds(idexp_lm3d_normalized_numpy, i, smo_win_size=hparams['cond_win_size'], pad_option='edge') for i in range(idexp_lm3d_normalized_numpy.shape[0])])
-        idexp_lm3d_normalized_win = torch.from_numpy(idexp_lm3d_normalized_win_numpy)
+        # the windows of all frames, then the windows of these windows, each in one call
+        idexp_lm3d_normalized_win = get_wins(idexp_lm3d_normalized.cpu(), hparams['cond_win_size'], pad_option='edge').contiguous()
+        idexp_lm3d_normalized_wins = get_wins(idexp_lm3d_normalized_win, hparams['smo_win_size'], pad_option='edge').contiguous()
 
         for idx, sample in enumerate(samples):
             sample['cond'] = idexp_lm3d_normalized[idx].unsqueeze(0)
             if hparams['use_window_cond']:
                 sample['cond_win'] = idexp_lm3d_normalized_win[idx]
-                sample['cond_wins'] = torch.from_numpy(get_win_conds(idexp_lm3d_normalized_win_numpy, idx, hparams['smo_win_size'], 'edge'))
+                sample['cond_wins'] = idexp_lm3d_normalized_wins[idx]
         return samples
 
 
@@ -2,10 +2,11 @@ import torch
 import numpy as np
 
 from utils.commons.hparams import hparams
+from utils.commons.window_utils import get_wins
 
 from tasks.radnerfs.dataset_utils import RADNeRFDataset
 from inference.nerfs.lm3d_nerf_infer import LM3dNeRFInfer
-from data_util.face3d_helper import Face3DHelper
+from data_util.face3d_helper import get_face3d_helper
 
 
 class LM3d_RADNeRFInfer(LM3dNeRFInfer):
@@ -13,7 +14,19 @@ class LM3d_RADNeRFInfer(LM3dNeRFInfer):
         super().__init__(hparams, device)
         self.dataset_cls = RADNeRFDataset # the dataset only provides head pose 
         self.dataset = self.dataset_cls('trainval', training=False)
-        self.face3d_helper = Face3DHelper(use_gpu=torch.cuda.is_available())
+        self.face3d_helper = get_face3d_helper(use_gpu=torch.cuda.is_available())
+
+    def get_infer_frames_per_batch(self, H, W):
+        """
+        march the rays of several frames together, as many as the memory budget allows
+        """
+        mem_budget_mb = hparams.get('infer_render_mem_budget_mb', 4096)
+        max_frames_per_batch = hparams.get('infer_max_frames_per_batch', 8)
+        if mem_budget_mb <= 0 or max_frames_per_batch <= 1:
+            return 1
+        bytes_per_frame = H * W * self.nerf_task.model.infer_bytes_per_ray()
+        num_frames_per_batch = int(mem_budget_mb * 1024 * 1024 // bytes_per_frame)
+        return max(1, min(num_frames_per_batch, max_frames_per_batch))
 
     def get_pose_from_ds(self, samples):
         """
@@ -72,17 +85,16 @@ class LM3d_RADNeRFInfer(LM3dNeRFInfer):
             moving_lm.data = idexp_lm3d_normalized[i].data
 
         idexp_lm3d_normalized = idexp_lm3d_normalized.reshape([-1,68*3])
-        from data_gen.nerf.binarizer import get_win_conds
-        idexp_lm3d_normalized_numpy = idexp_lm3d_normalized.cpu().numpy()
-        idexp_lm3d_normalized_win_numpy = np.stack([get_win_conds(idexp_lm3d_normalized_numpy, i, smo_win_size=hparams['cond_win_size'], pad_option='edge') for i in range(idexp_lm3d_normalized_numpy.shape[0])])
-        idexp_lm3d_normalized_win = torch.from_numpy(idexp_lm3d_normalized_win_numpy)
+        # the windows of all frames, then the windows of these windows, each in one call
+        idexp_lm3d_normalized_win = get_wins(idexp_lm3d_normalized.cpu(), hparams['cond_win_size'], pad_option='edge').contiguous()
+        idexp_lm3d_normalized_wins = get_wins(idexp_lm3d_normalized_win, hparams['smo_win_size'], pad_option='edge').contiguous()
 
         samples = [{} for _ in range(len(idexp_lm3d_normalized))]
         for idx, sample in enumerate(samples):
             sample['cond'] = idexp_lm3d_normalized[idx].unsqueeze(0)
             if hparams['use_window_cond']:
                 sample['cond_win'] = idexp_lm3d_normalized_win[idx]
-                sample['cond_wins'] = torch.from_numpy(get_win_conds(idexp_lm3d_normalized_win_numpy, idx, hparams['smo_win_size'], 'edge'))
+                sample['cond_wins'] = idexp_lm3d_normalized_wins[idx]
         return samples
 
 
@@ -8,6 +8,7 @@ import tqdm
 from utils.commons.tensor_utils import move_to_cuda
 from utils.commons.ckpt_utils import load_ckpt, get_last_checkpoint
 from utils.commons.hparams import hparams, set_hparams
+from utils.nn.precision_utils import infer_autocast, quantize_dynamic_int8
 
 
 class PostnetInfer:
@@ -20,6 +21,11 @@ class PostnetInfer:
         self.postnet_task = self.build_postnet_task()
         self.postnet_task.eval()
         self.postnet_task.to(self.device)
+        # precision policy of cpu inference, see utils/nn/precision_utils.py
+        self.infer_cpu_precision = hparams.get('infer_cpu_precision', 'fp32')
+        self.infer_cpu_int8 = self.device == 'cpu' and hparams.get('infer_cpu_int8', False)
+        if self.infer_cpu_int8:
+            self.quantize_postnet_task()
         
     def build_postnet_task(self):
         assert hparams['task_cls'] != ''
@@ -36,6 +42,17 @@ class PostnetInfer:
         task.global_step = steps
         return task
 
+    def quantize_postnet_task(self):
+        """
+        dynamic int8 quantization of the postnet and the audio2motion model, only for cpu inference
+        """
+        self.postnet_task.model = quantize_dynamic_int8(self.postnet_task.model)
+        self.postnet_task.audio2motion_task.model = quantize_dynamic_int8(self.postnet_task.audio2motion_task.model)
+        if self.infer_cpu_precision != 'fp32':
+            print(f"| infer_cpu_int8 is enabled, ignore infer_cpu_precision={self.infer_cpu_precision}.")
+            self.infer_cpu_precision = 'fp32'
+        print("| Postnet and audio2motion model are quantized to int8.")
+
     def infer_once(self, inp):
         self.inp = inp
         samples = self.get_cond_from_input(inp)
@@ -91,8 +108,9 @@ class PostnetInfer:
                                 desc=f"Now VAE is predicting the action into {inp['out_npy_name']}"):
                 if self.device == 'cuda':
                     batch = move_to_cuda(batch)
-                model_out = self.postnet_task.run_model(batch, infer=True, temperature=1.)
-                pred = model_out['refine_lm3d'].squeeze().cpu().numpy()
+                with infer_autocast(self.device, self.infer_cpu_precision):
+                    model_out = self.postnet_task.run_model(batch, infer=True, temperature=1.)
+                pred = model_out['refine_lm3d'].squeeze().float().cpu().numpy()
                 pred_lst.append(pred)
         np.save(inp['out_npy_name'], pred_lst)
         return inp['out_npy_name']
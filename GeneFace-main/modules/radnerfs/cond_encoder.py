@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from typing import List, Optional
 
 
 # Audio feature extractor
@@ -78,10 +79,16 @@ class AudioAttNet(nn.Module):
         
     def forward(self, x):
         """
-        x: [b=8, c]
+        x: [b=8, c], or [F, b=8, c] for a batch of frames
         return:
-            [c]
+            [c], or [F, c]
         """
+        if x.dim() == 3:
+            y = x[..., :self.in_out_dim].permute(0, 2, 1)  # [F, b, c] => [F, c, b]
+            y = self.attentionConvNet(y) # [F,1,b]
+            y = self.attentionNet(y.view(-1, self.seq_len)).view(-1, self.seq_len, 1) # [F, 8, 1]
+            smoothed_y = torch.sum(y*x, dim=1) # [F,8,1]*[F,8,c]=>[F,8,c]=>[F,c]
+            return smoothed_y
         y = x[:, :self.in_out_dim].permute(1, 0).unsqueeze(0)  # [b, c] => [1, c, b]
         y = self.attentionConvNet(y) # [1,1,b]
         y = self.attentionNet(y.view(1, self.seq_len)).view(self.seq_len, 1) # [8, 1]
@@ -89,6 +96,41 @@ class AudioAttNet(nn.Module):
         return smoothed_y
     
 
+def mlp_forward(x: torch.Tensor, first_proj: Optional[torch.Tensor], weights: List[torch.Tensor]) -> torch.Tensor:
+    """
+    x: [N, C], input of the first layer
+    first_proj: [1/N, dim_hidden], added to the output of the first layer, or None
+    weights: weights of the bias-free linear layers, relu is applied between them
+    """
+    num_layers = len(weights)
+    for l in range(num_layers):
+        x = F.linear(x, weights[l])
+        if l == 0 and first_proj is not None:
+            x = x + first_proj
+        if l != num_layers - 1:
+            x = F.relu(x)
+    return x
+
+
+def get_fused_mlp_forward(mode='jit'):
+    """
+    mode: jit, compile or none.
+        fuse the MLP chain with TorchScript or torch.compile, fallback to eager mlp_forward if unavailable.
+    """
+    if mode == 'jit':
+        try:
+            return torch.jit.script(mlp_forward)
+        except Exception as e:
+            print(f"| TorchScript is unavailable, use eager MLP forward instead: {e}")
+    elif mode == 'compile':
+        if hasattr(torch, 'compile'):
+            return torch.compile(mlp_forward, dynamic=True)
+        print("| torch.compile is unavailable, use eager MLP forward instead.")
+    elif mode != 'none':
+        raise ValueError(f"unsupported mlp fusion mode: {mode}")
+    return mlp_forward
+
+
 class MLP(nn.Module):
     def __init__(self, dim_in, dim_out, dim_hidden, num_layers):
         super().__init__()
@@ -102,10 +144,38 @@ class MLP(nn.Module):
             net.append(nn.Linear(self.dim_in if l == 0 else self.dim_hidden, self.dim_out if l == num_layers - 1 else self.dim_hidden, bias=False))
 
         self.net = nn.ModuleList(net)
-    
-    def forward(self, x):
-        for l in range(self.num_layers):
-            x = self.net[l](x)
-            if l != self.num_layers - 1:
-                x = F.relu(x, inplace=True)
-        return x
\ No newline at end of file
+        self.fused_forward = None
+
+    def set_fusion(self, mode='jit'):
+        """
+        use a fused MLP chain in eval mode, training always uses the eager path.
+        """
+        self.fused_forward = None if mode == 'none' else get_fused_mlp_forward(mode)
+
+    def project_cond(self, cond):
+        """
+        The contribution of the trailing `cond.shape[-1]` input dims to the first layer.
+        For a cond that is constant over many points (e.g., per-frame), compute it once and pass it to self.forward,
+        instead of repeating and concatenating the cond to each point.
+        cond: [..., dim_cond]
+        return: [..., dim_hidden]
+        """
+        return F.linear(cond, self.net[0].weight[:, self.dim_in - cond.shape[-1]:])
+
+    def forward(self, x, cond_proj=None):
+        """
+        x: [N, dim_in], or [N, dim_in - dim_cond] if cond_proj is given
+        cond_proj: [1/N, dim_hidden], generated by self.project_cond
+        """
+        if cond_proj is None and self.fused_forward is None:
+            for l in range(self.num_layers):
+                x = self.net[l](x)
+                if l != self.num_layers - 1:
+                    x = F.relu(x, inplace=True)
+            return x
+        weights = [layer.weight for layer in self.net]
+        if cond_proj is not None:
+            weights[0] = weights[0][:, :x.shape[-1]]
+        if self.fused_forward is not None and not self.training:
+            return self.fused_forward(x, cond_proj, weights)
+        return mlp_forward(x, cond_proj, weights)
@@ -58,6 +58,11 @@ class RADNeRF(NeRFRenderer):
         self.direction_embedder, self.direction_embedding_dim = get_encoder('spherical_harmonics')
         self.color_net = MLP(self.direction_embedding_dim + self.geo_feat_dim + self.individual_embedding_dim, 3, self.hidden_dim_color, self.num_layers_color)
 
+        # fuse the MLP chains at inference, jit (TorchScript), compile (torch.compile) or none
+        self.mlp_fusion = hparams.get('nerf_mlp_fusion', 'jit')
+        for mlp in [self.ambient_net, self.sigma_net, self.color_net]:
+            mlp.set_fusion(self.mlp_fusion)
+
     def cal_cond_feat(self, cond):
         """
         cond: [B, T, Ç]
@@ -70,19 +75,52 @@ class RADNeRF(NeRFRenderer):
             cond_feat = self.cond_att_net(cond_feat) # [1, 64] 
         return cond_feat
 
-    def forward(self, position, direction, cond_feat, individual_code):
+    def cal_cond_feat_batch(self, cond):
+        """
+        cond: [F, B, T, C], the conditions of F frames, each one is the input of self.cal_cond_feat
+        return: [F, cond_dim]
+        """
+        num_frames = cond.shape[0]
+        cond_feat = self.cond_prenet(cond.reshape([-1, *cond.shape[-2:]])) # [F*B, cond_dim]
+        cond_feat = cond_feat.reshape([num_frames, -1, self.cond_out_dim]) # [F, B, cond_dim]
+        if self.with_att:
+            cond_feat = self.cond_att_net(cond_feat) # [F, cond_dim]
+        else:
+            cond_feat = cond_feat.reshape([num_frames, self.cond_out_dim])
+        return cond_feat
+
+    def infer_bytes_per_ray(self):
+        """
+        A rough estimation of the peak memory that each ray costs in self.march_rays_infer,
+        used to decide how many frames could be rendered together.
+        """
+        # rays_o, rays_d, nears, fars, rays_t, weights_sum, depth, image, bg_color, frame_inds, rays_alive
+        ray_state_dim = 3 + 3 + 1 + 1 + 1 + 1 + 1 + 3 + 3 + 2 + 1
+        # each alive ray marches at most one point per ray in average (n_alive * n_step <= N)
+        point_feat_dim = 3 + 3 + 2 # xyzs, dirs, deltas
+        point_feat_dim += self.position_embedding_dim + self.hidden_dim_ambient # pos_feat, gathered cond_proj
+        point_feat_dim += 2 * self.hidden_dim_ambient
+        point_feat_dim += self.ambient_embedding_dim + 2 * self.hidden_dim_sigma + 1 + self.geo_feat_dim
+        point_feat_dim += self.direction_embedding_dim + self.geo_feat_dim + self.individual_embedding_dim + 2 * self.hidden_dim_color
+        return 4 * (ray_state_dim + point_feat_dim) # float32
+
+    def forward(self, position, direction, cond_feat, individual_code, frame_inds=None):
         """
         position: [N, 3], position, in [-bound, bound]
         direction: [N, 3], direction, nomalized in [-1, 1]
         cond_feat: [1, cond_dim], condition encoding, generated by self.cal_cond_feat
+            or [F, cond_dim] if frame_inds is given, generated by self.cal_cond_feat_batch
         individual_code: [1, ind_dim], individual code for each timestep
+        frame_inds: [N], long, the frame index of each point, select its cond_feat for multi-frame rendering
         """
-        cond_feat = cond_feat.repeat(position.shape[0], 1) # [1,cond_dim] ==> [N, cond_dim]
         pos_feat = self.position_embedder(position, bound=self.bound) # spatial feat f after E^3_{spatial} 3D grid in the paper
 
         # ambient
-        ambient_inp = torch.cat([pos_feat, cond_feat], dim=1) # audio feat and spatial feat 
-        ambient_logit = self.ambient_net(ambient_inp).float() # the MLP after AFE in paper, use float(), prevent performance drop due to amp
+        # the cond part of the first layer of ambient_net is computed once per frame, then broadcast-added to each point
+        cond_proj = self.ambient_net.project_cond(cond_feat) # [1/F, hidden_dim_ambient]
+        if frame_inds is not None:
+            cond_proj = cond_proj[frame_inds] # [F, hidden_dim_ambient] ==> [N, hidden_dim_ambient]
+        ambient_logit = self.ambient_net(pos_feat, cond_proj).float() # the MLP after AFE in paper, use float(), prevent performance drop due to amp
         ambient_pos = torch.tanh(ambient_logit) # normalized to [-1, 1], act as the coordinate in the 2D ambient tilegrid
         ambient_feat = self.ambient_embedder(ambient_pos, bound=1) # E^2_{audio} in paper, 2D grid
 
@@ -94,26 +132,29 @@ class RADNeRF(NeRFRenderer):
 
         # color
         direction_feat = self.direction_embedder(direction)
+        color_inp = torch.cat([direction_feat, geo_feat], dim=-1)
         if individual_code is not None:
-            color_inp = torch.cat([direction_feat, geo_feat, individual_code.repeat(position.shape[0], 1)], dim=-1)
+            # the individual code is shared by all points, so is its contribution to the first layer of color_net
+            color_logit = self.color_net(color_inp, self.color_net.project_cond(individual_code))
         else:
-            color_inp = torch.cat([direction_feat, geo_feat], dim=-1)
-        color_logit = self.color_net(color_inp)
+            color_logit = self.color_net(color_inp)
         # sigmoid activation for rgb
         color = torch.sigmoid(color_logit)
 
         return sigma, color, ambient_pos
 
-    def density(self, position, cond_feat, e=None):
+    def density(self, position, cond_feat, e=None, frame_inds=None):
         """
         Calculate Density, this is a sub-process of self.forward 
         """
-        cond_feat = cond_feat.repeat(position.shape[0], 1) # [1,cond_dim] ==> [N, cond_dim]
         pos_feat = self.position_embedder(position, bound=self.bound) # spatial feat f after E^3_{spatial} 3D grid in the paper
 
         # ambient
-        ambient_inp = torch.cat([pos_feat, cond_feat], dim=1) # audio feat and spatial feat 
-        ambient_logit = self.ambient_net(ambient_inp).float() # the MLP after AFE in paper, use float(), prevent performance drop due to amp
+        # the cond part of the first layer of ambient_net is computed once per frame, then broadcast-added to each point
+        cond_proj = self.ambient_net.project_cond(cond_feat) # [1/F, hidden_dim_ambient]
+        if frame_inds is not None:
+            cond_proj = cond_proj[frame_inds] # [F, hidden_dim_ambient] ==> [N, hidden_dim_ambient]
+        ambient_logit = self.ambient_net(pos_feat, cond_proj).float() # the MLP after AFE in paper, use float(), prevent performance drop due to amp
         ambient_pos = torch.tanh(ambient_logit) # normalized to [-1, 1], act as the coordinate in the 2D ambient tilegrid
         ambient_feat = self.ambient_embedder(ambient_pos, bound=1) # E^2_{audio} in paper, 2D grid
 
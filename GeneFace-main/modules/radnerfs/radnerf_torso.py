@@ -126,33 +126,39 @@ class RADNeRFTorso(RADNeRF):
                 results['weights_sum'] = weights_sum
                 results['ambient'] = ambient_sum
             else:
-                dtype = torch.float32
-                weights_sum = torch.zeros(N, dtype=dtype, device=device)
-                depth = torch.zeros(N, dtype=dtype, device=device)
-                image = torch.zeros(N, 3, dtype=dtype, device=device)
-                n_alive = N
-                rays_alive = torch.arange(n_alive, dtype=torch.int32, device=device) # [N]
-                rays_t = nears.clone() # [N]
-                step = 0
-                while step < max_steps:
-                    # count alive rays 
-                    n_alive = rays_alive.shape[0]
-                    # exit loop
-                    if n_alive <= 0:
-                        break
-                    # decide compact_steps
-                    n_step = max(min(N // n_alive, 8), 1)
-                    xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, self.bound, self.density_bitfield, self.cascade, self.grid_size, nears, fars, 128, perturb if step == 0 else False, dt_gamma, max_steps)
-                    sigmas, rgbs, ambient = self(xyzs, dirs, cond_feat, ind_code)
-                    sigmas = self.density_scale * sigmas
-                    raymarching.composite_rays(n_alive, n_step, rays_alive, rays_t, sigmas, rgbs, deltas, weights_sum, depth, image, T_thresh)
-                    rays_alive = rays_alive[rays_alive >= 0]
-                    step += n_step
+                weights_sum, depth, image = self.march_rays_infer(rays_o, rays_d, nears, fars, cond_feat, ind_code, dt_gamma=dt_gamma, perturb=perturb, max_steps=max_steps, T_thresh=T_thresh)
             # background
             if bg_color is None:
                 bg_color = 1
 
         ### Start Rendering Torso
+        torso_alpha, torso_color, deform = self.render_torso(bg_coords, poses, index, image, weights_sum)
+        if deform is not None:
+            results['deform'] = deform
+        # first mix torso with background
+        bg_color = torso_color * torso_alpha + bg_color * (1 - torso_alpha)
+        results['torso_alpha_map'] = torso_alpha
+        results['torso_rgb_map'] = bg_color
+        # then mix the head image with the torso_bg
+        image = image + (1 - weights_sum).unsqueeze(-1) * bg_color
+        image = image.view(*prefix, 3)
+        image = image.clamp(0, 1)
+        depth = torch.clamp(depth - nears, min=0) / (fars - nears)
+        depth = depth.view(*prefix)
+        results['depth_map'] = depth
+        results['rgb_map'] = image # head_image if train, else com_image
+
+        return results
+
+    def render_torso(self, bg_coords, poses, index, image, weights_sum):
+        # bg_coords: [N, 2]
+        # poses: [1, 6]
+        # image, weights_sum: [N, 3], [N], the rendered head
+        # return: torso_alpha: [N, 1], torso_color: [N, 3], deform: [M, 2] or None
+        N = bg_coords.shape[0]
+        device = bg_coords.device
+        deform = None
+
         if self.torso_individual_embedding_dim > 0:
             if self.training:
                 torso_individual_code = self.torso_individual_codes[index]
@@ -181,20 +187,41 @@ class RADNeRFTorso(RADNeRF):
                 torso_alpha_mask, torso_color_mask, deform = self.forward_torso(bg_coords[mask], poses, torso_individual_code)
             torso_alpha[mask] = torso_alpha_mask.float()
             torso_color[mask] = torso_color_mask.float()
-            results['deform'] = deform
-        # first mix torso with background
-        bg_color = torso_color * torso_alpha + bg_color * (1 - torso_alpha)
+        return torso_alpha, torso_color, deform
+
+    @torch.no_grad()
+    def render_batch(self, rays_o, rays_d, cond, bg_coords, poses, dt_gamma=0, bg_color=None, perturb=False, max_steps=1024, T_thresh=1e-4, **kwargs):
+        # inference only, march the head rays of F frames together, then render the torso of each frame
+        # rays_o, rays_d: [F, N, 3]
+        # cond: [F, ...]
+        # bg_coords: [1, N, 2]
+        # poses: [F, 6]
+        # bg_color: [F, N, 3]
+        # return: pred_rgb: [F, N, 3]
+        assert not self.training, "render_batch only supports inference"
+        march_out = self.march_batch(rays_o, rays_d, cond, dt_gamma=dt_gamma, perturb=perturb, max_steps=max_steps, T_thresh=T_thresh)
+        weights_sum, depth, image = march_out['weights_sum'], march_out['depth'], march_out['image']
+        nears, fars = march_out['nears'], march_out['fars']
+        bg_coords = bg_coords.contiguous().view(-1, 2)
+        if bg_color is None:
+            bg_color = torch.ones_like(image)
+
+        torso_alpha_lst, torso_rgb_lst = [], []
+        for i in range(image.shape[0]):
+            torso_alpha, torso_color, _ = self.render_torso(bg_coords, poses[i:i+1], 0, image[i], weights_sum[i])
+            torso_alpha_lst.append(torso_alpha)
+            torso_rgb_lst.append(torso_color * torso_alpha + bg_color[i] * (1 - torso_alpha))
+        torso_alpha = torch.stack(torso_alpha_lst) # [F, N, 1]
+        torso_bg_color = torch.stack(torso_rgb_lst) # [F, N, 3]
+
+        results = {}
         results['torso_alpha_map'] = torso_alpha
-        results['torso_rgb_map'] = bg_color
-        # then mix the head image with the torso_bg
-        image = image + (1 - weights_sum).unsqueeze(-1) * bg_color
-        image = image.view(*prefix, 3)
+        results['torso_rgb_map'] = torso_bg_color
+        image = image + (1 - weights_sum).unsqueeze(-1) * torso_bg_color
         image = image.clamp(0, 1)
         depth = torch.clamp(depth - nears, min=0) / (fars - nears)
-        depth = depth.view(*prefix)
         results['depth_map'] = depth
-        results['rgb_map'] = image # head_image if train, else com_image
-
+        results['rgb_map'] = image
         return results
     
     @torch.no_grad()
@@ -99,9 +99,15 @@ class NeRFRenderer(nn.Module):
         self.register_buffer('step_counter', step_counter)
         self.mean_count = 0
         self.local_step = 0
+
+        # ray/sample counters of the inference march loop, a dict when enabled by the profiler of the infer scripts
+        self.infer_stats = None
         
     def cal_cond_feat(self, cond):
         raise NotImplementedError()
+
+    def cal_cond_feat_batch(self, cond):
+        raise NotImplementedError()
     
     def forward(self, x, d):
         raise NotImplementedError()
@@ -313,57 +319,136 @@ class NeRFRenderer(nn.Module):
             results['weights_sum'] = weights_sum
             results['ambient'] = ambient_sum
         else:
-           
-            dtype = torch.float32
-            
-            weights_sum = torch.zeros(N, dtype=dtype, device=device)
-            depth = torch.zeros(N, dtype=dtype, device=device)
-            image = torch.zeros(N, 3, dtype=dtype, device=device)
-            
-            n_alive = N
-            rays_alive = torch.arange(n_alive, dtype=torch.int32, device=device) # [N]
-            rays_t = nears.clone() # [N]
+            weights_sum, depth, image = self.march_rays_infer(rays_o, rays_d, nears, fars, cond_feat, ind_code, dt_gamma=dt_gamma, perturb=perturb, max_steps=max_steps, T_thresh=T_thresh)
+
+        # background
+        if bg_color is None:
+            bg_color = 1
+
+        image = image + (1 - weights_sum).unsqueeze(-1) * bg_color
+        image = image.view(*prefix, 3)
+        image = image.clamp(0, 1)
+
+        depth = torch.clamp(depth - nears, min=0) / (fars - nears)
+        depth = depth.view(*prefix)
+        
+        results['depth_map'] = depth
+        results['rgb_map'] = image # head_image if train, else com_image
+
+        return results
+
+    def march_rays_infer(self, rays_o, rays_d, nears, fars, cond_feat, ind_code, frame_inds=None, dt_gamma=0, perturb=False, max_steps=1024, T_thresh=1e-4):
+        # rays_o, rays_d: [N, 3], a flat ray buffer, may hold the rays of several frames
+        # nears, fars: [N]
+        # cond_feat: [1, cond_dim], or [F, cond_dim] if frame_inds is given
+        # frame_inds: [N], long, the frame that each ray belongs to, selects its row in cond_feat
+        # return: weights_sum: [N], depth: [N], image: [N, 3]
+        N = rays_o.shape[0]
+        device = rays_o.device
+        dtype = torch.float32
+        
+        weights_sum = torch.zeros(N, dtype=dtype, device=device)
+        depth = torch.zeros(N, dtype=dtype, device=device)
+        image = torch.zeros(N, 3, dtype=dtype, device=device)
+        
+        n_alive = N
+        rays_alive = torch.arange(n_alive, dtype=torch.int32, device=device) # [N]
+        if self.infer_stats is not None:
+            self.infer_stats['num_rays'] = self.infer_stats.get('num_rays', 0) + N
+        rays_t = nears.clone() # [N]
+
+        step = 0
+        
+        while step < max_steps:
 
-            step = 0
+            # count alive rays 
+            n_alive = rays_alive.shape[0]
             
-            while step < max_steps:
+            # exit loop
+            if n_alive <= 0:
+                break
 
-                # count alive rays 
-                n_alive = rays_alive.shape[0]
-                
-                # exit loop
-                if n_alive <= 0:
-                    break
+            # decide compact_steps
+            n_step = max(min(N // n_alive, 8), 1)
 
-                # decide compact_steps
-                n_step = max(min(N // n_alive, 8), 1)
+            xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, self.bound, self.density_bitfield, self.cascade, self.grid_size, nears, fars, 128, perturb if step == 0 else False, dt_gamma, max_steps)
 
-                xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, self.bound, self.density_bitfield, self.cascade, self.grid_size, nears, fars, 128, perturb if step == 0 else False, dt_gamma, max_steps)
+            if frame_inds is not None:
+                # points are laid out ray by ray (n_step points for each alive ray), then padded to be dividable by align
+                sample_frame_inds = torch.zeros(xyzs.shape[0], dtype=torch.long, device=device)
+                sample_frame_inds[:n_alive * n_step] = frame_inds[rays_alive.long()].repeat_interleave(n_step)
+            else:
+                sample_frame_inds = None
+
+            sigmas, rgbs, ambient = self(xyzs, dirs, cond_feat, ind_code, sample_frame_inds)
+            sigmas = self.density_scale * sigmas
 
-                sigmas, rgbs, ambient = self(xyzs, dirs, cond_feat, ind_code)
-                sigmas = self.density_scale * sigmas
+            raymarching.composite_rays(n_alive, n_step, rays_alive, rays_t, sigmas.float(), rgbs.float(), deltas, weights_sum, depth, image, T_thresh)
 
-                raymarching.composite_rays(n_alive, n_step, rays_alive, rays_t, sigmas, rgbs, deltas, weights_sum, depth, image, T_thresh)
+            if self.infer_stats is not None:
+                self.infer_stats['march_iters'] = self.infer_stats.get('march_iters', 0) + 1
+                self.infer_stats['num_samples'] = self.infer_stats.get('num_samples', 0) + n_alive * n_step
+                self.infer_stats['num_padded_samples'] = self.infer_stats.get('num_padded_samples', 0) + xyzs.shape[0]
 
-                rays_alive = rays_alive[rays_alive >= 0]
+            rays_alive = rays_alive[rays_alive >= 0]
 
-                # print(f'step = {step}, n_step = {n_step}, n_alive = {n_alive}, xyzs: {xyzs.shape}')
+            # print(f'step = {step}, n_step = {n_step}, n_alive = {n_alive}, xyzs: {xyzs.shape}')
+
+            step += n_step
+
+        return weights_sum, depth, image
+
+    @torch.no_grad()
+    def march_batch(self, rays_o, rays_d, cond, dt_gamma=0, perturb=False, max_steps=1024, T_thresh=1e-4):
+        # rays_o, rays_d: [F, N, 3], rays of F frames, marched together in one flat ray buffer
+        # cond: [F, ...], the condition of each frame, as accepted by cal_cond_feat_batch
+        # return: a dict of weights_sum: [F, N], depth: [F, N], image: [F, N, 3], nears/fars: [F, N]
+        num_frames, N = rays_o.shape[:2]
+        device = rays_o.device
+        rays_o = rays_o.contiguous().view(-1, 3)
+        rays_d = rays_d.contiguous().view(-1, 3)
+        frame_inds = torch.arange(num_frames, device=device).repeat_interleave(N) # [F*N]
+
+        nears, fars = raymarching.near_far_from_aabb(rays_o, rays_d, self.aabb_infer, self.min_near)
+
+        # encode the conditions of all frames at once
+        cond_feat = self.cal_cond_feat_batch(cond) # [F, 64]
+
+        # use a fixed ind code for the unknown test data.
+        ind_code = self.individual_embeddings[0] if self.individual_embedding_dim > 0 else None
+
+        weights_sum, depth, image = self.march_rays_infer(rays_o, rays_d, nears, fars, cond_feat, ind_code, frame_inds=frame_inds, dt_gamma=dt_gamma, perturb=perturb, max_steps=max_steps, T_thresh=T_thresh)
+        return {
+            'weights_sum': weights_sum.view(num_frames, N),
+            'depth': depth.view(num_frames, N),
+            'image': image.view(num_frames, N, 3),
+            'nears': nears.view(num_frames, N),
+            'fars': fars.view(num_frames, N),
+        }
+
+    @torch.no_grad()
+    def render_batch(self, rays_o, rays_d, cond, bg_coords, poses, dt_gamma=0, bg_color=None, perturb=False, max_steps=1024, T_thresh=1e-4, **kwargs):
+        # inference only, render F frames with one march loop
+        # rays_o, rays_d: [F, N, 3]
+        # cond: [F, ...]
+        # bg_coords: [1, N, 2]
+        # poses: [F, 6]
+        # bg_color: [F, N, 3]
+        # return: pred_rgb: [F, N, 3]
+        assert not self.training, "render_batch only supports inference"
+        march_out = self.march_batch(rays_o, rays_d, cond, dt_gamma=dt_gamma, perturb=perturb, max_steps=max_steps, T_thresh=T_thresh)
+        weights_sum, depth, image = march_out['weights_sum'], march_out['depth'], march_out['image']
+        nears, fars = march_out['nears'], march_out['fars']
 
-                step += n_step
-            
         # background
         if bg_color is None:
             bg_color = 1
 
         image = image + (1 - weights_sum).unsqueeze(-1) * bg_color
-        image = image.view(*prefix, 3)
         image = image.clamp(0, 1)
-
         depth = torch.clamp(depth - nears, min=0) / (fars - nears)
-        depth = depth.view(*prefix)
-        
-        results['depth_map'] = depth
-        results['rgb_map'] = image # head_image if train, else com_image
 
+        results = {}
+        results['depth_map'] = depth
+        results['rgb_map'] = image
         return results
-
@@ -11,6 +11,7 @@ import pandas as pd
 
 import time
 from datetime import datetime
+from collections import OrderedDict
 
 import cv2
 import matplotlib.pyplot as plt
@@ -28,6 +29,7 @@ import trimesh
 import mcubes
 
 from utils.commons.hparams import hparams
+from utils.commons.window_utils import get_att_win
 from packaging import version as pver
 import imageio
 import lpips
@@ -73,38 +75,8 @@ def custom_meshgrid(*args):
 
 
 def get_audio_features(features, att_mode, index):
-    if att_mode == 0:
-        return features[[index]]
-    elif att_mode == 1:
-        left = index - hparams['smo_win_size']
-        pad_left = 0
-        if left < 0:
-            pad_left = -left
-            left = 0
-        auds = features[left:index]
-        if pad_left > 0:
-            # pad may be longer than auds, so do not use zeros_like
-            auds = torch.cat([torch.zeros(pad_left, *auds.shape[1:], device=auds.device, dtype=auds.dtype), auds], dim=0)
-        return auds
-    elif att_mode == 2:
-        left = index - hparams['smo_win_size']//2
-        right = index + (hparams['smo_win_size']-hparams['smo_win_size']//2)
-        pad_left = 0
-        pad_right = 0
-        if left < 0:
-            pad_left = -left
-            left = 0
-        if right > features.shape[0]:
-            pad_right = right - features.shape[0]
-            right = features.shape[0]
-        auds = features[left:right]
-        if pad_left > 0:
-            auds = torch.cat([torch.zeros_like(auds[:pad_left]), auds], dim=0)
-        if pad_right > 0:
-            auds = torch.cat([auds, torch.zeros_like(auds[:pad_right])], dim=0) # [8, 16]
-        return auds
-    else:
-        raise NotImplementedError(f'wrong att_mode: {att_mode}')
+    # att_mode 1/2 take the windows of hparams['smo_win_size'] frames, see utils/commons/window_utils.py
+    return get_att_win(features, att_mode, index, hparams['smo_win_size'])
 
 
 @torch.jit.script
@@ -282,13 +254,67 @@ def get_bg_coords(H, W, device):
     return bg_coords
 
 
+# cache of the unit ray directions in camera space of the full image, keyed by (H, W, intrinsics, stride, device)
+_camera_dirs_cache = OrderedDict()
+_camera_dirs_cache_size = 8
+
+
+def _cal_camera_dirs(rows, cols, intrinsics):
+    # rows: [h], cols: [w], int pixel indices
+    # return: i, j: [h*w], pixel centers (col, row); directions: [h*w, 3], unit directions in camera space, row-major
+    fx, fy, cx, cy = intrinsics
+    j, i = custom_meshgrid(rows.float() + 0.5, cols.float() + 0.5) # [h, w]
+    i = i.reshape(-1)
+    j = j.reshape(-1)
+    zs = torch.ones_like(i)
+    xs = (i - cx) / fx * zs
+    ys = (j - cy) / fy * zs
+    directions = torch.stack((xs, ys, zs), dim=-1)
+    directions = directions / torch.norm(directions, dim=-1, keepdim=True)
+    return i, j, directions
+
+
 @torch.cuda.amp.autocast(enabled=False)
-def get_rays(poses, intrinsics, H, W, N=-1, patch_size=1, rect=None):
+def get_camera_dirs(H, W, intrinsics, device, rect=None, stride=1):
+    ''' get the unit ray directions in camera space, the grid of the full image is cached
+    Args:
+        intrinsics: [4]
+        H, W: int
+        rect: [xmin, xmax, ymin, ymax], only compute the pixels in rows [xmin, xmax) and cols [ymin, ymax), not cached
+        stride: int, only compute every `stride`-th row and col
+    Returns:
+        i, j: [M], pixel centers (col, row)
+        directions: [M, 3], row-major over the selected pixels
+        NOTE: without rect, they are the cached tensors shared by all calls, do not modify them in place
+    '''
+    intrinsics = tuple(float(x) for x in intrinsics)
+    if rect is not None:
+        xmin, xmax, ymin, ymax = rect
+        rows = torch.arange(xmin, xmax, stride, device=device)
+        cols = torch.arange(ymin, ymax, stride, device=device)
+        return _cal_camera_dirs(rows, cols, intrinsics)
+
+    key = (H, W, intrinsics, stride, str(device))
+    if key in _camera_dirs_cache:
+        _camera_dirs_cache.move_to_end(key)
+        return _camera_dirs_cache[key]
+    rows = torch.arange(0, H, stride, device=device)
+    cols = torch.arange(0, W, stride, device=device)
+    camera_dirs = _cal_camera_dirs(rows, cols, intrinsics)
+    _camera_dirs_cache[key] = camera_dirs
+    if len(_camera_dirs_cache) > _camera_dirs_cache_size:
+        _camera_dirs_cache.popitem(last=False)
+    return camera_dirs
+
+
+@torch.cuda.amp.autocast(enabled=False)
+def get_rays(poses, intrinsics, H, W, N=-1, patch_size=1, rect=None, stride=1):
     ''' get rays
     Args:
         poses: [B, 4, 4], cam2world
         intrinsics: [4]
         H, W, N: int
+        stride: int, only get the rays of every `stride`-th row and col, requires N <= 0
     Returns:
         rays_o, rays_d: [B, N, 3]
         inds: [B, N]
@@ -296,67 +322,69 @@ def get_rays(poses, intrinsics, H, W, N=-1, patch_size=1, rect=None):
 
     device = poses.device
     B = poses.shape[0]
-    fx, fy, cx, cy = intrinsics
 
-    if rect is not None:
-        xmin, xmax, ymin, ymax = rect
-        N = (xmax - xmin) * (ymax - ymin)
+    results = {}
 
-    i, j = custom_meshgrid(torch.linspace(0, W-1, W, device=device), torch.linspace(0, H-1, H, device=device)) # float
-    i = i.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
-    j = j.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
+    if rect is not None and patch_size == 1:
+        # only get rays in the specified rect, the full-image grid is not needed
+        # assert B == 1
+        i, j, directions = get_camera_dirs(H, W, intrinsics, device, rect=rect, stride=stride)
+        inds = (j.long() * W + i.long()).unsqueeze(0) # [1, N]
+        i = i.unsqueeze(0)
+        j = j.unsqueeze(0)
+        directions = directions.unsqueeze(0) # [1, N, 3]
+    else:
+        if rect is not None:
+            xmin, xmax, ymin, ymax = rect
+            N = (xmax - xmin) * (ymax - ymin)
 
-    results = {}
+        # unit directions in camera space are cached, so only the rotation is computed for each pose
+        i, j, directions = get_camera_dirs(H, W, intrinsics, device, stride=stride) # [H*W], [H*W], [H*W, 3]
 
-    if N > 0:
-        N = min(N, H*W)
+        if N > 0:
+            assert stride == 1, "stride only supports getting all rays"
+            N = min(N, H*W)
 
-        if patch_size > 1:
+            if patch_size > 1:
 
-            # random sample left-top cores.
-            # NOTE: this impl will lead to less sampling on the image corner pixels... but I don't have other ideas.
-            num_patch = N // (patch_size ** 2)
-            inds_x = torch.randint(0, H - patch_size, size=[num_patch], device=device)
-            inds_y = torch.randint(0, W - patch_size, size=[num_patch], device=device)
-            inds = torch.stack([inds_x, inds_y], dim=-1) # [np, 2]
+                # random sample left-top cores.
+                # NOTE: this impl will lead to less sampling on the image corner pixels... but I don't have other ideas.
+                num_patch = N // (patch_size ** 2)
+                inds_x = torch.randint(0, H - patch_size, size=[num_patch], device=device)
+                inds_y = torch.randint(0, W - patch_size, size=[num_patch], device=device)
+                inds = torch.stack([inds_x, inds_y], dim=-1) # [np, 2]
 
-            # create meshgrid for each patch
-            pi, pj = custom_meshgrid(torch.arange(patch_size, device=device), torch.arange(patch_size, device=device))
-            offsets = torch.stack([pi.reshape(-1), pj.reshape(-1)], dim=-1) # [p^2, 2]
+                # create meshgrid for each patch
+                pi, pj = custom_meshgrid(torch.arange(patch_size, device=device), torch.arange(patch_size, device=device))
+                offsets = torch.stack([pi.reshape(-1), pj.reshape(-1)], dim=-1) # [p^2, 2]
 
-            inds = inds.unsqueeze(1) + offsets.unsqueeze(0) # [np, p^2, 2]
-            inds = inds.view(-1, 2) # [N, 2]
-            inds = inds[:, 0] * W + inds[:, 1] # [N], flatten
+                inds = inds.unsqueeze(1) + offsets.unsqueeze(0) # [np, p^2, 2]
+                inds = inds.view(-1, 2) # [N, 2]
+                inds = inds[:, 0] * W + inds[:, 1] # [N], flatten
 
-            inds = inds.expand([B, N])
-        
-        # only get rays in the specified rect
-        elif rect is not None:
-            # assert B == 1
-            mask = torch.zeros(H, W, dtype=torch.bool, device=device)
-            xmin, xmax, ymin, ymax = rect
-            mask[xmin:xmax, ymin:ymax] = 1
-            inds = torch.where(mask.view(-1))[0] # [nzn]
-            inds = inds.unsqueeze(0) # [1, N]
+                inds = inds.expand([B, N])
 
-        else:
-            inds = torch.randint(0, H*W, size=[N], device=device) # may duplicate
-            inds = inds.expand([B, N])
+            else:
+                inds = torch.randint(0, H*W, size=[N], device=device) # may duplicate
+                inds = inds.expand([B, N])
 
-        i = torch.gather(i, -1, inds)
-        j = torch.gather(j, -1, inds)
-    else:
-        inds = torch.arange(H*W, device=device).expand([B, H*W])
+            i = i[inds] # [B, N]
+            j = j[inds]
+            directions = directions[inds] # [B, N, 3]
+        else:
+            if stride == 1:
+                inds = torch.arange(H*W, device=device).expand([B, H*W])
+            else:
+                inds = (j.long() * W + i.long()).expand([B, -1])
+            # i, j are returned, so they are copied out of the cache in case the caller modifies them in place
+            i = i.clone().expand([B, -1])
+            j = j.clone().expand([B, -1])
+            directions = directions.expand([B, -1, 3])
     
     results['i'] = i
     results['j'] = j
     results['inds'] = inds
 
-    zs = torch.ones_like(i)
-    xs = (i - cx) / fx * zs
-    ys = (j - cy) / fy * zs
-    directions = torch.stack((xs, ys, zs), dim=-1)
-    directions = directions / torch.norm(directions, dim=-1, keepdim=True)
     rays_d = directions @ poses[:, :3, :3].transpose(-1, -2) # (B, N, 3)
 
     rays_o = poses[..., :3, 3] # [B, 3]
@@ -46,7 +46,7 @@ else
 fi
 
 # 修改点：加入断点机制。检查预处理的终产物是否存在，存在则跳过。
-processed_dataset="data/binary/videos/$video_id/trainval_dataset.npy"
+processed_dataset="data/binary/videos/$video_id/trainval/meta.json"
 
 if [ -f "$processed_dataset" ]; then
     echo "[INFO] 预处理产物 $processed_dataset 已存在，跳过数据预处理步骤。"
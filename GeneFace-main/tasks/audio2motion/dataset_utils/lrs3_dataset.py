@@ -8,11 +8,18 @@ import tqdm
 
 from utils.commons.hparams import hparams
 from utils.commons.tensor_utils import convert_to_tensor
-from data_util.face3d_helper import Face3DHelper
+from data_util.face3d_helper import get_face3d_helper
 
 from utils.commons.indexed_datasets import IndexedDataset
+from utils.commons.dataset_utils import batch_by_size
 from tasks.audio2motion.dataset_utils.euler2quaterion import euler2quaterion, quaterion2euler
 
+def to_float_tensor(x):
+    # a copy: the arrays of the typed records are read-only views of the memory-mapped dataset,
+    # which torch.from_numpy would share (and memory_cache would keep alive)
+    return torch.from_numpy(np.array(x, dtype=np.float32))
+
+
 class LRS3SeqDataset(Dataset):
     def __init__(self, prefix='train'):
         self.db_key = prefix
@@ -21,7 +28,7 @@ class LRS3SeqDataset(Dataset):
         self.sizes = None
         self.ordered_indices()
         self.memory_cache = {} # we use hash table to accelerate indexing
-        self.face3d_helper = Face3DHelper('deep_3drecon/BFM')
+        self.face3d_helper = get_face3d_helper('deep_3drecon/BFM')
         self.x_multiply = 8
         if hparams['load_db_to_memory']:
             self.load_db_to_memory()
@@ -46,87 +53,46 @@ class LRS3SeqDataset(Dataset):
     def ordered_indices(self):
         """Return an ordered list of indices. Batches will be constructed based
         on this order."""
-        sizes_fname = os.path.join(self.ds_path, f"sizes_{self.db_key}.npy")
-        if os.path.exists(sizes_fname):
-            sizes = np.load(sizes_fname, allow_pickle=True)
-            self.sizes = sizes
         if self.sizes is None:
-            self.sizes = []
-            print("Counting the size of each item in dataset...")
-            ds = IndexedDataset(f"{self.ds_path}/{self.db_key}")
-            for i_sample in tqdm.trange(len(ds)):
-                sample = ds[i_sample]
-                if sample is None:
-                    size = 0
-                else:
-                    x = sample['mel']
-                    size = x.shape[-1] # time step in audio
-                self.sizes.append(size)
-            np.save(sizes_fname, self.sizes)
-        indices = np.arange(len(self))
-        indices = indices[np.argsort(np.array(self.sizes)[indices], kind='mergesort')]
+            self.sizes = self.load_sizes()
+        indices = np.argsort(self.sizes, kind='mergesort')
         return indices
 
+    def load_sizes(self):
+        """
+        bucket_size_key: none, every item has the size of 80 (the mel bins, which the previous scan measured),
+            so the batches have max_sentences items as before;
+            mel, hubert or idexp_lm3d, the frames of the items recorded in the index by the binarizer,
+            the datasets binarized before that are scanned once and the sizes are saved to sizes_{db_key}_{key}.npy
+        """
+        ds = IndexedDataset(f"{self.ds_path}/{self.db_key}")
+        bucket_size_key = hparams.get('bucket_size_key', 'none')
+        if bucket_size_key == 'none':
+            return np.full([len(ds)], 80, dtype=np.int64)
+        sizes = ds.get_sizes(bucket_size_key)
+        if sizes is not None:
+            return sizes
+        sizes_fname = os.path.join(self.ds_path, f"sizes_{self.db_key}_{bucket_size_key}.npy")
+        if os.path.exists(sizes_fname):
+            return np.load(sizes_fname, allow_pickle=True)
+        print("Counting the size of each item in dataset...")
+        sizes = []
+        for begin in tqdm.trange(0, len(ds), 256):
+            for sample in ds.get_many(range(begin, min(begin + 256, len(ds)))):
+                sizes.append(0 if sample is None else sample[bucket_size_key].shape[0]) # time steps
+        sizes = np.array(sizes, dtype=np.int64)
+        np.save(sizes_fname, sizes)
+        return sizes
+
     def batch_by_size(self, indices, max_tokens=None, max_sentences=None,
         required_batch_size_multiple=1):
         """
-        Yield mini-batches of indices bucketed by size. Batches may contain
-        sequences of different lengths.
-
-        Args:
-            indices (List[int]): ordered list of dataset indices
-            num_tokens_fn (callable): function that returns the number of tokens at
-                a given index
-            max_tokens (int, optional): max number of tokens in each batch
-                (default: None).
-            max_sentences (int, optional): max number of sentences in each
-                batch (default: None).
-            required_batch_size_multiple (int, optional): require batch size to
-                be a multiple of N (default: 1).
+        Yield mini-batches of indices bucketed by size, see utils.commons.dataset_utils.batch_by_size
         """
-        def _is_batch_full(batch, num_tokens, max_tokens, max_sentences):
-            if len(batch) == 0:
-                return 0
-            if len(batch) == max_sentences:
-                return 1
-            if num_tokens > max_tokens:
-                return 1
-            return 0
-
-        num_tokens_fn = lambda x: self.sizes[x]
         max_tokens = max_tokens if max_tokens is not None else 60000
         max_sentences = max_sentences if max_sentences is not None else 512
-        bsz_mult = required_batch_size_multiple
-
-        sample_len = 0
-        sample_lens = []
-        batch = []
-        batches = []
-        for i in range(len(indices)):
-            idx = indices[i]
-            num_tokens = num_tokens_fn(idx)
-            sample_lens.append(num_tokens)
-            sample_len = max(sample_len, num_tokens)
-
-            assert sample_len <= max_tokens, (
-                "sentence at index {} of size {} exceeds max_tokens "
-                "limit of {}!".format(idx, sample_len, max_tokens)
-            )
-            num_tokens = (len(batch) + 1) * sample_len
-
-            if _is_batch_full(batch, num_tokens, max_tokens, max_sentences):
-                mod_len = max(
-                    bsz_mult * (len(batch) // bsz_mult),
-                    len(batch) % bsz_mult,
-                )
-                batches.append(batch[:mod_len])
-                batch = batch[mod_len:]
-                sample_lens = sample_lens[mod_len:]
-                sample_len = max(sample_lens) if len(sample_lens) > 0 else 0
-            batch.append(idx)
-        if len(batch) > 0:
-            batches.append(batch)
-        return batches
+        return batch_by_size(indices, self.sizes, max_tokens=max_tokens, max_sentences=max_sentences,
+                             required_batch_size_multiple=required_batch_size_multiple)
 
     def decode_pose(self, pose):
         """
@@ -152,29 +118,29 @@ class LRS3SeqDataset(Dataset):
             # audio-related features
             mel = raw_item['mel']
             hubert = raw_item['hubert']
-            item['mel'] = torch.from_numpy(mel).float() # [T_x, c=80]
-            item['hubert'] = torch.from_numpy(hubert).float() # [T_x, c=80]
+            item['mel'] = to_float_tensor(mel) # [T_x, c=80]
+            item['hubert'] = to_float_tensor(hubert) # [T_x, c=80]
             if 'f0' in raw_item.keys():
                 f0 = raw_item['f0']
-                item['f0'] = torch.from_numpy(f0).float() # [T_x,]
+                item['f0'] = to_float_tensor(f0) # [T_x,]
             # video-related features
             coeff = raw_item['coeff'] # [T_y ~= T_x//2, c=257]
             exp = coeff[:, 80:144] 
-            item['exp'] = torch.from_numpy(exp).float() # [T_y, c=64]
+            item['exp'] = to_float_tensor(exp) # [T_y, c=64]
             translation = coeff[:, 254:257] # [T_y, c=3]
             angles = euler2quaterion(coeff[:, 224:227]) # # [T_y, c=4]
             pose = np.concatenate([translation, angles], axis=1)
-            item['pose'] = torch.from_numpy(pose).float() # [T_y, c=4+3]
+            item['pose'] = to_float_tensor(pose) # [T_y, c=4+3]
 
             # Load identity for landmark construction
-            item['identity'] = torch.from_numpy(raw_item['coeff'][..., :80]).float()
+            item['identity'] = to_float_tensor(raw_item['coeff'][..., :80])
             
             # Load lm3d
             t_lm, dim_lm, _ = raw_item['idexp_lm3d'].shape # [T, 68, 3]
-            item['idexp_lm3d'] = torch.from_numpy(raw_item['idexp_lm3d']).reshape(t_lm, -1).float()
+            item['idexp_lm3d'] = to_float_tensor(raw_item['idexp_lm3d']).reshape(t_lm, -1)
             eye_idexp_lm3d, mouth_idexp_lm3d = self.face3d_helper.get_eye_mouth_lm_from_lm3d(raw_item['idexp_lm3d'])
-            item['eye_idexp_lm3d'] = convert_to_tensor(eye_idexp_lm3d).reshape(t_lm, -1).float()
-            item['mouth_idexp_lm3d'] = convert_to_tensor(mouth_idexp_lm3d).reshape(t_lm, -1).float()
+            item['eye_idexp_lm3d'] = to_float_tensor(eye_idexp_lm3d).reshape(t_lm, -1)
+            item['mouth_idexp_lm3d'] = to_float_tensor(mouth_idexp_lm3d).reshape(t_lm, -1)
             item['ref_mean_lm3d'] = item['idexp_lm3d'].mean(dim=0).reshape([204,])
             
             self.memory_cache[idx] = item
@@ -201,29 +167,29 @@ class LRS3SeqDataset(Dataset):
         # audio-related features
         mel = raw_item['mel']
         hubert = raw_item['hubert']
-        item['mel'] = torch.from_numpy(mel).float() # [T_x, c=80]
-        item['hubert'] = torch.from_numpy(hubert).float() # [T_x, c=80]
+        item['mel'] = to_float_tensor(mel) # [T_x, c=80]
+        item['hubert'] = to_float_tensor(hubert) # [T_x, c=80]
         if 'f0' in raw_item.keys():
             f0 = raw_item['f0']
-            item['f0'] = torch.from_numpy(f0).float() # [T_x,]
+            item['f0'] = to_float_tensor(f0) # [T_x,]
         # video-related features
         coeff = raw_item['coeff'] # [T_y ~= T_x//2, c=257]
         exp = coeff[:, 80:144] 
-        item['exp'] = torch.from_numpy(exp).float() # [T_y, c=64]
+        item['exp'] = to_float_tensor(exp) # [T_y, c=64]
         translation = coeff[:, 254:257] # [T_y, c=3]
         angles = euler2quaterion(coeff[:, 224:227]) # # [T_y, c=4]
         pose = np.concatenate([translation, angles], axis=1)
-        item['pose'] = torch.from_numpy(pose).float() # [T_y, c=4+3]
+        item['pose'] = to_float_tensor(pose) # [T_y, c=4+3]
 
         # Load identity for landmark construction
-        item['identity'] = torch.from_numpy(raw_item['coeff'][..., :80]).float()
+        item['identity'] = to_float_tensor(raw_item['coeff'][..., :80])
         
         # Load lm3d
         t_lm, dim_lm, _ = raw_item['idexp_lm3d'].shape # [T, 68, 3]
-        item['idexp_lm3d'] = torch.from_numpy(raw_item['idexp_lm3d']).reshape(t_lm, -1).float()
+        item['idexp_lm3d'] = to_float_tensor(raw_item['idexp_lm3d']).reshape(t_lm, -1)
         eye_idexp_lm3d, mouth_idexp_lm3d = self.face3d_helper.get_eye_mouth_lm_from_lm3d(raw_item['idexp_lm3d'])
-        item['eye_idexp_lm3d'] = convert_to_tensor(eye_idexp_lm3d).reshape(t_lm, -1).float()
-        item['mouth_idexp_lm3d'] = convert_to_tensor(mouth_idexp_lm3d).reshape(t_lm, -1).float()
+        item['eye_idexp_lm3d'] = to_float_tensor(eye_idexp_lm3d).reshape(t_lm, -1)
+        item['mouth_idexp_lm3d'] = to_float_tensor(mouth_idexp_lm3d).reshape(t_lm, -1)
         
         # item = self.memory_cache[idx]
         item['ref_mean_lm3d'] = item['idexp_lm3d'].mean(dim=0).reshape([204,])
@@ -292,8 +258,9 @@ class LRS3SeqDataset(Dataset):
 
     def get_dataloader(self):
         shuffle = True if self.db_key == 'train' else False
-        max_tokens = 60000
-        batches_idx = self.batch_by_size(self.ordered_indices(), max_tokens=max_tokens)
+        max_tokens = hparams.get('max_tokens', 60000)
+        batches_idx = self.batch_by_size(self.ordered_indices(), max_tokens=max_tokens,
+                                         max_sentences=hparams.get('max_sentences', 512))
         batches_idx = batches_idx * 50
         random.shuffle(batches_idx)
         loader = DataLoader(self, pin_memory=True,collate_fn=self.collater, batch_sampler=batches_idx, num_workers=4)
@@ -15,14 +15,14 @@ from modules.audio2motion.vae import PitchContourVAEModel
 from tasks.audio2motion.dataset_utils.lrs3_dataset import LRS3SeqDataset
 from tasks.syncnet.lm3d_syncnet import SyncNetTask
 
-from data_util.face3d_helper import Face3DHelper
+from data_util.face3d_helper import get_face3d_helper
 
 class VAESyncAudio2MotionTask(BaseTask):
     def __init__(self):
         super().__init__()
         self.dataset_cls = LRS3SeqDataset
         self.enable_sync = False # enables when sync loss is lower than 0.5!
-        self.face3d_helper = Face3DHelper(use_gpu=True)
+        self.face3d_helper = get_face3d_helper(use_gpu=True)
 
     def build_model(self):
         self.syncnet_task = SyncNetTask()
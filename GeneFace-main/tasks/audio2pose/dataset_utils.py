@@ -7,15 +7,15 @@ from torch.utils.data import DataLoader
 from utils.commons.hparams import hparams, set_hparams
 from utils.commons.tensor_utils import convert_to_tensor
 from utils.commons.euler2rot import euler_trans_2_c2w, c2w_to_euler_trans
+from data_gen.nerf.trainval_dataset import load_trainval_dataset
 
 
 class Audio2PoseDataset(torch.utils.data.Dataset):
     def __init__(self, data_dir=None):
         super().__init__()
         self.data_dir = os.path.join(hparams['binary_data_dir'], hparams['video_id']) if data_dir is None else data_dir
-        binary_file_name = os.path.join(self.data_dir, "trainval_dataset.npy")
-        ds_dict = np.load(binary_file_name, allow_pickle=True).tolist()
-        self.samples = [convert_to_tensor(sample) for sample in ds_dict['train_samples']] + [convert_to_tensor(sample) for sample in ds_dict['val_samples']]
+        ds_dict = load_trainval_dataset(self.data_dir)
+        self.samples = ds_dict.samples('trainval')
         self.num_samples = len(ds_dict['train_samples']) + len(ds_dict['val_samples'])
         self.audio_lst = [None] * self.num_samples
         self.pose_lst = [None] * self.num_samples
@@ -5,6 +5,7 @@ import numpy as np
 from utils.commons.hparams import hparams, set_hparams
 from utils.commons.tensor_utils import convert_to_tensor
 from utils.commons.image_utils import load_image_as_uint8_tensor
+from data_gen.nerf.trainval_dataset import load_trainval_dataset
 
 
 class NeRFDataset(torch.utils.data.Dataset):
@@ -12,16 +13,10 @@ class NeRFDataset(torch.utils.data.Dataset):
         super().__init__()
         self.data_dir = os.path.join(hparams['binary_data_dir'], hparams['video_id']) if data_dir is None else data_dir
         self.cond_type = hparams['cond_type'] if cond_type is None else cond_type
-        binary_file_name = os.path.join(self.data_dir, "trainval_dataset.npy")
-        ds_dict = np.load(binary_file_name, allow_pickle=True).tolist()
-        if prefix == 'train':
-            self.samples = [convert_to_tensor(sample) for sample in ds_dict['train_samples']]
-        elif prefix == 'val':
-            self.samples = [convert_to_tensor(sample) for sample in ds_dict['val_samples']]
-        elif prefix == 'trainval':
-            self.samples = [convert_to_tensor(sample) for sample in ds_dict['train_samples']] + [convert_to_tensor(sample) for sample in ds_dict['val_samples']]
-        else:
+        ds_dict = load_trainval_dataset(self.data_dir)
+        if prefix not in ['train', 'val', 'trainval']:
             raise ValueError("prefix should in train/val !")
+        self.samples = ds_dict.samples(prefix)
         self.prefix = prefix
         self.H = ds_dict['H']
         self.W = ds_dict['W']
@@ -34,22 +29,16 @@ class NeRFDataset(torch.utils.data.Dataset):
         self.idexp_lm3d_mean = torch.from_numpy(ds_dict['idexp_lm3d_mean']).float()
         self.idexp_lm3d_std = torch.from_numpy(ds_dict['idexp_lm3d_std']).float()
         self.max_t = len(ds_dict['train_samples']) + len(ds_dict['val_samples'])
+        self.img_caches = None
+        if hparams.get("load_imgs_to_memory", True):
+            # the packed uint8 caches of the binarized dataset, memory-mapped and shared by the DataLoader workers
+            self.img_caches = {kind: ds_dict.image_cache(kind, required=True) for kind in ['head_img', 'gt_img']}
 
     def __getitem__(self, idx):
         raw_sample = self.samples[idx]
 
-        if hparams.get("load_imgs_to_memory", True):
-            # disable it to save memory usage.
-            # for 5500 images, it takes 1 minutes to imread, by contrast, only 1s is needed to index them in memory. 
-            # But it reuqires 15GB memory for caching 5500 images at 512x512 resolution.
-            if 'head_img' not in self.samples[idx].keys():
-                self.samples[idx]['head_img'] = load_image_as_uint8_tensor(self.samples[idx]['head_img_fname'])
-                self.samples[idx]['gt_img'] = load_image_as_uint8_tensor(self.samples[idx]['gt_img_fname'])
-            head_img = self.samples[idx]['head_img']
-            gt_img = self.samples[idx]['gt_img']
-        else:
-            head_img = load_image_as_uint8_tensor(self.samples[idx]['head_img_fname'])
-            gt_img = load_image_as_uint8_tensor(self.samples[idx]['gt_img_fname'])
+        head_img = self.load_img(idx, 'head_img')
+        gt_img = self.load_img(idx, 'gt_img')
 
         sample = {
             'H': self.H,
@@ -99,6 +88,14 @@ class NeRFDataset(torch.utils.data.Dataset):
         
         return sample
     
+    def load_img(self, idx, kind):
+        """
+        :return: [H, W, C] uint8 tensor, copied from the packed cache if load_imgs_to_memory, otherwise read from the file
+        """
+        if self.img_caches is not None:
+            return torch.from_numpy(np.array(self.img_caches[kind][self.samples.positions[idx]]))
+        return load_image_as_uint8_tensor(self.samples[idx][f'{kind}_fname'])
+
     def __len__(self):
         return len(self.samples)
 
@@ -5,23 +5,23 @@ from torch.utils.data import DataLoader
 from utils.commons.hparams import hparams, set_hparams
 
 from tasks.audio2motion.dataset_utils.lrs3_dataset import LRS3SeqDataset
+from data_gen.nerf.trainval_dataset import load_trainval_dataset
 
 
 class PostnetDataset(torch.utils.data.Dataset):
     def __init__(self, prefix, data_dir=None):
         super().__init__()
         self.person_binary_data_dir = os.path.join(hparams['person_binary_data_dir'], hparams['video_id']) if data_dir is None else data_dir
-        binary_file_name = os.path.join(self.person_binary_data_dir, "trainval_dataset.npy")
-        person_ds_dict = np.load(binary_file_name, allow_pickle=True).tolist()
+        person_ds_dict = load_trainval_dataset(self.person_binary_data_dir)
         mel = person_ds_dict['mel']
         f0 = person_ds_dict['f0'].reshape([-1,1])
         hubert = person_ds_dict['hubert']
         # if len(mel.shape) == 0: # is object
         #     mel = mel.tolist()['mel']
-        train_lm3d_normalized = np.stack([sample['idexp_lm3d_normalized'] for sample in person_ds_dict['train_samples']], axis=0)
-        train_lm3d = np.stack([sample['idexp_lm3d'] for sample in person_ds_dict['train_samples']], axis=0)
-        val_lm3d_normalized = np.stack([sample['idexp_lm3d_normalized'] for sample in person_ds_dict['val_samples']], axis=0)
-        val_lm3d = np.stack([sample['idexp_lm3d'] for sample in person_ds_dict['val_samples']], axis=0)
+        train_lm3d_normalized = person_ds_dict['train_samples'].column('idexp_lm3d_normalized')
+        train_lm3d = person_ds_dict['train_samples'].column('idexp_lm3d')
+        val_lm3d_normalized = person_ds_dict['val_samples'].column('idexp_lm3d_normalized')
+        val_lm3d = person_ds_dict['val_samples'].column('idexp_lm3d')
         lm3d_len = train_lm3d_normalized.shape[0] + val_lm3d_normalized.shape[0]
         mel_len = mel.shape[0]
         if mel_len > 2 * lm3d_len:
@@ -89,8 +89,9 @@ class PostnetDataset(torch.utils.data.Dataset):
         return batch
 
     def get_dataloader(self):
-        max_tokens = 60000
-        batches_idx = self.audio2motion_ds.batch_by_size(self.audio2motion_ds.ordered_indices(), max_tokens=max_tokens)
+        max_tokens = hparams.get('max_tokens', 60000)
+        batches_idx = self.audio2motion_ds.batch_by_size(self.audio2motion_ds.ordered_indices(), max_tokens=max_tokens,
+                                                         max_sentences=hparams.get('max_sentences', 512))
         # loader = DataLoader(self, pin_memory=False,collate_fn=self.collater, batch_sampler=batches_idx, num_workers=0)
         loader = DataLoader(self, pin_memory=True,collate_fn=self.collater, batch_sampler=batches_idx, num_workers=4)
         return loader
@@ -13,7 +13,7 @@ from tasks.audio2motion.lm3d_vae_sync import VAESyncAudio2MotionTask
 from tasks.postnet.dataset_utils import PostnetDataset
 from tasks.syncnet.lm3d_syncnet import SyncNetTask
 
-from data_util.face3d_helper import Face3DHelper
+from data_util.face3d_helper import get_face3d_helper
 
 
 class PostnetAdvSyncTask(BaseTask):
@@ -23,7 +23,7 @@ class PostnetAdvSyncTask(BaseTask):
         self.syncnet_task = self.build_syncnet_task()
         self.build_disc_model()
         self.dataset_cls = PostnetDataset
-        self.face3d_helper = Face3DHelper(use_gpu=torch.cuda.is_available())
+        self.face3d_helper = get_face3d_helper(use_gpu=torch.cuda.is_available())
 
     def build_audio2motion_task(self):
         assert hparams['audio2motion_task_cls'] != ''
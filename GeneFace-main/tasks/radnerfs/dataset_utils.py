@@ -2,15 +2,17 @@ import os
 import tqdm
 import torch
 import cv2
+import imageio
 import numpy as np
 
 from scipy.spatial.transform import Rotation
 
 from utils.commons.hparams import hparams, set_hparams
 from utils.commons.tensor_utils import convert_to_tensor
-from utils.commons.image_utils import load_image_as_uint8_tensor
 
 from modules.radnerfs.utils import get_audio_features, get_rays, get_bg_coords, convert_poses, nerf_matrix_to_ngp
+from data_util.frame_store import load_landmarks
+from data_gen.nerf.trainval_dataset import load_trainval_dataset
 
 
 def smooth_camera_path(poses, kernel_size=7):
@@ -36,25 +38,36 @@ def smooth_camera_path(poses, kernel_size=7):
     return poses
 
 
+def get_lips_rects(lms, H, W):
+    """
+    the square lip rects of all frames at once
+    :param lms: [T, 68, 2] landmarks (x, y)
+    :return: [T, 4] int, (xmin, xmax, ymin, ymax), where x indexes the rows (H) and y the columns (W)
+    """
+    lips = np.asarray(lms[:, 48:60], dtype=np.float64)
+    # astype truncates toward zero, the same as int()
+    xmin, xmax = lips[:, :, 1].min(1).astype(np.int64), lips[:, :, 1].max(1).astype(np.int64)
+    ymin, ymax = lips[:, :, 0].min(1).astype(np.int64), lips[:, :, 0].max(1).astype(np.int64)
+
+    # padding to H == W
+    cx = (xmin + xmax) // 2
+    cy = (ymin + ymax) // 2
+
+    l = np.maximum(xmax - xmin, ymax - ymin) // 2
+    xmin = np.maximum(0, cx - l)
+    xmax = np.minimum(H, cx + l)
+    ymin = np.maximum(0, cy - l)
+    ymax = np.minimum(W, cy + l)
+    return np.stack([xmin, xmax, ymin, ymax], axis=1)
+
+
 class RADNeRFDataset(torch.utils.data.Dataset):
     def __init__(self, prefix, data_dir=None, training=True):
         super().__init__()
         self.data_dir = os.path.join(hparams['binary_data_dir'], hparams['video_id']) if data_dir is None else data_dir
-        binary_file_name = os.path.join(self.data_dir, "trainval_dataset.npy")
-        ds_dict = np.load(binary_file_name, allow_pickle=True).tolist()
-        if prefix == 'train':
-            self.samples = [convert_to_tensor(sample) for sample in ds_dict['train_samples']]
-        elif prefix == 'val':
-            self.samples = [convert_to_tensor(sample) for sample in ds_dict['val_samples']]
-        elif prefix == 'trainval':
-            self.samples = [convert_to_tensor(sample) for sample in ds_dict['train_samples']] + [
-                convert_to_tensor(sample) for sample in ds_dict['val_samples']
-            ]
-        else:
-            raise ValueError("prefix should be in train/val/trainval!")
-
+        ds_dict = load_trainval_dataset(self.data_dir)
         # Sort samples by idx to ensure correct order
-        self.samples.sort(key=lambda x: x['idx'])
+        self.samples = ds_dict.samples(prefix).sorted_by_idx()
         self.prefix = prefix
         self.cond_type = hparams['cond_type']
         self.H = ds_dict['H']
@@ -64,9 +77,17 @@ class RADNeRFDataset(torch.utils.data.Dataset):
         self.cy = ds_dict['cy']
         self.near = hparams['near'] # follow AD-NeRF, we dont use near-far in ds_dict
         self.far = hparams['far'] # follow AD-NeRF, we dont use near-far in ds_dict
+        self.img_downscale = hparams.get('img_downscale', 1)
+        if self.img_downscale > 1:
+            # render and supervise at the resolution of the downscaled image caches (the size is floored)
+            self.H, self.W = self.H // self.img_downscale, self.W // self.img_downscale
+            self.focal, self.cx, self.cy = self.focal / self.img_downscale, self.cx / self.img_downscale, self.cy / self.img_downscale
         if hparams['infer_bg_img_fname'] == '':
             # use the default bg_img from dataset
-            bg_img = torch.from_numpy(ds_dict['bg_img']).float() / 255.
+            bg_img = np.asarray(ds_dict['bg_img'])
+            if bg_img.shape[0] != self.H or bg_img.shape[1] != self.W:
+                bg_img = cv2.resize(bg_img, (self.W, self.H), interpolation=cv2.INTER_AREA)
+            bg_img = torch.from_numpy(bg_img).float() / 255.
         elif hparams['infer_bg_img_fname'] == 'white': # special
             bg_img = np.ones((self.H, self.W, 3), dtype=np.float32)
         elif hparams['infer_bg_img_fname'] == 'black': # special
@@ -84,7 +105,7 @@ class RADNeRFDataset(torch.utils.data.Dataset):
 
         fl_x = fl_y = self.focal
         self.intrinsics = np.array([fl_x, fl_y, self.cx, self.cy])
-        self.poses = torch.from_numpy(np.stack([nerf_matrix_to_ngp(s['c2w'], scale=hparams['camera_scale'], offset=hparams['camera_offset']) for s in self.samples]))
+        self.poses = torch.from_numpy(np.stack([nerf_matrix_to_ngp(c2w, scale=hparams['camera_scale'], offset=hparams['camera_offset']) for c2w in self.samples.column('c2w')]))
         if torch.any(torch.isnan(self.poses)):
             raise ValueError("Found NaN in transform_matrix, please check the face_tracker process!")
         if not training and hparams['infer_smooth_camera_path']:
@@ -94,34 +115,25 @@ class RADNeRFDataset(torch.utils.data.Dataset):
         self.bg_coords = get_bg_coords(self.H, self.W, 'cpu') # [1, H*W, 2] in [-1, 1]
 
         if self.cond_type == 'deepspeech':
-            self.conds = torch.stack([s['deepspeech_win'] for s in self.samples]) # [B=1, T=16, C=29]
+            self.conds = torch.from_numpy(self.samples.column('deepspeech_win')) # [B=1, T=16, C=29]
         elif self.cond_type == 'esperanto':
-            self.conds = torch.stack([s['esperanto_win'] for s in self.samples]) # [B=1, T=16, C=44]
+            self.conds = torch.from_numpy(self.samples.column('esperanto_win')) # [B=1, T=16, C=44]
         elif self.cond_type == 'idexp_lm3d_normalized':
-            self.conds = torch.stack([s['idexp_lm3d_normalized_win'].reshape([hparams['cond_win_size'], 204]) for s in self.samples]) # [B=1, T=1, C=204]
+            self.conds = torch.from_numpy(self.samples.column('idexp_lm3d_normalized_win').reshape([-1, hparams['cond_win_size'], 204])) # [B=1, T=1, C=204]
         else:
             raise NotImplementedError
         
         self.finetune_lip_flag = False
-        self.lips_rect = []
-        for sample in self.samples:
-            img_id = sample['idx']
-            lms = np.loadtxt(os.path.join(hparams['processed_data_dir'],hparams['video_id'], 'ori_imgs', str(img_id) + '.lms')) # [68, 2]
-            lips = slice(48, 60)
-            xmin, xmax = int(lms[lips, 1].min()), int(lms[lips, 1].max())
-            ymin, ymax = int(lms[lips, 0].min()), int(lms[lips, 0].max())
-
-            # padding to H == W
-            cx = (xmin + xmax) // 2
-            cy = (ymin + ymax) // 2
-
-            l = max(xmax - xmin, ymax - ymin) // 2
-            xmin = max(0, cx - l)
-            xmax = min(self.H, cx + l)
-            ymin = max(0, cy - l)
-            ymax = min(self.W, cy + l)
-            self.lips_rect.append([xmin, xmax, ymin, ymax])
+        lms, _ = load_landmarks(os.path.join(hparams['processed_data_dir'], hparams['video_id'], 'ori_imgs')) # [T, 68, 2], memmap
+        img_ids = self.samples.column('idx')
+        self.lips_rect = get_lips_rects(lms[img_ids] / self.img_downscale, self.H, self.W).tolist()
 
+        self.img_caches = None
+        if hparams.get("load_imgs_to_memory", True):
+            # the packed uint8 caches of the binarized dataset ([N, H, W, C], packed by the binarizer),
+            # memory-mapped, so the pages are shared by all DataLoader workers and the validation loop.
+            # It replaces the per-worker tensor caches, which took 15GB for 5500 images at 512x512 in each worker.
+            self.img_caches = {kind: ds_dict.image_cache(kind, self.img_downscale, required=True) for kind in ['torso_img', 'gt_img']}
         self.training = training
         self.global_step = 0
 
@@ -131,20 +143,8 @@ class RADNeRFDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, idx):
         raw_sample = self.samples[idx]
-        
-        if hparams.get("load_imgs_to_memory", True):
-            # disable it to save memory usage.
-            # for 5500 images, it takes 1 minutes to imread, by contrast, only 1s is needed to index them in memory. 
-            # But it reuqires 15GB memory for caching 5500 images at 512x512 resolution.
-            if 'torso_img' not in self.samples[idx].keys():
-                self.samples[idx]['torso_img'] = load_image_as_uint8_tensor(self.samples[idx]['torso_img_fname'])
-                self.samples[idx]['gt_img'] = load_image_as_uint8_tensor(self.samples[idx]['gt_img_fname'])
-            torso_img = self.samples[idx]['torso_img']
-            gt_img = self.samples[idx]['gt_img']
-        else:
-            torso_img = load_image_as_uint8_tensor(self.samples[idx]['torso_img_fname'])
-            gt_img = load_image_as_uint8_tensor(self.samples[idx]['gt_img_fname'])
-
+        torso_img = self.load_img(idx, 'torso_img') # [H, W, 4], uint8
+        gt_img = self.load_img(idx, 'gt_img') # [H, W, 3], uint8
 
         sample = {
             'H': self.H,
@@ -155,7 +155,7 @@ class RADNeRFDataset(torch.utils.data.Dataset):
             'near': self.near,
             'far': self.far,
             'idx': raw_sample['idx'],
-            'face_rect': raw_sample['face_rect'],
+            'face_rect': raw_sample['face_rect'] / self.img_downscale,
             'lip_rect': self.lips_rect[idx],
             'bg_img': self.bg_img,
         }
@@ -166,11 +166,6 @@ class RADNeRFDataset(torch.utils.data.Dataset):
         sample['pose'] = convert_poses(ngp_pose) # [B, 6]
         sample['pose_matrix'] = ngp_pose # [B, 4, 4]
 
-        sample.update({
-            'torso_img': torso_img.float() / 255.,
-            'gt_img': gt_img.float() / 255.,
-        })
-        
         if self.training:
             if self.finetune_lip_flag:
                 # the finetune_lip_flag is controlled by the task that use this dataset 
@@ -184,23 +179,25 @@ class RADNeRFDataset(torch.utils.data.Dataset):
         sample['rays_o'] = rays['rays_o']
         sample['rays_d'] = rays['rays_d']
 
-        xmin, xmax, ymin, ymax = raw_sample['face_rect']
+        xmin, xmax, ymin, ymax = sample['face_rect']
         face_mask = (rays['j'] >= xmin) & (rays['j'] < xmax) & (rays['i'] >= ymin) & (rays['i'] < ymax) # [B, N]
         sample['face_mask'] = face_mask
 
-        bg_torso_img = sample['torso_img']
-        bg_torso_img = bg_torso_img[..., :3] * bg_torso_img[..., 3:] + self.bg_img * (1 - bg_torso_img[..., 3:])
-        bg_torso_img = bg_torso_img.view(1, -1, 3) # treat torso as a part of background
-        bg_img =  self.bg_img.view(1, -1, 3)
-        
-        C = sample['gt_img'].shape[-1]
+        C = gt_img.shape[-1]
         if self.training:
-            bg_img = torch.gather(bg_img.cuda(), 1, torch.stack(3 * [rays['inds']], -1)) # [B, N, 3]
-            bg_torso_img = torch.gather(bg_torso_img.cuda(), 1, torch.stack(3 * [rays['inds']], -1)) # [B, N, 3]
-            gt_img = torch.gather(sample['gt_img'].reshape(1, -1, C).cuda(), 1, torch.stack(C * [rays['inds']], -1)) # [B, N, 3/4]
-            sample['gt_img'] = gt_img
+            # gather the sampled pixels on the uint8 views, only the sampled pixels are read and converted to float
+            inds = rays['inds'][0].cpu().numpy() # [N]
+            torso_img = torch.from_numpy(torso_img.reshape(-1, torso_img.shape[-1])[inds]).unsqueeze(0).cuda().float() / 255. # [B, N, 4]
+            gt_img = torch.from_numpy(gt_img.reshape(-1, C)[inds]).unsqueeze(0).cuda().float() / 255. # [B, N, 3/4]
+            bg_img = torch.gather(self.bg_img.view(1, -1, 3).cuda(), 1, torch.stack(3 * [rays['inds']], -1)) # [B, N, 3]
         else:
-            sample['gt_img'] = sample['gt_img'].reshape([1,-1,C])
+            torso_img = torch.from_numpy(np.array(torso_img)).float() / 255.
+            sample['torso_img'] = torso_img
+            torso_img = torso_img.view(1, -1, torso_img.shape[-1])
+            gt_img = torch.from_numpy(np.array(gt_img)).float().reshape([1, -1, C]) / 255.
+            bg_img = self.bg_img.view(1, -1, 3)
+        bg_torso_img = torso_img[..., :3] * torso_img[..., 3:] + bg_img * (1 - torso_img[..., 3:]) # treat torso as a part of background
+        sample['gt_img'] = gt_img
         sample['bg_img'] = bg_img
         sample['bg_torso_img'] = bg_torso_img
 
@@ -212,6 +209,17 @@ class RADNeRFDataset(torch.utils.data.Dataset):
 
         return sample
     
+    def load_img(self, idx, kind):
+        """
+        :return: [H, W, C] uint8, a read-only view of the packed cache if load_imgs_to_memory, otherwise read from the file
+        """
+        if self.img_caches is not None:
+            return self.img_caches[kind][self.samples.positions[idx]]
+        img = imageio.imread(self.samples[idx][f'{kind}_fname'])
+        if img.shape[0] != self.H or img.shape[1] != self.W:
+            img = cv2.resize(img, (self.W, self.H), interpolation=cv2.INTER_AREA)
+        return img
+
     def __len__(self):
         return len(self.samples)
 
@@ -179,6 +179,21 @@ class RADNeRFTask(BaseTask):
                     model_out['lpips_loss'] = self.criterion_lpips(pred_rgb, gt_rgb).mean()
             return model_out
 
+    def run_model_batch(self, samples):
+        """
+        render several frames together in infer mode, with one ray marching loop
+        :param samples: a list of single-frame samples, as the input of self.run_model
+        :return: model_out, rgb_map is [F, N, 3]
+        """
+        cond_inp = torch.stack([sample['cond_wins'] for sample in samples]) # [F, ...]
+        rays_o = torch.cat([sample['rays_o'] for sample in samples]) # [F, N, 3]
+        rays_d = torch.cat([sample['rays_d'] for sample in samples]) # [F, N, 3]
+        bg_coords = samples[0]['bg_coords'] # [1, N, 2]
+        poses = torch.cat([sample['pose'] for sample in samples]) # [F, 6]
+        bg_color = torch.cat([(sample['bg_torso_img'] if 'bg_torso_img' in sample else sample['bg_img']).reshape([1, -1, 3]) for sample in samples]) # [F, N, 3]
+        model_out = self.model.render_batch(rays_o, rays_d, cond_inp, bg_coords, poses, bg_color=bg_color, perturb=False, **hparams)
+        return model_out
+
     ##########################
     # training 
     ##########################
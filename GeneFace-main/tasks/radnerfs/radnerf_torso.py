@@ -121,6 +121,11 @@ class RADNeRFTorsoTask(RADNeRFTask):
                 model_out['mse_loss'] = torch.mean((pred_rgb - gt_rgb) ** 2) # [B, N, 3] -->  scalar
             return model_out
 
+    def run_model_batch(self, samples):
+        # the torso is rendered by the model itself, so only the pure background is blended
+        samples = [{k: v for k, v in sample.items() if k != 'bg_torso_img'} for sample in samples]
+        return super().run_model_batch(samples)
+
     ##########################
     # training 
     ##########################
@@ -52,16 +52,6 @@ def collate_2d(values, pad_idx=0, left_pad=False, shift_right=False, max_len=Non
     return res
 
 
-def _is_batch_full(batch, num_tokens, max_tokens, max_sentences):
-    if len(batch) == 0:
-        return 0
-    if len(batch) == max_sentences:
-        return 1
-    if num_tokens > max_tokens:
-        return 1
-    return 0
-
-
 def batch_by_size(
         indices, num_tokens_fn, max_tokens=None, max_sentences=None,
         required_batch_size_multiple=1, distributed=False
@@ -72,8 +62,8 @@ def batch_by_size(
 
     Args:
         indices (List[int]): ordered list of dataset indices
-        num_tokens_fn (callable): function that returns the number of tokens at
-            a given index
+        num_tokens_fn (callable or np.ndarray): function that returns the number of tokens at
+            a given index, or the array of the sizes of all items of the dataset
         max_tokens (int, optional): max number of tokens in each batch
             (default: None).
         max_sentences (int, optional): max number of sentences in each
@@ -87,35 +77,40 @@ def batch_by_size(
 
     if isinstance(indices, types.GeneratorType):
         indices = np.fromiter(indices, dtype=np.int64, count=-1)
-
-    sample_len = 0
-    sample_lens = []
-    batch = []
+    indices = np.asarray(indices, dtype=np.int64)
+    if callable(num_tokens_fn):
+        sizes = np.array([num_tokens_fn(idx) for idx in indices], dtype=np.int64)
+    else:
+        sizes = np.asarray(num_tokens_fn, dtype=np.int64)[indices]
+    n = len(indices)
+    if n > 0 and sizes.max() > max_tokens:
+        i = int(np.argmax(sizes > max_tokens))
+        raise AssertionError("sentence at index {} of size {} exceeds max_tokens "
+                             "limit of {}!".format(indices[i], sizes[i], max_tokens))
+
+    # The same greedy bucketing as the loop over the items: a batch is full when adding the k-th item
+    # (k items in the batch) reaches max_sentences or (k + 1) * (max size of the batch) > max_tokens.
+    # The full batch is cut to a multiple of bsz_mult and the rest is carried over into the next batch,
+    # together with the item that filled it, without checking them again (num_forced).
     batches = []
-    for i in range(len(indices)):
-        idx = indices[i]
-        num_tokens = num_tokens_fn(idx)
-        sample_lens.append(num_tokens)
-        sample_len = max(sample_len, num_tokens)
-
-        assert sample_len <= max_tokens, (
-            "sentence at index {} of size {} exceeds max_tokens "
-            "limit of {}!".format(idx, sample_len, max_tokens)
-        )
-        num_tokens = (len(batch) + 1) * sample_len
-
-        if _is_batch_full(batch, num_tokens, max_tokens, max_sentences):
-            mod_len = max(
-                bsz_mult * (len(batch) // bsz_mult),
-                len(batch) % bsz_mult,
-            )
-            batches.append(batch[:mod_len])
-            batch = batch[mod_len:]
-            sample_lens = sample_lens[mod_len:]
-            sample_len = max(sample_lens) if len(sample_lens) > 0 else 0
-        batch.append(idx)
-    if len(batch) > 0:
-        batches.append(batch)
+    begin, num_forced = 0, 1
+    while begin < n:
+        win = min(n - begin, max(1024, num_forced + 1))
+        while True:
+            k = np.arange(win)
+            run_max = np.maximum.accumulate(sizes[begin:begin + win])
+            full = (k >= num_forced) & ((k == max_sentences) | ((k + 1) * run_max > max_tokens))
+            if full.any() or begin + win == n:
+                break
+            win = min(n - begin, win * 2)
+        if not full.any():
+            batches.append(indices[begin:].tolist())
+            break
+        batch_len = int(np.argmax(full))
+        mod_len = max(bsz_mult * (batch_len // bsz_mult), batch_len % bsz_mult)
+        batches.append(indices[begin:begin + mod_len].tolist())
+        begin += mod_len
+        num_forced = batch_len - mod_len + 1
     return batches
 
 
@@ -1,9 +1,31 @@
+import os
+import mmap
+import json
+import zlib
 import pickle
 from bisect import bisect
 from copy import deepcopy
 import numpy as np
 import gzip
 
+from utils.commons.multiprocess_utils import multiprocess_run_tqdm
+
+# the compression codecs of the array fields of the records, lz4 and zstd are optional
+CODECS = {
+    'none': (None, None),
+    'zlib': (lambda b: zlib.compress(b, 1), zlib.decompress),
+}
+try:
+    import lz4.frame
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+try:
+    import zstandard
+    CODECS['zstd'] = (lambda b: zstandard.ZstdCompressor(level=3).compress(b), lambda b: zstandard.ZstdDecompressor().decompress(b))
+except ImportError:
+    pass
+
 
 def int2bytes(i: int, *, signed: bool = False) -> bytes:
     length = ((i + ((i * signed) < 0)).bit_length() + 7 + signed) // 8
@@ -24,58 +46,259 @@ def load_index_data(data_file):
     return data_offsets, id2pos, meta
 
 
+##############
+# typed records
+##############
+# A record stores the numpy fields of an item as raw buffers, so they are read back with np.frombuffer
+# (zero-copy for the uncompressed fields), instead of unpickling the whole item:
+#     magic (4 bytes) | header length (uint32) | json header | buffers, each aligned to RECORD_ALIGN bytes
+# The header lists the fields in order: {'name', 'kind': 'array' | 'json' | 'pickle', 'dtype', 'shape', 'codec',
+# 'offset' (from the first buffer), 'nbytes'} ('value' for the json fields). The values that are neither arrays nor plain json
+# (str, int, float, bool, None, and lists of them) are pickled.
+RECORD_MAGIC = b'GFR1'
+RECORD_ALIGN = 64
+
+
+def _is_plain_json(v):
+    if v is None or type(v) in (str, int, float, bool):
+        return True
+    if type(v) is list:
+        return all(_is_plain_json(x) for x in v)
+    return False
+
+
+def _align(n):
+    return n + (-n) % RECORD_ALIGN
+
+
+def encode_record(item, compression='none', min_compress_bytes=1024):
+    """
+    :param item: a dict
+    :param compression: the codec of all array fields, or a dict {field: codec} ('*' for the other fields),
+        the codecs are in CODECS; the buffers smaller than min_compress_bytes are not compressed
+    :return: bytes
+    """
+    fields, buffers = [], []
+    for k, v in item.items():
+        field = {'name': k}
+        if isinstance(v, (np.ndarray, np.generic)) and not v.dtype.hasobject:
+            arr = np.ascontiguousarray(v)
+            codec = compression.get(k, compression.get('*', 'none')) if isinstance(compression, dict) else compression
+            if codec not in CODECS:
+                raise ValueError(f"the codec {codec} is unknown or not installed, the available codecs are {list(CODECS.keys())}")
+            b = arr.tobytes()
+            if codec != 'none' and len(b) >= min_compress_bytes:
+                b = CODECS[codec][0](b)
+            else:
+                codec = 'none'
+            field.update({'kind': 'array', 'dtype': arr.dtype.str, 'shape': list(arr.shape), 'codec': codec})
+        elif _is_plain_json(v):
+            field.update({'kind': 'json', 'value': v})
+            fields.append(field)
+            continue
+        else:
+            b = pickle.dumps(v)
+            field['kind'] = 'pickle'
+        field['nbytes'] = len(b)
+        fields.append(field)
+        buffers.append((field, b))
+
+    offset = 0
+    for field, b in buffers:
+        field['offset'] = offset
+        offset += _align(len(b))
+    header = json.dumps({'fields': fields}, separators=(',', ':')).encode()
+    data_begin = _align(8 + len(header))
+    out = bytearray(data_begin + offset)
+    out[:8] = RECORD_MAGIC + len(header).to_bytes(4, 'little')
+    out[8:8 + len(header)] = header
+    for field, b in buffers:
+        out[data_begin + field['offset']:data_begin + field['offset'] + len(b)] = b
+    return bytes(out)
+
+
+def is_record(b):
+    return bytes(b[:4]) == RECORD_MAGIC
+
+
+def decode_record(b):
+    """
+    :param b: the bytes (or a memoryview) of a record
+    :return: the dict of the item, the uncompressed arrays are read-only views of b
+    """
+    header_len = int.from_bytes(bytes(b[4:8]), 'little')
+    header = json.loads(bytes(b[8:8 + header_len]))
+    data_begin = _align(8 + header_len)
+    item = {}
+    for field in header['fields']:
+        if field['kind'] == 'json':
+            item[field['name']] = field['value']
+            continue
+        buf = b[data_begin + field['offset']:data_begin + field['offset'] + field['nbytes']]
+        if field['kind'] == 'pickle':
+            item[field['name']] = pickle.loads(buf)
+            continue
+        if field['codec'] != 'none':
+            buf = CODECS[field['codec']][1](buf)
+        arr = np.frombuffer(buf, dtype=np.dtype(field['dtype'])).reshape(field['shape'])
+        item[field['name']] = arr[()] if len(field['shape']) == 0 else arr
+    return item
+
+
+def get_item_sizes(item, size_fields):
+    # the length (first dim) of each field, 0 if the item does not have it
+    return {k: (len(item[k]) if item.get(k) is not None else 0) for k in size_fields}
+
+
+def _encode_item_job(item_func, arg, encode_kwargs, size_fields):
+    # build an item in the worker and encode it there, only the bytes and the sizes are sent back
+    item = item_func(*arg) if isinstance(arg, (list, tuple)) else item_func(arg)
+    if item is None:
+        return None
+    return encode_item(item, **encode_kwargs), get_item_sizes(item, size_fields)
+
+
+def encode_item(item, record=False, compression='none', min_compress_bytes=1024, gzip_pickle=False):
+    if record:
+        return encode_record(item, compression, min_compress_bytes)
+    s = pickle.dumps(item)
+    if gzip_pickle:
+        s = gzip.compress(s, 1)
+    return s
+
+
 class IndexedDataset:
-    def __init__(self, path, unpickle=True):
+    """
+    The data files of each chunk ({path}.data, {path}.{i}.data) are memory-mapped once per process
+    (reopened after a fork, so the DataLoader workers do not share file handles), and the items are read
+    as zero-copy slices of the maps.
+    mode: 'pickle' decodes the items, typed records or pickles (the default, unpickle=False selects 'bytes'),
+          'bytes' returns the raw bytes, 'memoryview' / 'numpy' return zero-copy views of the maps
+          (np.frombuffer with dtype for 'numpy'), without copy or pickle.
+    """
+    def __init__(self, path, unpickle=True, mode=None, dtype=np.uint8):
         self.path = path
-        self.root_data_file = open(f"{path}.data", 'rb', buffering=-1)
-        try:
-            self.byte_offsets, self.id2pos, self.meta = load_index_data(self.root_data_file)
-            self.data_files = [self.root_data_file]
-        except:
-            self.__init__old(path)
-            self.meta = {}
+        with open(f"{path}.data", 'rb', buffering=-1) as root_data_file:
+            try:
+                self.byte_offsets, self.id2pos, self.meta = load_index_data(root_data_file)
+            except:
+                self.__init__old(path)
+                self.meta = {}
         self.gzip = self.meta.get('gzip', False)
         if 'chunk_begin' not in self.meta:
             self.meta['chunk_begin'] = [0]
-        for i in range(len(self.meta['chunk_begin'][1:])):
-            self.data_files.append(open(f"{self.path}.{i + 1}.data", 'rb'))
+        self.chunk_begin = list(self.meta['chunk_begin'])
+        self.data_fnames = [f"{path}.data"] + [f"{path}.{i + 1}.data" for i in range(len(self.chunk_begin[1:]))]
         self.unpickle = unpickle
+        self.mode = mode if mode is not None else ('pickle' if unpickle else 'bytes')
+        assert self.mode in ['pickle', 'bytes', 'memoryview', 'numpy'], self.mode
+        self.dtype = dtype
+        self.data_files, self.mmaps, self.pid = [], [], None
 
     def __init__old(self, path):
         self.path = path
         index_data = np.load(f"{path}.idx", allow_pickle=True).item()
         self.byte_offsets = index_data['offsets']
         self.id2pos = index_data.get('id2pos', {})
-        self.data_files = [open(f"{path}.data", 'rb', buffering=-1)]
 
-    def __getitem__(self, i):
+    def _open(self):
+        # open the maps on the first read of each process
+        if self.pid != os.getpid():
+            self.data_files, self.mmaps = [], []
+            for fname in self.data_fnames:
+                data_file = open(fname, 'rb')
+                self.data_files.append(data_file)
+                self.mmaps.append(mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ))
+            self.pid = os.getpid()
+        return self.mmaps
+
+    def _pos(self, i):
         if self.id2pos is not None and len(self.id2pos) > 0:
             i = self.id2pos[i]
         self.check_index(i)
-        
-        chunk_id = bisect(self.meta['chunk_begin'][1:], self.byte_offsets[i])
-        data_file = open(f"{self.path}.data", 'rb', buffering=-1)
-        data_file.seek(self.byte_offsets[i] - self.meta['chunk_begin'][chunk_id])
-        b = data_file.read(self.byte_offsets[i + 1] - self.byte_offsets[i])
-        data_file.close()
-        
-        # chunk_id = bisect(self.meta['chunk_begin'][1:], self.byte_offsets[i])
-        # data_file = self.data_files[chunk_id]
-        # data_file.seek(self.byte_offsets[i] - self.meta['chunk_begin'][chunk_id])
-        # b = data_file.read(self.byte_offsets[i + 1] - self.byte_offsets[i])
-
-        unpickle = self.unpickle
-        if unpickle:
+        return i
+
+    def _decode(self, b):
+        if self.mode == 'pickle':
+            if is_record(b):
+                return decode_record(b)
             if self.gzip:
                 b = gzip.decompress(b)
-            item = pickle.loads(b)
-        else:
-            item = b
-        return item
+            return pickle.loads(b)
+        elif self.mode == 'bytes':
+            return bytes(b)
+        elif self.mode == 'numpy':
+            return np.frombuffer(b, dtype=self.dtype)
+        return b
 
-    def __del__(self):
+    def __getitem__(self, i):
+        i = self._pos(i)
+        mmaps = self._open()
+        chunk_id = bisect(self.chunk_begin[1:], self.byte_offsets[i])
+        begin = self.byte_offsets[i] - self.chunk_begin[chunk_id]
+        b = memoryview(mmaps[chunk_id])[begin:begin + self.byte_offsets[i + 1] - self.byte_offsets[i]]
+        return self._decode(b)
+
+    def get_many(self, indices, max_gap=4096):
+        """
+        read the items in the order of their offsets, the items of a chunk that are at most max_gap bytes apart
+        are coalesced into one read (prefetched with madvise), the items are returned in the order of indices
+        """
+        positions = np.array([self._pos(i) for i in indices], dtype=np.int64)
+        if len(positions) == 0:
+            return []
+        mmaps = self._open()
+        byte_offsets = np.asarray(self.byte_offsets, dtype=np.int64)
+        begins, ends = byte_offsets[positions], byte_offsets[positions + 1]
+        chunk_ids = np.searchsorted(np.asarray(self.chunk_begin[1:], dtype=np.int64), begins, side='right')
+        order = np.lexsort([begins, chunk_ids])
+        items = [None] * len(positions)
+        run_start = 0
+        for k in range(1, len(order) + 1):
+            # close the run at the end, at a chunk boundary, or at a gap larger than max_gap
+            if k < len(order):
+                prev, cur = order[k - 1], order[k]
+                if chunk_ids[cur] == chunk_ids[prev] and begins[cur] - ends[prev] <= max_gap:
+                    continue
+            run = order[run_start:k]
+            chunk_id = chunk_ids[run[0]]
+            chunk_begin = self.chunk_begin[chunk_id]
+            run_begin, run_end = int(begins[run[0]]) - chunk_begin, int(ends[run].max()) - chunk_begin
+            if hasattr(mmap, 'MADV_WILLNEED'):
+                page_begin = run_begin - run_begin % mmap.PAGESIZE
+                mmaps[chunk_id].madvise(mmap.MADV_WILLNEED, page_begin, run_end - page_begin)
+            buf = memoryview(mmaps[chunk_id])[run_begin:run_end]
+            for j in run:
+                items[j] = self._decode(buf[int(begins[j]) - chunk_begin - run_begin:int(ends[j]) - chunk_begin - run_begin])
+            run_start = k
+        return items
+
+    def get_sizes(self, key):
+        """
+        the sizes of a field of all items recorded by the builder (size_fields), None if not recorded
+        """
+        sizes = self.meta.get('sizes', {}).get(key)
+        return None if sizes is None else np.asarray(sizes, dtype=np.int64)
+
+    def close(self):
+        for m in self.mmaps:
+            try:
+                m.close()
+            except BufferError:
+                pass # a zero-copy view of the map is still alive, it is released with the view
         for data_file in self.data_files:
             data_file.close()
+        self.data_files, self.mmaps, self.pid = [], [], None
+
+    def __getstate__(self):
+        # the maps are reopened in the process that unpickles the dataset (e.g., spawned DataLoader workers)
+        state = self.__dict__.copy()
+        state['data_files'], state['mmaps'], state['pid'] = [], [], None
+        return state
+
+    def __del__(self):
+        if getattr(self, 'pid', None) == os.getpid():
+            self.close()
 
     def check_index(self, i):
         if i < 0 or i >= len(self.byte_offsets) - 1:
@@ -98,8 +321,15 @@ class IndexedDataset:
 
 
 class IndexedDatasetBuilder:
+    """
+    record: write the items as typed records (see encode_record) with the codecs of compression,
+        instead of pickles (gzip-compressed if gzip); both formats are read by IndexedDataset
+    size_fields: record the length of these fields of each item into meta['sizes'] (e.g., mel, hubert, idexp_lm3d
+        frames), so the readers bucket the items without reading them, see IndexedDataset.get_sizes
+    """
     def __init__(self, path, append=False, max_size=1024 * 1024 * 1024 * 64,
-                 default_idx_size=1024 * 1024 * 16, gzip=False):
+                 default_idx_size=1024 * 1024 * 16, gzip=False, record=False, compression='none', min_compress_bytes=1024,
+                 size_fields=()):
         self.path = self.root_path = path
         self.default_idx_size = default_idx_size
         if append:
@@ -120,9 +350,28 @@ class IndexedDatasetBuilder:
             self.gzip = self.meta['gzip'] = gzip
         self.root_data_file = self.data_file
         self.max_size = max_size
-        self.data_chunk_id = 0
+        self.data_chunk_id = len(self.meta['chunk_begin']) - 1
+        if self.data_chunk_id > 0:
+            # append to the last chunk
+            self.data_file = open(f"{self.path}.{self.data_chunk_id}.data", 'r+b')
+            self.data_file.seek(self.byte_offsets[-1] - self.meta['chunk_begin'][-1])
+        self.encode_kwargs = {'record': record, 'compression': compression,
+                              'min_compress_bytes': min_compress_bytes, 'gzip_pickle': self.gzip}
+        self.meta['record'] = self.meta.get('record', False) or record
+        self.size_fields = list(size_fields)
+        sizes = self.meta.get('sizes', {})
+        if append and len(self.size_fields) > 0:
+            assert all(k in sizes for k in self.size_fields), "the dataset does not have the sizes of all size_fields"
+        self.meta['sizes'] = {k: np.asarray(sizes.get(k, []), dtype=np.int64).tolist() for k in self.size_fields}
+
+    def encode(self, item):
+        return encode_item(item, **self.encode_kwargs)
 
-    def add_item(self, item, id=None, use_pickle=True):
+    def add_item(self, item, id=None, use_pickle=True, sizes=None):
+        """
+        :param use_pickle: False if item is already encoded (bytes)
+        :param sizes: the sizes of the size_fields of an encoded item, see get_item_sizes
+        """
         if self.byte_offsets[-1] > self.meta['chunk_begin'][-1] + self.max_size:
             if self.data_file != self.root_data_file:
                 self.data_file.close()
@@ -130,18 +379,59 @@ class IndexedDatasetBuilder:
             self.data_file = open(f"{self.path}.{self.data_chunk_id}.data", 'wb')
             self.data_file.seek(0)
             self.meta['chunk_begin'].append(self.byte_offsets[-1])
-        if not use_pickle:
-            s = item
-        else:
-            s = pickle.dumps(item)
-            if self.gzip:
-                s = gzip.compress(s, 1)
-        bytes = self.data_file.write(s)
+        if len(self.size_fields) > 0:
+            if use_pickle:
+                sizes = get_item_sizes(item, self.size_fields)
+            assert sizes is not None, "the sizes of the encoded items are required when size_fields is set"
+            for k in self.size_fields:
+                self.meta['sizes'][k].append(int(sizes[k]))
+        s = self.encode(item) if use_pickle else item
+        if is_record(s):
+            # align the records in the chunk, so the arrays are aligned in the memory maps of the readers
+            pad = (-(self.byte_offsets[-1] - self.meta['chunk_begin'][-1])) % RECORD_ALIGN
+            self.byte_offsets[-1] += self.data_file.write(bytes(pad))
+        bytes_ = self.data_file.write(s)
         if id is not None:
             self.id2pos[id] = len(self.byte_offsets) - 1
-        self.byte_offsets.append(self.byte_offsets[-1] + bytes)
+        self.byte_offsets.append(self.byte_offsets[-1] + bytes_)
+
+    def add_items(self, item_func, args, num_workers=None, desc=None):
+        """
+        build and encode the items in worker processes and append them in the order of args
+        :param item_func: a top-level function, item_func(*arg) returns the item, or None to skip it
+        :return: the number of added items
+        """
+        job_args = [(item_func, arg, self.encode_kwargs, self.size_fields) for arg in args]
+        cnt = 0
+        for _, res in multiprocess_run_tqdm(_encode_item_job, job_args, num_workers=num_workers, desc=desc):
+            if res is None:
+                continue
+            s, sizes = res
+            self.add_item(s, use_pickle=False, sizes=sizes)
+            cnt += 1
+        return cnt
+
+    def add_dataset(self, path, batch_size=256):
+        """
+        append the encoded items of another indexed dataset (e.g., a shard binarized in parallel) without decoding them,
+        with their ids and sizes
+        :return: the number of added items
+        """
+        ds = IndexedDataset(path, mode='bytes')
+        assert ds.gzip == self.gzip, "the datasets are pickled with different gzip settings"
+        sizes = {k: ds.get_sizes(k) for k in self.size_fields}
+        assert all(v is not None for v in sizes.values()), f"{path} does not have the sizes of all size_fields"
+        pos2id = {pos: id for id, pos in ds.id2pos.items()}
+        for begin in range(0, len(ds), batch_size):
+            for i, s in enumerate(ds.get_many(range(begin, min(begin + batch_size, len(ds)))), begin):
+                self.add_item(s, id=pos2id.get(i), use_pickle=False, sizes={k: v[i] for k, v in sizes.items()})
+        self.meta['record'] = self.meta['record'] or ds.meta.get('record', False)
+        cnt = len(ds)
+        ds.close()
+        return cnt
 
     def finalize(self):
+        self.meta['sizes'] = {k: np.asarray(v, dtype=np.int64) for k, v in self.meta['sizes'].items()}
         self.root_data_file.seek(0)
         s = pickle.dumps({'offsets': self.byte_offsets, 'id2pos': self.id2pos, 'meta': self.meta})
         assert len(s) < self.default_idx_size, (len(s), self.default_idx_size)
@@ -186,6 +476,17 @@ if __name__ == "__main__":
         idx = random.randint(0, size - 1)
         assert (ds[idx]['a'] == items[idx]['a']).all()
 
+    # typed records, with the fields of 'b' compressed
+    builder = IndexedDatasetBuilder(ds_path, max_size=1024 * 1024 * 40, record=True, compression={'b': 'zlib'})
+    for i in tqdm(range(size)):
+        builder.add_item({**items[i], 'item_id': f'item_{i}'}, i)
+    builder.finalize()
+    ds = IndexedDataset(ds_path)
+    for i in tqdm(range(1000)):
+        idx = random.randint(0, size - 1)
+        item = ds[idx]
+        assert (item['a'] == items[idx]['a']).all() and (item['b'] == items[idx]['b']).all() and item['item_id'] == f'item_{idx}'
+
     # builder = IndexedDataset2Builder(ds_path, append=True)
     # builder.meta['lengths'] = [1, 2, 3, 5, 6, 7]
     # for i in tqdm(range(size)):
@@ -1,5 +1,9 @@
+import contextlib
+import json
+import os
 import time
 import torch
+from collections import OrderedDict
 
 
 class AvgrageMeter(object):
@@ -40,3 +44,91 @@ class Timer:
             Timer.timer_map[self.name] += time.time() - self.t
             if self.enable:
                 print(f'[Timer] {self.name}: {Timer.timer_map[self.name]}')
+
+
+class InferProfiler:
+    """
+    opt-in per-stage profiler of the inference loops, enabled by hparams['infer_profile'].
+    Records the wall time of each stage and the counters reported by the model,
+    optionally runs torch.profiler over a window of frames, and dumps everything into a json report.
+    """
+    def __init__(self, enable=False, torch_profile_start=0, torch_profile_frames=0):
+        self.enable = enable
+        self.stage_times = OrderedDict() # name: list of seconds
+        self.counters = OrderedDict()
+        self.torch_profile_start = torch_profile_start
+        self.torch_profile_frames = torch_profile_frames
+        self.torch_prof = None
+        self.torch_prof_running = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enable:
+            yield
+            return
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t = time.time()
+        yield
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.stage_times.setdefault(name, []).append(time.time() - t)
+
+    def add_counters(self, counters):
+        if not self.enable:
+            return
+        for k, v in counters.items():
+            self.counters[k] = self.counters.get(k, 0) + v
+
+    def step(self, frame_idx):
+        """
+        call it before rendering frame_idx, starts/stops the torch.profiler window
+        """
+        if not self.enable or self.torch_profile_frames <= 0:
+            return
+        if self.torch_prof is None and frame_idx >= self.torch_profile_start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_prof = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.torch_prof.start()
+            self.torch_prof_running = True
+        elif self.torch_prof_running and frame_idx >= self.torch_profile_start + self.torch_profile_frames:
+            self.stop_torch_profile()
+
+    def stop_torch_profile(self):
+        if self.torch_prof_running:
+            self.torch_prof.stop()
+            self.torch_prof_running = False
+
+    def summary(self):
+        stages = OrderedDict()
+        for name, times in self.stage_times.items():
+            stages[name] = {
+                'total': sum(times),
+                'mean': sum(times) / len(times),
+                'max': max(times),
+                'count': len(times),
+            }
+        return {'stages': stages, 'counters': dict(self.counters)}
+
+    def save(self, fname, meta=None):
+        """
+        dump the report into fname (json), the torch.profiler trace is saved next to it
+        """
+        if not self.enable:
+            return
+        report = OrderedDict(meta or {})
+        report.update(self.summary())
+        if self.torch_prof is not None:
+            self.stop_torch_profile()
+            trace_fname = os.path.splitext(fname)[0] + '_trace.json'
+            self.torch_prof.export_chrome_trace(trace_fname)
+            report['torch_profile'] = {
+                'trace': trace_fname,
+                'frames': [self.torch_profile_start, self.torch_profile_start + self.torch_profile_frames],
+                'top_ops': self.torch_prof.key_averages().table(sort_by='self_cpu_time_total', row_limit=20),
+            }
+        with open(fname, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"| Inference profile is saved at {fname}")
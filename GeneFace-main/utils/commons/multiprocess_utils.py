@@ -1,77 +1,226 @@
 import os
+import queue
+import time
 import traceback
+from collections import deque, namedtuple
 from functools import partial
+from multiprocessing import shared_memory
+import numpy as np
 from tqdm import tqdm
 
 
-def chunked_worker(worker_id, args_queue=None, results_queue=None, init_ctx_func=None):
+# a numpy result in a shared memory block, created by the worker and released by the main process
+SharedArray = namedtuple('SharedArray', ['name', 'shape', 'dtype'])
+
+
+class WorkerError(RuntimeError):
+    def __init__(self, job_idx, tb):
+        super().__init__(f"job {job_idx} failed in the worker:\n{tb}")
+        self.job_idx = job_idx
+        self.tb = tb
+
+
+def pack_result(res, min_shm_bytes):
+    """
+    move the numpy arrays of res (also in dicts, lists and tuples) of at least min_shm_bytes to shared memory
+    """
+    if isinstance(res, np.ndarray) and res.nbytes >= min_shm_bytes and not res.dtype.hasobject:
+        shm = shared_memory.SharedMemory(create=True, size=res.nbytes)
+        arr = np.ndarray(res.shape, dtype=res.dtype, buffer=shm.buf)
+        arr[...] = res
+        del arr
+        shm.close()
+        return SharedArray(shm.name, res.shape, res.dtype.str)
+    if type(res) is dict:
+        return {k: pack_result(v, min_shm_bytes) for k, v in res.items()}
+    if type(res) in (list, tuple):
+        return type(res)(pack_result(v, min_shm_bytes) for v in res)
+    return res
+
+
+def unpack_result(res):
+    if isinstance(res, SharedArray):
+        shm = shared_memory.SharedMemory(name=res.name)
+        arr = np.ndarray(res.shape, dtype=np.dtype(res.dtype), buffer=shm.buf).copy()
+        shm.close()
+        shm.unlink()
+        return arr
+    if type(res) is dict:
+        return {k: unpack_result(v) for k, v in res.items()}
+    if type(res) in (list, tuple):
+        return type(res)(unpack_result(v) for v in res)
+    return res
+
+
+def release_result(res):
+    """
+    unlink the shared memory blocks of a packed result that will not be unpacked
+    """
+    if isinstance(res, SharedArray):
+        try:
+            shm = shared_memory.SharedMemory(name=res.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+    elif type(res) is dict:
+        for v in res.values():
+            release_result(v)
+    elif type(res) in (list, tuple):
+        for v in res:
+            release_result(v)
+
+
+def chunked_worker(worker_id, args_queue=None, results_queue=None, init_ctx_func=None, min_shm_bytes=None):
     ctx = init_ctx_func(worker_id) if init_ctx_func is not None else None
     while True:
-        args = args_queue.get()
-        if args == '<KILL>':
+        jobs = args_queue.get()
+        if jobs == '<KILL>':
             return
-        job_idx, map_func, arg = args
-        try:
-            map_func_ = partial(map_func, ctx=ctx) if ctx is not None else map_func
-            if isinstance(arg, dict):
-                res = map_func_(**arg)
-            elif isinstance(arg, (list, tuple)):
-                res = map_func_(*arg)
-            else:
-                res = map_func_(arg)
-            results_queue.put((job_idx, res))
-        except:
-            traceback.print_exc()
-            results_queue.put((job_idx, None))
+        for job_idx, map_func, arg in jobs:
+            try:
+                map_func_ = partial(map_func, ctx=ctx) if ctx is not None else map_func
+                if isinstance(arg, dict):
+                    res = map_func_(**arg)
+                elif isinstance(arg, (list, tuple)):
+                    res = map_func_(*arg)
+                else:
+                    res = map_func_(arg)
+                if min_shm_bytes is not None:
+                    res = pack_result(res, min_shm_bytes)
+                results_queue.put((job_idx, True, res))
+            except:
+                traceback.print_exc()
+                results_queue.put((job_idx, False, traceback.format_exc()))
 
 
 class MultiprocessManager:
-    def __init__(self, num_workers=None, init_ctx_func=None, multithread=False, queue_max=-1):
+    """
+    chunk_size: the number of jobs sent to a worker in one message
+    min_shm_bytes: the numpy results of at least this size are returned through shared memory instead of
+        being pickled through the results queue (processes only)
+    on_error: 'none' returns None for a failed job (its traceback is printed by the worker), 'raise' raises
+        a WorkerError in get_results; a dead worker process always raises
+    """
+    def __init__(self, num_workers=None, init_ctx_func=None, multithread=False, queue_max=-1,
+                 chunk_size=1, min_shm_bytes=64 * 1024, on_error='none'):
         if multithread:
             from multiprocessing.dummy import Queue, Process
         else:
-            from multiprocessing import Queue, Process
+            from multiprocessing import Queue, Process, resource_tracker
+            # start the tracker of the shared memory blocks before forking, so the workers share it with us
+            # and a block created by a worker is released once we unlink it
+            resource_tracker.ensure_running()
         if num_workers is None:
             num_workers = int(os.getenv('N_PROC', os.cpu_count()))
+        assert on_error in ['raise', 'none'], on_error
         self.num_workers = num_workers
         self.results_queue = Queue(maxsize=-1)
-        self.jobs_pending = []
+        self.jobs_pending = deque()
         self.args_queue = Queue(maxsize=queue_max)
         self.workers = []
         self.total_jobs = 0
         self.multithread = multithread
+        self.chunk_size = chunk_size
+        self.on_error = on_error
+        min_shm_bytes = None if multithread else min_shm_bytes
         for i in range(num_workers):
             if multithread:
                 p = Process(target=chunked_worker,
-                            args=(i, self.args_queue, self.results_queue, init_ctx_func))
+                            args=(i, self.args_queue, self.results_queue, init_ctx_func, min_shm_bytes))
             else:
                 p = Process(target=chunked_worker,
-                            args=(i, self.args_queue, self.results_queue, init_ctx_func),
+                            args=(i, self.args_queue, self.results_queue, init_ctx_func, min_shm_bytes),
                             daemon=True)
             self.workers.append(p)
             p.start()
 
     def add_job(self, func, args):
-        if not self.args_queue.full():
-            self.args_queue.put((self.total_jobs, func, args))
-        else:
-            self.jobs_pending.append((self.total_jobs, func, args))
+        self.jobs_pending.append((self.total_jobs, func, args))
         self.total_jobs += 1
 
-    def get_results(self):
+    def _submit_jobs(self, max_job_idx):
+        # send the pending jobs with job_idx < max_job_idx, chunk_size jobs per message
+        while len(self.jobs_pending) > 0 and self.jobs_pending[0][0] < max_job_idx and not self.args_queue.full():
+            jobs = []
+            while len(jobs) < self.chunk_size and len(self.jobs_pending) > 0 and self.jobs_pending[0][0] < max_job_idx:
+                jobs.append(self.jobs_pending.popleft())
+            self.args_queue.put(jobs)
+
+    def _get_result(self):
+        while True:
+            try:
+                return self.results_queue.get(timeout=1)
+            except queue.Empty:
+                for i, w in enumerate(self.workers):
+                    if not w.is_alive():
+                        self._abort()
+                        raise RuntimeError(f"worker {i} exited unexpectedly (exit code {getattr(w, 'exitcode', None)})")
+
+    def get_results(self, ordered=False, max_in_flight=None):
+        """
+        :param ordered: yield the results in the order of the jobs; at most max_in_flight jobs
+            (default 4 * num_workers * chunk_size) after the next one to yield are submitted, which bounds the
+            number of results waiting for an earlier job
+        :return: yields job_idx, result
+        """
+        if max_in_flight is None:
+            max_in_flight = 4 * self.num_workers * self.chunk_size
         self.n_finished = 0
+        next_job_idx = 0
+        waiting = {}
         while self.n_finished < self.total_jobs:
-            while len(self.jobs_pending) > 0 and not self.args_queue.full():
-                self.args_queue.put(self.jobs_pending[0])
-                self.jobs_pending = self.jobs_pending[1:]
-            job_id, res = self.results_queue.get()
-            yield job_id, res
+            self._submit_jobs(next_job_idx + max_in_flight if ordered else self.total_jobs)
+            job_idx, ok, res = self._get_result()
             self.n_finished += 1
+            if ok:
+                res = unpack_result(res)
+            elif self.on_error == 'raise':
+                self._abort()
+                raise WorkerError(job_idx, res)
+            else:
+                res = None
+            if not ordered:
+                yield job_idx, res
+                continue
+            waiting[job_idx] = res
+            while next_job_idx in waiting:
+                yield next_job_idx, waiting.pop(next_job_idx)
+                next_job_idx += 1
         for w in range(self.num_workers):
             self.args_queue.put("<KILL>")
         for w in self.workers:
             w.join()
 
+    def _abort(self, timeout=10):
+        # drop the jobs not started, let the workers finish their chunk (killed after timeout), and unlink the
+        # shared memory blocks of the results that are not collected
+        self.jobs_pending.clear()
+        while True:
+            try:
+                self.args_queue.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            for _ in range(self.num_workers):
+                self.args_queue.put("<KILL>", timeout=1)
+        except queue.Full:
+            pass
+        deadline = time.time() + timeout
+        while any(w.is_alive() for w in self.workers) and time.time() < deadline:
+            self._release_results()
+        self.close()
+        self._release_results()
+
+    def _release_results(self):
+        while True:
+            try:
+                job_idx, ok, res = self.results_queue.get(timeout=0.1)
+            except (queue.Empty, EOFError, OSError):
+                return
+            if ok:
+                release_result(res)
+
     def close(self):
         if not self.multithread:
             for w in self.workers:
@@ -82,16 +231,16 @@ class MultiprocessManager:
 
 
 def multiprocess_run_tqdm(map_func, args, num_workers=None, ordered=True, init_ctx_func=None,
-                          multithread=False, queue_max=-1, desc=None):
+                          multithread=False, queue_max=-1, desc=None, **manager_kwargs):
     for i, res in tqdm(
             multiprocess_run(map_func, args, num_workers, ordered, init_ctx_func, multithread,
-                             queue_max=queue_max),
+                             queue_max=queue_max, **manager_kwargs),
             total=len(args), desc=desc):
         yield i, res
 
 
 def multiprocess_run(map_func, args, num_workers=None, ordered=True, init_ctx_func=None, multithread=False,
-                     queue_max=-1):
+                     queue_max=-1, **manager_kwargs):
     """
     Multiprocessing running chunked jobs.
 
@@ -106,25 +255,15 @@ def multiprocess_run(map_func, args, num_workers=None, ordered=True, init_ctx_fu
     :param init_ctx_func:
     :param q_max_size:
     :param multithread:
+    :param manager_kwargs: chunk_size, min_shm_bytes, on_error, see MultiprocessManager
     :return:
     """
     if num_workers is None:
         num_workers = int(os.getenv('N_PROC', os.cpu_count()))
         # num_workers = 1
-    manager = MultiprocessManager(num_workers, init_ctx_func, multithread, queue_max=queue_max)
+    manager = MultiprocessManager(num_workers, init_ctx_func, multithread, queue_max=queue_max, **manager_kwargs)
     for arg in args:
         manager.add_job(map_func, arg)
-    if ordered:
-        n_jobs = len(args)
-        results = ['<WAIT>' for _ in range(n_jobs)]
-        i_now = 0
-        for job_i, res in manager.get_results():
-            results[job_i] = res
-            while i_now < n_jobs and (not isinstance(results[i_now], str) or results[i_now] != '<WAIT>'):
-                yield i_now, results[i_now]
-                results[i_now] = None
-                i_now += 1
-    else:
-        for job_i, res in manager.get_results():
-            yield job_i, res
+    for job_i, res in manager.get_results(ordered=ordered):
+        yield job_i, res
     manager.close()
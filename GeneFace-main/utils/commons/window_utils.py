@@ -0,0 +1,110 @@
+"""
+The windows of the per-frame condition sequences (audio features, landmarks) along the time axis 0.
+The window of frame i covers the frames [i - left, i - left + win_size); the frames out of the sequence are
+zeros (pad_option='zero') or the first/last frame ('edge'). left is win_size // 2 by default (the window is centered,
+get_win_conds and att_mode=2), and win_size for the win_size frames before i (att_mode=1).
+
+    get_wins:    the windows of all frames in one call, [T, win_size, ...], a strided view of the padded sequence
+                 (sliding_window_view for numpy arrays, Tensor.unfold for tensors)
+    get_win:     the window of one frame, a view of the sequence if it does not need padding
+    gather_wins: the windows of some frames, [N, win_size, ...], in one indexing without padding the whole sequence
+Both numpy arrays and torch tensors are supported, the windows are of the same type as the sequence.
+"""
+import numpy as np
+import torch
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def _check_pad_option(pad_option):
+    if pad_option not in ['zero', 'edge']:
+        raise NotImplementedError(f'wrong pad_option: {pad_option}')
+
+
+def pad_seq(x, pad_left, pad_right, pad_option='zero'):
+    """
+    pad x along the axis 0
+    """
+    _check_pad_option(pad_option)
+    if pad_left == 0 and pad_right == 0:
+        return x
+    if isinstance(x, torch.Tensor):
+        if pad_option == 'zero':
+            left, right = x.new_zeros([pad_left, *x.shape[1:]]), x.new_zeros([pad_right, *x.shape[1:]])
+        else:
+            left, right = x[:1].expand(pad_left, *x.shape[1:]), x[-1:].expand(pad_right, *x.shape[1:])
+        return torch.cat([left, x, right], dim=0)
+    x = np.asarray(x)
+    return np.pad(x, [(pad_left, pad_right)] + [(0, 0)] * (x.ndim - 1), mode='constant' if pad_option == 'zero' else 'edge')
+
+
+def get_wins(x, win_size, left=None, pad_option='zero'):
+    """
+    :param x: [T, ...]
+    :return: [T, win_size, ...], a read-only view for numpy arrays, copy it (or .contiguous()) before writing
+    """
+    left = win_size // 2 if left is None else left
+    assert 0 <= left <= win_size, (left, win_size)
+    pad_right = win_size - left - 1
+    if pad_right < 0:
+        # the causal windows (left=win_size) do not reach the last frame
+        x, pad_right = x[:len(x) + pad_right], 0
+    padded = pad_seq(x, left, pad_right, pad_option)
+    if isinstance(padded, torch.Tensor):
+        return padded.unfold(0, win_size, 1).movedim(-1, 1)
+    return np.moveaxis(sliding_window_view(padded, win_size, axis=0), -1, 1)
+
+
+def gather_wins(x, idxs, win_size, left=None, pad_option='zero'):
+    """
+    :param idxs: [N] int, the frames of the windows
+    :return: [N, win_size, ...], a copy
+    """
+    _check_pad_option(pad_option)
+    left = win_size // 2 if left is None else left
+    frames = np.asarray(idxs, dtype=np.int64).reshape([-1, 1]) - left + np.arange(win_size) # [N, win_size]
+    clipped = np.clip(frames, 0, len(x) - 1) # the edge padding
+    outside = (frames < 0) | (frames >= len(x))
+    if isinstance(x, torch.Tensor):
+        wins = x[torch.from_numpy(clipped).to(x.device)]
+        if pad_option == 'zero' and outside.any():
+            wins[torch.from_numpy(outside).to(x.device)] = 0
+        return wins
+    wins = np.asarray(x)[clipped]
+    if pad_option == 'zero' and outside.any():
+        wins[outside] = 0
+    return wins
+
+
+def get_win(x, idx, win_size, left=None, pad_option='zero'):
+    """
+    :return: [win_size, ...], x[idx - left: idx - left + win_size] (a view) if it is in the sequence, otherwise a padded copy
+    """
+    left = win_size // 2 if left is None else left
+    begin = idx - left
+    if begin >= 0 and begin + win_size <= len(x):
+        return x[begin: begin + win_size]
+    return gather_wins(x, [idx], win_size, left, pad_option)[0]
+
+
+def get_win_conds(conds, idx, smo_win_size=8, pad_option='zero'):
+    """
+    conds: [b, t=16, h=29]
+    idx: long, time index of the selected frame, clamped into the sequence
+    """
+    idx = min(max(0, idx), conds.shape[0] - 1)
+    return get_win(conds, idx, smo_win_size, pad_option=pad_option)
+
+
+def get_att_win(features, att_mode, index, win_size):
+    """
+    the audio features of a frame for the attention modes of RAD-NeRF
+    att_mode: 0, the frame itself, [1, ...]; 1, the win_size frames before it; 2, the window centered on it
+    """
+    if att_mode == 0:
+        return features[[index]]
+    elif att_mode == 1:
+        return get_win(features, index, win_size, left=win_size, pad_option='zero')
+    elif att_mode == 2:
+        return get_win(features, index, win_size, pad_option='zero')
+    else:
+        raise NotImplementedError(f'wrong att_mode: {att_mode}')
@@ -0,0 +1,26 @@
+import contextlib
+import torch
+import torch.nn as nn
+
+
+def infer_autocast(device, precision='fp32'):
+    """
+    the autocast context of CPU inference.
+    :param device: 'cpu' or 'cuda', the policy only applies to cpu, cuda inference is left unchanged
+    :param precision: fp32 | bf16
+    """
+    if precision not in ['fp32', 'bf16']:
+        raise ValueError(f"Unsupported infer_cpu_precision: {precision}, choose from fp32 | bf16")
+    if device != 'cpu' or precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+
+
+def quantize_dynamic_int8(model):
+    """
+    dynamic int8 quantization for CPU inference, weights are stored in int8 and activations are quantized on the fly.
+    NOTE: torch only provides dynamic quantization for nn.Linear and RNNs, nn.Conv1d layers stay in float.
+    :param model: nn.Module in eval mode
+    :return: the quantized copy of model
+    """
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
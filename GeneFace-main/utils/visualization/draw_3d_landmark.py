@@ -5,9 +5,9 @@ import matplotlib.pyplot as plt
 import dearpygui.dearpygui as dpg
 from scipy.spatial.transform import Rotation as R
 from utils.commons.hparams import set_hparams, hparams
-from data_util.face3d_helper import Face3DHelper
+from data_util.face3d_helper import get_face3d_helper
 
-face3d_helper = Face3DHelper(use_gpu=False)
+face3d_helper = get_face3d_helper(use_gpu=False)
 
 
 set_hparams("egs/datasets/videos/May/radnerf_torso.yaml")
@@ -3,6 +3,7 @@ import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import random
+from data_gen.nerf.trainval_dataset import load_trainval_dataset
 
 def visualize(
     x,
@@ -101,11 +102,11 @@ idexp_lm3d_pred_lrs3 = np.load("infer_out/tmp_npys/lrs3_pred_all.npy")
 idx = np.random.choice(np.arange(len(idexp_lm3d_pred_lrs3)), 10000)
 idexp_lm3d_pred_lrs3 = idexp_lm3d_pred_lrs3[idx]
 
-person_ds = np.load("data/binary/videos/May/trainval_dataset.npy", allow_pickle=True).tolist()
+person_ds = load_trainval_dataset("data/binary/videos/May")
 person_idexp_mean = person_ds['idexp_lm3d_mean'].reshape([1,204])
 person_idexp_std = person_ds['idexp_lm3d_std'].reshape([1,204])
-person_idexp_lm3d_train = np.stack([s['idexp_lm3d_normalized'].reshape([204,]) for s in person_ds['train_samples']])
-person_idexp_lm3d_val = np.stack([s['idexp_lm3d_normalized'].reshape([204,]) for s in person_ds['val_samples']])
+person_idexp_lm3d_train = person_ds['train_samples'].column('idexp_lm3d_normalized').reshape([-1, 204])
+person_idexp_lm3d_val = person_ds['val_samples'].column('idexp_lm3d_normalized').reshape([-1, 204])
 
 lrs3_stats = np.load('/home/yezhenhui/datasets/binary/lrs3_0702/stats.npy',allow_pickle=True).tolist()
 lrs3_idexp_mean = lrs3_stats['idexp_lm3d_mean'].reshape([1,204])
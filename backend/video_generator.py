@@ -204,6 +204,10 @@ def generate_video(data):
             
             if os.path.exists(source_path):
                 shutil.copy(source_path, destination_path)
+                # infer_profile=true 时推理会在视频旁写出分阶段耗时报告，一并复制给前端
+                profile_path = os.path.splitext(source_path)[0] + "_profile.json"
+                if os.path.exists(profile_path):
+                    shutil.copy(profile_path, os.path.splitext(destination_path)[0] + "_profile.json")
                 print(f"[backend.video_generator] 视频生成完成，路径：{destination_path}")
                 return destination_path
             else: